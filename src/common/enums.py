@@ -26,6 +26,13 @@ class DicomExtensions(Enum):
     DICOM = ".dcm"
 
 
+class BrainMaskArtifacts(Enum):
+    """Files written by skull stripping and consumed by inference and postprocessing."""
+
+    MASK = "brain_mask.nii.gz"
+    BOUNDING_BOX = "brain_bbox.json"
+
+
 # TODO: parse this as JSON probably
 modalities = {
     "t1ce": [
@@ -0,0 +1,227 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from src.models.msnet.inference import build_network, get_network_list, restore_network
+from src.models.msnet.util.parse_config import parse_config
+from src.models.msnet.util.data_loader import DataLoader
+from src.models.msnet.util.session import (
+    get_host_key,
+    get_session_config,
+    get_thread_budget,
+    set_session_environment,
+)
+from src.models.msnet.util.train_test_func import get_adaptive_size, network_forward
+
+BATCH_SIZES = [1, 2, 4, 5, 6, 8]
+INTER_OP_THREADS = [1, 2]
+# [D, H, W] of a typical brain crop, used when no studies are given
+DEFAULT_IMAGE_SIZES = [[144, 176, 144]]
+# axes of the image in the axial, sagittal and coronal views
+VIEW_AXES = {"ax": (0, 1, 2), "sg": (2, 0, 1), "cr": (1, 0, 2)}
+
+
+def get_thread_candidates(budget):
+    """
+    intra-op and inter-op thread counts tried by the autotuner within the thread budget
+    """
+    candidates = []
+    for inter_op_threads in INTER_OP_THREADS:
+        for divisor in [1, 2, 4]:
+            intra_op_threads = max(1, budget // (inter_op_threads * divisor))
+            if (intra_op_threads, inter_op_threads) not in candidates:
+                candidates.append((intra_op_threads, inter_op_threads))
+    return candidates
+
+
+def get_image_sizes(config_file, studies_dir):
+    """
+    [D, H, W] sizes of the brain crops of the studies in studies_dir, as loaded by run_inference
+    """
+    config = parse_config(config_file, studies_dir, None, None)
+    dataloader = DataLoader(config["data"])
+    dataloader.load_data()
+    return [list(data.shape[:3]) for data in dataloader.data]
+
+
+def get_network_shapes(config, section, image_sizes):
+    """
+    input tensor shapes [data_slice, height, width, channel] of a network at test time.
+    The whole tumor networks see the whole brain crop, in the adaptive shapes of get_adaptive_size
+    for the view of the network. The tumor core and enhancing networks see tumor crops, which mostly
+    fit their native shape (shape_mode 1).
+    """
+    data_shape = config[section]["data_shape"]
+    if not section.startswith("network1"):
+        return [data_shape]
+    shape_buckets = config["testing"].get("shape_buckets", None)
+    if section[-2:] in VIEW_AXES:
+        views = [VIEW_AXES[section[-2:]]]
+    else:
+        views = list(VIEW_AXES.values())
+    shapes = []
+    for size in image_sizes:
+        for axes in views:
+            shape = [
+                data_shape[0],
+                get_adaptive_size(size[axes[1]], data_shape[1], shape_buckets),
+                get_adaptive_size(size[axes[2]], data_shape[2], shape_buckets),
+                data_shape[-1],
+            ]
+            if shape not in shapes:
+                shapes.append(shape)
+    return shapes
+
+
+def measure_network(config_net, config_session, batch_sizes, shapes, warmup=1, repeat=5):
+    """
+    per-slab latency of one network for each batch size, on synthetic inputs of each tensor shape
+    outputs:
+        latency: a dictionary mapping each batch size to the median duration per slab in seconds,
+                 averaged over the shapes
+    """
+    graph = tf.Graph()
+    latency = {}
+    with graph.as_default():
+        # the variables of the network are shared by the graphs of all the batch sizes and shapes
+        graphs = {}
+        net = None
+        for batch_size in batch_sizes:
+            for shape in shapes:
+                full_data_shape = [batch_size] + shape
+                if net is None:
+                    net, x, proby = build_network(config_net, full_data_shape)
+                else:
+                    x = tf.compat.v1.placeholder(tf.float32, full_data_shape)
+                    proby = network_forward(net, x)
+                graphs.setdefault(batch_size, []).append((x, proby, full_data_shape))
+        all_vars = tf.compat.v1.global_variables()
+        with tf.compat.v1.Session(graph=graph, config=get_session_config(config_session)) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            restore_network(sess, config_net, all_vars)
+            for batch_size, shape_graphs in graphs.items():
+                shape_latency = []
+                for x, proby, full_data_shape in shape_graphs:
+                    data = np.random.normal(0, 1, size=full_data_shape).astype(np.float32)
+                    for i in range(warmup):
+                        sess.run(proby, feed_dict={x: data})
+                    durations = []
+                    for i in range(repeat):
+                        t0 = time.time()
+                        sess.run(proby, feed_dict={x: data})
+                        durations.append(time.time() - t0)
+                    shape_latency.append(float(np.median(durations)) / batch_size)
+                latency[batch_size] = float(np.mean(shape_latency))
+    return latency
+
+
+def measure_candidate(config_file, config_session, batch_sizes, image_sizes):
+    """
+    per-slab latency of every network of the cascade with one session profile
+    outputs:
+        results: a dictionary mapping each section to the latency of measure_network
+    """
+    config = parse_config(config_file, None, None, None)
+    results = {}
+    for section in get_network_list(config):
+        shapes = get_network_shapes(config, section, image_sizes)
+        results[section] = measure_network(config[section], config_session, batch_sizes, shapes)
+    return results
+
+
+def autotune(config_file, tuning_file, studies_dir=None, batch_sizes=BATCH_SIZES):
+    """
+    sweep batch size, intra-op and inter-op threads for every network of the cascade and write the
+    best settings of this host to tuning_file, loaded by run_inference with tuning_file in [testing].
+    The session threads are shared by all the networks, so the thread counts minimizing the sum of
+    the per-slab latencies are kept, then the fastest batch size of each network with those threads.
+    The networks are timed at the tensor shapes of the studies in studies_dir, or of DEFAULT_IMAGE_SIZES.
+    """
+    config = parse_config(config_file, None, None, None)
+    config_session = config.get("session", {})
+    sections = get_network_list(config)
+    budget = get_thread_budget(config_session)
+    image_sizes = get_image_sizes(config_file, studies_dir) if studies_dir else DEFAULT_IMAGE_SIZES
+
+    results = {}
+    # OpenMP and MKL read their thread counts once per process, so each candidate runs in a new
+    # process started with the environment of its session profile
+    context = multiprocessing.get_context("spawn")
+    for intra_op_threads, inter_op_threads in get_thread_candidates(budget):
+        candidate_session = dict(config_session)
+        candidate_session["intra_op_threads"] = intra_op_threads
+        candidate_session["inter_op_threads"] = inter_op_threads
+        set_session_environment(candidate_session)
+        with context.Pool(1) as pool:
+            candidate_results = pool.apply(
+                measure_candidate, (config_file, candidate_session, batch_sizes, image_sizes)
+            )
+        results[(intra_op_threads, inter_op_threads)] = candidate_results
+        for section in sections:
+            latency = candidate_results[section]
+            print(
+                "{} intra {} inter {}: ".format(section, intra_op_threads, inter_op_threads)
+                + ", ".join(
+                    "batch {} {:.1f} ms/slab".format(b, 1000 * latency[b]) for b in batch_sizes
+                )
+            )
+
+    best_threads = min(
+        results,
+        key=lambda threads: sum(min(results[threads][s].values()) for s in sections),
+    )
+    networks = {}
+    for section in sections:
+        latency = results[best_threads][section]
+        best_batch_size = min(latency, key=latency.get)
+        networks[section] = {
+            "batch_size": best_batch_size,
+            "slab_latency": latency[best_batch_size],
+            "data_shape": config[section]["data_shape"],
+            "shapes": get_network_shapes(config, section, image_sizes),
+        }
+    host_key = get_host_key(config_session)
+    tuning = {
+        "session": {
+            "intra_op_threads": best_threads[0],
+            "inter_op_threads": best_threads[1],
+        },
+        "networks": networks,
+    }
+    print("best settings for {}: {}".format(host_key, json.dumps(tuning, indent=4)))
+
+    tunings = {}
+    if os.path.isfile(tuning_file):
+        with open(tuning_file) as f:
+            tunings = json.load(f)
+    tunings[host_key] = tuning
+    with open(tuning_file, "w") as f:
+        json.dump(tunings, f, indent=4)
+    return tuning
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print("Number of arguments should be 3 or 4. e.g.")
+        print(
+            "    python -m src.models.msnet.autotune src/models/msnet/config/mercure_config.txt "
+            "src/models/msnet/config/tuning.json [data/4-skull-strip]"
+        )
+        exit()
+    autotune(*sys.argv[1:])
@@ -0,0 +1,88 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from src.models.msnet.inference import build_network, get_network_list, restore_network
+from src.models.msnet.util.session import XLA_MODES, enable_cpu_auto_jit, get_session_config
+from src.models.msnet.util.parse_config import parse_config
+
+
+def benchmark_network(config_net, full_data_shape, xla="none", warmup=2, repeat=10):
+    """
+    measure the latency of one network on random minibatches
+    outputs:
+        first_run: duration of the first run in seconds, including XLA compilation
+        slab_latency: median duration per slab in seconds after warmup
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        net, x, proby = build_network(config_net, full_data_shape, xla=xla)
+        all_vars = tf.compat.v1.global_variables()
+        with tf.compat.v1.Session(graph=graph, config=get_session_config(None, xla)) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            restore_network(sess, config_net, all_vars)
+            data = np.random.normal(0, 1, size=full_data_shape).astype(np.float32)
+            t0 = time.time()
+            sess.run(proby, feed_dict={x: data})
+            first_run = time.time() - t0
+            for i in range(warmup - 1):
+                sess.run(proby, feed_dict={x: data})
+            durations = []
+            for i in range(repeat):
+                t0 = time.time()
+                sess.run(proby, feed_dict={x: data})
+                durations.append(time.time() - t0)
+    return first_run, float(np.median(durations)) / full_data_shape[0]
+
+
+def benchmark_xla(config_file, report_file=None, modes=XLA_MODES, repeat=10):
+    """
+    compare the per-slab latency of every network of the cascade with and without XLA,
+    with the batch size and tensor shape of the config
+    """
+    if "auto" in modes:
+        enable_cpu_auto_jit()
+    config = parse_config(config_file, None, None, None)
+    batch_size = config["testing"].get("batch_size", 5)
+    report = {}
+    for section in get_network_list(config):
+        full_data_shape = [batch_size] + config[section]["data_shape"]
+        report[section] = {}
+        for xla in modes:
+            first_run, slab_latency = benchmark_network(
+                config[section], full_data_shape, xla, repeat=repeat
+            )
+            report[section][xla] = {"first_run": first_run, "slab_latency": slab_latency}
+            print(
+                "{} xla {}: first run {:.2f}s, {:.1f} ms per slab".format(
+                    section, xla, first_run, 1000 * slab_latency
+                )
+            )
+    if report_file:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print("Number of arguments should be 2 or 3. e.g.")
+        print(
+            "    python -m src.models.msnet.benchmark src/models/msnet/config/mercure_config.txt [report.json]"
+        )
+        exit()
+    benchmark_xla(*sys.argv[1:])
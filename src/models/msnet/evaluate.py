@@ -0,0 +1,118 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from src.models.msnet.util.data_process import binary_dice3d, load_3d_volume_as_array
+from src.models.msnet.util.parse_config import parse_value_from_string
+
+# BraTS labels of each sub-region: 1 non enhancing core, 2 edema, 4 enhancing tumor
+SUBREGIONS = {"WT": [1, 2, 4], "TC": [1, 4], "EN": [4]}
+
+
+def subregion_dice(seg, reference):
+    """
+    dice score of each tumor sub-region between two label volumes
+    """
+    dice = {}
+    for region, labels in SUBREGIONS.items():
+        s = np.asarray(np.isin(seg, labels), np.float32)
+        g = np.asarray(np.isin(reference, labels), np.float32)
+        dice[region] = float(binary_dice3d(s, g))
+    return dice
+
+
+def compare_segmentation_dirs(test_dir, reference_dir):
+    """
+    compare the segmentations written by run_inference in two output folders
+    outputs:
+        report: per case dice of each sub-region, and their mean under "mean"
+    """
+    report = {}
+    for case in sorted(os.listdir(reference_dir)):
+        seg_name = os.path.join(case, "{}_seg_whole.nii.gz".format(case))
+        if not os.path.isfile(os.path.join(reference_dir, seg_name)):
+            continue
+        reference = load_3d_volume_as_array(os.path.join(reference_dir, seg_name))
+        seg = load_3d_volume_as_array(os.path.join(test_dir, seg_name))
+        report[case] = subregion_dice(seg, reference)
+    assert len(report) > 0, "no segmentation found in {}".format(reference_dir)
+    report["mean"] = dict(
+        (region, float(np.mean([report[case][region] for case in report])))
+        for region in SUBREGIONS
+    )
+    return report
+
+
+def evaluate_variants(studies_dir, output_dir, config_file, variants, reference):
+    """
+    run the cascade with several variants of the [testing] config and compare them to a reference variant
+    inputs:
+        studies_dir: skull-stripped studies, one folder per study
+        output_dir: each variant writes its segmentations to output_dir/<variant>
+        config_file: inference config file
+        variants: a dictionary mapping each variant name to its [testing] overrides
+        reference: name of the reference variant
+    outputs:
+        report: for each variant, the mean test time and the dice of each sub-region versus the reference
+    """
+    from src.models.msnet.inference import run_inference
+
+    report = {}
+    for name, overrides in variants.items():
+        variant_dir = os.path.join(output_dir, name)
+        run_inference(studies_dir, variant_dir, config_file, overrides=overrides)
+        test_time = np.loadtxt(os.path.join(variant_dir, "test_time.txt"), ndmin=1)
+        report[name] = {"test_time": float(test_time.mean())}
+
+    reference_dir = os.path.join(output_dir, reference)
+    for name in variants:
+        if name == reference:
+            continue
+        dice = compare_segmentation_dirs(os.path.join(output_dir, name), reference_dir)
+        report[name]["dice"] = dice
+        print(
+            "{} vs {}: time {:.2f}s vs {:.2f}s, ".format(
+                name, reference, report[name]["test_time"], report[reference]["test_time"]
+            )
+            + ", ".join(
+                "{} dice {:.4f}".format(region, dice["mean"][region]) for region in SUBREGIONS
+            )
+        )
+    with open(os.path.join(output_dir, "evaluation.json"), "w") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print("Number of arguments should be at least 5. e.g.")
+        print(
+            "    python -m src.models.msnet.evaluate data/validation data/evaluation "
+            "src/models/msnet/config/mercure_config.txt coarse_localization=2 [key=value ...]"
+        )
+        print("  compares the config with the [testing] values given (variant) to the config as is (reference)")
+        exit()
+    overrides = {}
+    for item in sys.argv[4:]:
+        key, val_str = item.split("=", 1)
+        overrides[key] = parse_value_from_string(val_str)
+    evaluate_variants(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        {"reference": {}, "variant": overrides},
+        "reference",
+    )
@@ -0,0 +1,84 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from src.models.msnet.inference import build_network, get_network_list, restore_network
+from src.models.msnet.util.frozen_graph import INPUT_SUFFIX, OUTPUT_SUFFIX
+from src.models.msnet.util.parse_config import parse_config
+
+
+def export_graph(config_file, graph_file):
+    """
+    freeze the networks of the cascade into a single constant-folded GraphDef.
+    Every network gets an input "<section>_input" of shape [None, D, None, None, C] and a
+    probability output "<section>_prob", so that batch size, height and width are chosen at test time.
+    inputs:
+        config_file: inference config file, e.g. src/models/msnet/config/mercure_config.txt
+        graph_file: path of the frozen graph (.pb)
+    """
+    t0 = time.time()
+    config = parse_config(config_file, None, None, None)
+    sections = get_network_list(config)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        for section in sections:
+            data_shape = config[section]["data_shape"]
+            full_data_shape = [None, data_shape[0], None, None, data_shape[-1]]
+            build_network(
+                config[section],
+                full_data_shape,
+                section + INPUT_SUFFIX,
+                section + OUTPUT_SUFFIX,
+            )
+        all_vars = tf.compat.v1.global_variables()
+        with tf.compat.v1.Session(graph=graph) as sess:
+            for section in sections:
+                restore_network(sess, config[section], all_vars)
+            output_names = [section + OUTPUT_SUFFIX for section in sections]
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), output_names
+            )
+
+    input_names = [section + INPUT_SUFFIX for section in sections]
+    graph_def = TransformGraph(
+        graph_def,
+        input_names,
+        output_names,
+        ["strip_unused_nodes", "fold_constants(ignore_errors=true)", "sort_by_execution_order"],
+    )
+    graph_dir = os.path.dirname(graph_file)
+    if graph_dir and not os.path.isdir(graph_dir):
+        os.makedirs(graph_dir)
+    with tf.io.gfile.GFile(graph_file, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    print(
+        "exported {} networks to {} in {:.1f}s".format(
+            len(sections), graph_file, time.time() - t0
+        )
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Number of arguments should be 3. e.g.")
+        print(
+            "    python -m src.models.msnet.export_graph src/models/msnet/config/mercure_config.txt "
+            "src/models/msnet/model19_prepost4s/msnet_cascade.pb"
+        )
+        exit()
+    export_graph(sys.argv[1], sys.argv[2])
@@ -0,0 +1,102 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+import tf2onnx
+
+from src.models.msnet.inference import get_network_list
+from src.models.msnet.util.frozen_graph import INPUT_SUFFIX, OUTPUT_SUFFIX, load_frozen_networks
+from src.models.msnet.util.onnx_backend import OnnxSession, get_onnx_file, load_onnx_networks
+from src.models.msnet.util.parse_config import parse_config
+
+ONNX_OPSET = 11
+
+
+def export_onnx(config_file, graph_file, onnx_dir):
+    """
+    convert the frozen cascade written by export_graph.py to one onnx model per network
+    inputs:
+        config_file: inference config file, e.g. src/models/msnet/config/mercure_config.txt
+        graph_file: the frozen graph (.pb)
+        onnx_dir: output directory, a <section>.onnx file is written for each network
+    """
+    config = parse_config(config_file, None, None, None)
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.io.gfile.GFile(graph_file, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    if not os.path.isdir(onnx_dir):
+        os.makedirs(onnx_dir)
+
+    for section in get_network_list(config):
+        t0 = time.time()
+        # batch, height and width stay dynamic in the onnx model
+        tf2onnx.convert.from_graph_def(
+            graph_def,
+            input_names=[section + INPUT_SUFFIX + ":0"],
+            output_names=[section + OUTPUT_SUFFIX + ":0"],
+            opset=ONNX_OPSET,
+            output_path=get_onnx_file(onnx_dir, section),
+        )
+        print("exported {} in {:.1f}s".format(section, time.time() - t0))
+
+
+def check_onnx_parity(config_file, graph_file, onnx_dir, batch_size=5, sizes=(96, 160), tolerance=1e-4):
+    """
+    compare the probabilities of the onnx networks with those of the tensorflow frozen graph
+    on random inputs, for each network and each input height/width in sizes
+    outputs:
+        max_diff: a dictionary mapping each section to the maximal absolute probability difference
+    """
+    config = parse_config(config_file, None, None, None)
+    sections = get_network_list(config)
+    tf_networks = load_frozen_networks(graph_file, sections)
+    onnx_networks = load_onnx_networks(onnx_dir, sections)
+    tf_sess = tf.compat.v1.Session()
+    onnx_sess = OnnxSession()
+
+    max_diff = {}
+    for section in sections:
+        data_shape = config[section]["data_shape"]
+        max_diff[section] = 0.0
+        for size in sizes:
+            data = np.random.normal(
+                0, 1, size=[batch_size, data_shape[0], size, size, data_shape[-1]]
+            ).astype(np.float32)
+            [_, x, proby] = tf_networks[section]
+            tf_prob = tf_sess.run(proby, feed_dict={x: data})
+            [_, x, proby] = onnx_networks[section]
+            onnx_prob = onnx_sess.run(proby, feed_dict={x: data})
+            diff = float(np.abs(tf_prob - onnx_prob).max())
+            max_diff[section] = max(max_diff[section], diff)
+        status = "ok" if max_diff[section] <= tolerance else "MISMATCH"
+        print("{}: max probability difference {:.2e} {}".format(section, max_diff[section], status))
+    tf_sess.close()
+    return max_diff
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] not in ["export", "check"]:
+        print("Number of arguments should be 5. e.g.")
+        print(
+            "    python -m src.models.msnet.export_onnx export src/models/msnet/config/mercure_config.txt "
+            "src/models/msnet/model19_prepost4s/msnet_cascade.pb src/models/msnet/model19_prepost4s/onnx"
+        )
+        print("  use check instead of export to compare the onnx and tensorflow probabilities")
+        exit()
+    if sys.argv[1] == "export":
+        export_onnx(sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        check_onnx_parity(sys.argv[2], sys.argv[3], sys.argv[4])
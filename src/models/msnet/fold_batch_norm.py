@@ -0,0 +1,131 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from src.models.msnet.evaluate import evaluate_variants
+from src.models.msnet.inference import get_network_list
+from src.models.msnet.util.calibration import record_calibration_data
+from src.models.msnet.util.folded_graph import (
+    InferenceMSNet,
+    calibrate_statistics,
+    get_moving_statistics,
+    load_checkpoint_weights,
+)
+from src.models.msnet.util.frozen_graph import INPUT_SUFFIX, OUTPUT_SUFFIX, load_frozen_networks
+from src.models.msnet.util.parse_config import parse_config
+
+
+def export_folded_graph(config_file, folded_graph_file, statistics, calibration_data=None):
+    """
+    write the cascade with batch normalization folded into the convolutions as a frozen graph,
+    loaded like the graph of export_graph.py with frozen_graph in [testing]
+    inputs:
+        config_file: inference config file
+        folded_graph_file: path of the folded graph (.pb)
+        statistics: "moving" to use moving_mean/moving_variance of the checkpoints, or "calibrated"
+                    to use the average minibatch moments over calibration_data
+        calibration_data: a CalibrationData recorded with the original networks
+    """
+    config = parse_config(config_file, None, None, None)
+    graph = tf.Graph()
+    with graph.as_default():
+        for section in get_network_list(config):
+            t0 = time.time()
+            config_net = config[section]
+            weights = load_checkpoint_weights(config_net["model_file"], config_net["net_name"])
+            if statistics == "moving":
+                net_statistics = get_moving_statistics(weights)
+            else:
+                batches = calibration_data.batches[section]
+                net_statistics = calibrate_statistics(weights, config_net, batches)
+            data_shape = config_net["data_shape"]
+            x = tf.compat.v1.placeholder(
+                tf.float32,
+                [None, data_shape[0], None, None, data_shape[-1]],
+                name=section + INPUT_SUFFIX,
+            )
+            net = InferenceMSNet(weights, config_net, net_statistics)
+            tf.nn.softmax(net(x), name=section + OUTPUT_SUFFIX)
+            print("folded {} in {:.1f}s".format(section, time.time() - t0))
+    with tf.io.gfile.GFile(folded_graph_file, "wb") as f:
+        f.write(graph.as_graph_def().SerializeToString())
+
+
+def compare_folded_graph(config_file, graph_file, folded_graph_file, calibration_data):
+    """
+    compare the probabilities of the folded networks with those of the original networks
+    (minibatch statistics) on the recorded calibration minibatches
+    """
+    config = parse_config(config_file, None, None, None)
+    sections = get_network_list(config)
+    report = {}
+    for name, graph_name in [("original", graph_file), ("folded", folded_graph_file)]:
+        graph = tf.Graph()
+        with graph.as_default():
+            networks = load_frozen_networks(graph_name, sections)
+            with tf.compat.v1.Session(graph=graph) as sess:
+                for section in sections:
+                    [_, x, proby] = networks[section]
+                    report.setdefault(section, {})[name] = [
+                        sess.run(proby, feed_dict={x: data})
+                        for data in calibration_data.batches[section]
+                    ]
+    for section in sections:
+        original = report[section]["original"]
+        folded = report[section]["folded"]
+        max_diff = max(float(np.abs(p - q).max()) for p, q in zip(original, folded))
+        agreement = np.mean(
+            [np.mean(np.argmax(p, -1) == np.argmax(q, -1)) for p, q in zip(original, folded)]
+        )
+        print(
+            "{}: max probability difference {:.4f}, label agreement {:.4f}".format(
+                section, max_diff, agreement
+            )
+        )
+
+
+def fold_batch_norm(
+    studies_dir, config_file, graph_file, folded_graph_file, statistics="calibrated", output_dir=None
+):
+    """
+    build the folded cascade and compare it with the original one.
+    Calibration and comparison minibatches are recorded by running the original frozen graph
+    (export_graph.py) on studies_dir. When output_dir is given, both cascades are also run on
+    studies_dir and the dice of each sub-region and the test times are reported.
+    """
+    calibration_data = record_calibration_data(
+        studies_dir, config_file, {"frozen_graph": graph_file}
+    )
+    export_folded_graph(config_file, folded_graph_file, statistics, calibration_data)
+    compare_folded_graph(config_file, graph_file, folded_graph_file, calibration_data)
+    if output_dir:
+        variants = {
+            "original": {"frozen_graph": graph_file},
+            "folded": {"frozen_graph": folded_graph_file},
+        }
+        evaluate_variants(studies_dir, output_dir, config_file, variants, "original")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [5, 6, 7]:
+        print("Number of arguments should be 5 to 7. e.g.")
+        print(
+            "    python -m src.models.msnet.fold_batch_norm data/calibration src/models/msnet/config/mercure_config.txt "
+            "src/models/msnet/model19_prepost4s/msnet_cascade.pb src/models/msnet/model19_prepost4s/msnet_folded.pb "
+            "[calibrated|moving] [evaluation_output_dir]"
+        )
+        exit()
+    fold_batch_norm(*sys.argv[1:])
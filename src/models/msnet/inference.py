@@ -17,9 +17,6 @@ from scipy import ndimage
 
 # sys.path.insert(0, '/gpfs/scratch/bz957/brats_skynet/lib/python3.6/site-packages/')
 
-os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-
 import tensorflow as tf
 
 # from tensorflow.contrib.data import Iterator
@@ -27,367 +24,264 @@ from src.models.msnet.util.data_loader import *
 from src.models.msnet.util.data_process import *
 from src.models.msnet.util.train_test_func import *
 from src.models.msnet.util.parse_config import parse_config
-from src.models.msnet.train import NetFactory
+from src.models.msnet.util.calibration import RecordingSession
+from src.models.msnet.util.frozen_graph import load_frozen_networks
+from src.models.msnet.util.session import create_session, get_thread_counts, load_tuning
 
 
-def run_inference(input_dir, output_dir, config_file, example_names=None) -> dict:
-    # 1, load configure file
+def get_network_sections(config):
+    """
+    get the config sections of the networks used by the cascade, one list per stage.
+    A stage uses either one network for the three views (e.g. network1) or one network
+    per view (e.g. network1ax, network1sg and network1cr).
+    """
+    config_test = config["testing"]
+    if config_test.get("whole_tumor_only", False) is False:
+        stages = [1, 2, 3]
+    else:
+        stages = [1]
+    stage_sections = []
+    for stage in stages:
+        section = "network{}".format(stage)
+        if config.get(section, None):
+            stage_sections.append([section, section, section])
+        else:
+            stage_sections.append([section + "ax", section + "sg", section + "cr"])
+    return stage_sections
+
+
+def get_network_list(config):
+    """
+    get the config sections of all the networks of the cascade, each section once
+    """
+    sections = []
+    for stage in get_network_sections(config):
+        sections += [section for section in stage if section not in sections]
+    return sections
+
+
+def build_network(config_net, full_data_shape, input_name=None, output_name=None, xla="none"):
+    """
+    construct the graph of one network
+    inputs:
+        config_net: config section of the network
+        full_data_shape: shape of the input placeholder, unknown dimensions may be None
+        input_name, output_name: optional names of the input and probability tensors
+        xla: with jit_scope, the forward pass of the network is compiled with XLA
+    outputs:
+        net: the network object
+        x: the input placeholder
+        proby: the probability output
+    """
+    # niftynet is only imported when graphs are built in python
+    from src.models.msnet.train import NetFactory
+
+    x = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape, name=input_name)
+    net_class = NetFactory.create(config_net["net_type"])
+    net = net_class(
+        num_classes=config_net["class_num"],
+        w_regularizer=None,
+        b_regularizer=None,
+        name=config_net["net_name"],
+    )
+    net.set_params(config_net)
+    net.jit_scope = xla == "jit_scope"
+    proby = tf.identity(network_forward(net, x), name=output_name)
+    return net, x, proby
+
+
+def restore_network(sess, config_net, all_vars):
+    """
+    restore the variables of one network from its checkpoint
+    """
+    net_name = config_net["net_name"]
+    net_vars = [x for x in all_vars if x.name[0 : len(net_name) + 1] == net_name + "/"]
+    saver = tf.compat.v1.train.Saver(net_vars)
+    saver.restore(sess, config_net["model_file"])
+
+
+def get_stage_networks(config, networks, sections, batch_sizes):
+    """
+    get the arguments of test_one_image_three_nets_adaptive_shape for one stage of the cascade
+    """
+    config_nets = [config[section] for section in sections]
+    data_shapes = [config_net["data_shape"][:-1] for config_net in config_nets]
+    label_shapes = [config_net["label_shape"][:-1] for config_net in config_nets]
+    data_channel = config_nets[0]["data_shape"][-1]
+    class_num = config_nets[0]["class_num"]
+    stage_batch_sizes = [batch_sizes[section] for section in sections]
+    nets = [networks[section][0] for section in sections]
+    inputs = [networks[section][1] for section in sections]
+    outputs = [networks[section][2] for section in sections]
+    return [
+        data_shapes,
+        label_shapes,
+        data_channel,
+        class_num,
+        stage_batch_sizes,
+        nets,
+        outputs,
+        inputs,
+    ]
+
+
+def get_coarse_bounding_box(coarse_prob, coarse_weight, full_shape, factor, margin):
+    """
+    locate the whole tumor on the study downsampled by factor
+    inputs:
+        coarse_prob: whole tumor probability of stage 1 on the study downsampled with downsample_volume
+        coarse_weight: brain mask downsampled the same way
+        full_shape: shape of the study in full resolution
+        factor: downsampling factor of the localization pass
+        margin: margin added around the coarse tumor, in full resolution voxels
+    outputs:
+        bbox: [bbmin, bbmax] of the tumor with margin in full resolution, or None when the coarse
+              tumor is empty or touches the boundary of the study, then the full pass is needed
+    """
+    coarse_pred = (coarse_prob > 0.5) * coarse_weight
+    if coarse_pred.sum() == 0:
+        return None
+    bbmin, bbmax = get_ND_bounding_box(coarse_pred, 0)
+    coarse_shape = coarse_pred.shape
+    if min(bbmin) == 0 or any(bbmax[i] == coarse_shape[i] - 1 for i in range(3)):
+        return None
+    bbmin = [max(bbmin[i] * factor - margin, 0) for i in range(3)]
+    bbmax = [min(bbmax[i] * factor + factor - 1 + margin, full_shape[i] - 1) for i in range(3)]
+    return [bbmin, bbmax]
+
+
+def predict_whole_tumor(imgs, weight, factor=0, margin=10, dtype=np.float32):
+    """
+    whole tumor probability of stage 1, a generator yielding the (stage, images, weight) of each
+    prediction and sent the probability back.
+    With factor > 1, the whole tumor is first located on the study downsampled factor times, and
+    the full resolution pass covers the coarse tumor with margin voxels around it only, the
+    probability is 0 elsewhere. The full resolution pass covers the whole study when the coarse
+    tumor is empty or touches the boundary of the study, see get_coarse_bounding_box.
+    outputs:
+        prob1: whole tumor probability of the study
+        wt_bbox: [bbmin, bbmax] covered by the full resolution pass, None for the whole study
+    """
+    wt_bbox = None
+    if factor > 1:
+        coarse_weight = downsample_volume(weight, factor) > 0
+        coarse_prob = yield (0, downsample_volume(imgs, factor), coarse_weight)
+        wt_bbox = get_coarse_bounding_box(coarse_prob, coarse_weight, weight.shape, factor, margin)
+    if wt_bbox is None:
+        prob1 = yield (0, imgs, weight)
+        return prob1, wt_bbox
+    # full resolution pass around the coarse tumor only
+    roi_prob1 = yield (
+        0,
+        crop_ND_volume_with_bounding_box(imgs, wt_bbox[0] + [0], wt_bbox[1] + [imgs.shape[-1] - 1]),
+        crop_ND_volume_with_bounding_box(weight, wt_bbox[0], wt_bbox[1]),
+    )
+    prob1 = np.zeros(weight.shape, dtype)
+    prob1 = set_ND_volume_roi_with_bounding_box_range(prob1, wt_bbox[0], wt_bbox[1], roi_prob1)
+    return prob1, wt_bbox
+
+
+def run_inference(
+    input_dir, output_dir, config_file, example_names=None, overrides=None
+) -> dict:
+    # 1, load configure file, overrides replace values of the [testing] section
     config = parse_config(config_file, input_dir, output_dir, example_names)
     config_data = config["data"]
-    config_net1 = config.get("network1", None)
-    config_net2 = config.get("network2", None)
-    config_net3 = config.get("network3", None)
     config_test = config["testing"]
+    if overrides:
+        config_test.update(overrides)
+    # the session profile also sets the devices visible to tensorflow
+    config_session = config.get("session", {})
+    config_session.setdefault("cuda_visible_devices", 0)
     batch_size = config_test.get("batch_size", 5)
-
-    # 2.1, network for whole tumor
-    if config_net1:
-        net_type1 = config_net1["net_type"]
-        net_name1 = config_net1["net_name"]
-        data_shape1 = config_net1["data_shape"]
-        label_shape1 = config_net1["label_shape"]
-        class_num1 = config_net1["class_num"]
-
-        # construct graph for 1st network
-        full_data_shape1 = [batch_size] + data_shape1
-        x1 = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape1)
-        net_class1 = NetFactory.create(net_type1)
-        net1 = net_class1(
-            num_classes=class_num1,
-            w_regularizer=None,
-            b_regularizer=None,
-            name=net_name1,
-        )
-        net1.set_params(config_net1)
-        predicty1 = net1(x1, is_training=True)
-        proby1 = tf.nn.softmax(predicty1)
+    # per network batch sizes and session threads measured by autotune.py for this host
+    tuning = load_tuning(config_test.get("tuning_file", None), config_session)
+    shape_buckets = config_test.get("shape_buckets", None)
+    frozen_graph = config_test.get("frozen_graph", None)
+    onnx_dir = config_test.get("onnx_dir", None)
+    xla = config_test.get("xla", "none")
+    if xla == "jit_scope" and (frozen_graph or onnx_dir):
+        print("jit_scope needs networks built in python, using xla auto-clustering instead")
+        xla = "auto"
+    # run the three views of each stage in parallel threads, see get_thread_counts
+    concurrent_views = config_session.get("concurrent_views", False)
+    # three view ensembles built as one graph returning the label of each stage, see build_fused_ensemble
+    fused_views = config_test.get("fused_views", False)
+    assert not (fused_views and (frozen_graph or onnx_dir)), "fused_views needs networks built in python"
+    stage_sections = get_network_sections(config)
+    sections = get_network_list(config)
+    batch_sizes = dict((section, batch_size) for section in sections)
+    if tuning:
+        for key in ["intra_op_threads", "inter_op_threads"]:
+            if not config_session.get(key, 0):
+                config_session[key] = tuning["session"][key]
+        for section in sections:
+            if section in tuning["networks"]:
+                batch_sizes[section] = tuning["networks"][section]["batch_size"]
+
+    # 2, networks for whole tumor, tumor core and enhanced tumor
+    model_t0 = time.time()
+    tf.compat.v1.reset_default_graph()
+    if onnx_dir:
+        # onnx networks exported by export_onnx.py, run with onnxruntime on CPU
+        from src.models.msnet.util.onnx_backend import OnnxSession, load_onnx_networks
+
+        intra_op_threads = get_thread_counts(config_session)[0]
+        if concurrent_views:
+            # each onnx network has its own thread pool, the views split the budget
+            intra_op_threads = max(1, intra_op_threads // 3)
+        precision = config_test.get("precision", "fp32")
+        networks = load_onnx_networks(onnx_dir, sections, intra_op_threads, precision)
+    elif frozen_graph:
+        # frozen cascade exported by export_graph.py, no graph construction in python
+        networks = load_frozen_networks(frozen_graph, sections)
     else:
-        config_net1ax = config["network1ax"]
-        config_net1sg = config["network1sg"]
-        config_net1cr = config["network1cr"]
-
-        # construct graph for 1st network axial
-        net_type1ax = config_net1ax["net_type"]
-        net_name1ax = config_net1ax["net_name"]
-        data_shape1ax = config_net1ax["data_shape"]
-        label_shape1ax = config_net1ax["label_shape"]
-        class_num1ax = config_net1ax["class_num"]
-
-        full_data_shape1ax = [batch_size] + data_shape1ax
-        x1ax = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape1ax)
-        net_class1ax = NetFactory.create(net_type1ax)
-        net1ax = net_class1ax(
-            num_classes=class_num1ax,
-            w_regularizer=None,
-            b_regularizer=None,
-            name=net_name1ax,
-        )
-        net1ax.set_params(config_net1ax)
-        predicty1ax = net1ax(x1ax, is_training=True)
-        proby1ax = tf.nn.softmax(predicty1ax)
-
-        # construct graph for 1st network sagittal
-        net_type1sg = config_net1sg["net_type"]
-        net_name1sg = config_net1sg["net_name"]
-        data_shape1sg = config_net1sg["data_shape"]
-        label_shape1sg = config_net1sg["label_shape"]
-        class_num1sg = config_net1sg["class_num"]
-
-        full_data_shape1sg = [batch_size] + data_shape1sg
-        x1sg = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape1sg)
-        net_class1sg = NetFactory.create(net_type1sg)
-        net1sg = net_class1sg(
-            num_classes=class_num1sg,
-            w_regularizer=None,
-            b_regularizer=None,
-            name=net_name1sg,
-        )
-        net1sg.set_params(config_net1sg)
-        predicty1sg = net1sg(x1sg, is_training=True)
-        proby1sg = tf.nn.softmax(predicty1sg)
-
-        # construct graph for 1st network corogal
-        net_type1cr = config_net1cr["net_type"]
-        net_name1cr = config_net1cr["net_name"]
-        data_shape1cr = config_net1cr["data_shape"]
-        label_shape1cr = config_net1cr["label_shape"]
-        class_num1cr = config_net1cr["class_num"]
-
-        full_data_shape1cr = [batch_size] + data_shape1cr
-        x1cr = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape1cr)
-        net_class1cr = NetFactory.create(net_type1cr)
-        net1cr = net_class1cr(
-            num_classes=class_num1cr,
-            w_regularizer=None,
-            b_regularizer=None,
-            name=net_name1cr,
-        )
-        net1cr.set_params(config_net1cr)
-        predicty1cr = net1cr(x1cr, is_training=True)
-        proby1cr = tf.nn.softmax(predicty1cr)
-
-    if config_test.get("whole_tumor_only", False) is False:  # 改动1 !
-        # 2.2, networks for tumor core
-        if config_net2:
-            net_type2 = config_net2["net_type"]
-            net_name2 = config_net2["net_name"]
-            data_shape2 = config_net2["data_shape"]
-            label_shape2 = config_net2["label_shape"]
-            class_num2 = config_net2["class_num"]
-
-            # construct graph for 2st network
-            full_data_shape2 = [batch_size] + data_shape2
-            x2 = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape2)
-            net_class2 = NetFactory.create(net_type2)
-            net2 = net_class2(
-                num_classes=class_num2,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name2,
+        networks = {}
+        for section in sections:
+            # dynamic batch dimension, so that the last minibatch runs at its true size
+            full_data_shape = [None] + config[section]["data_shape"]
+            networks[section] = build_network(
+                config[section], full_data_shape, xla=xla
             )
-            net2.set_params(config_net2)
-            predicty2 = net2(x2, is_training=True)
-            proby2 = tf.nn.softmax(predicty2)
-        else:
-            config_net2ax = config["network2ax"]
-            config_net2sg = config["network2sg"]
-            config_net2cr = config["network2cr"]
-
-            # construct graph for 2st network axial
-            net_type2ax = config_net2ax["net_type"]
-            net_name2ax = config_net2ax["net_name"]
-            data_shape2ax = config_net2ax["data_shape"]
-            label_shape2ax = config_net2ax["label_shape"]
-            class_num2ax = config_net2ax["class_num"]
-
-            full_data_shape2ax = [batch_size] + data_shape2ax
-            x2ax = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape2ax)
-            net_class2ax = NetFactory.create(net_type2ax)
-            net2ax = net_class2ax(
-                num_classes=class_num2ax,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name2ax,
-            )
-            net2ax.set_params(config_net2ax)
-            predicty2ax = net2ax(x2ax, is_training=True)
-            proby2ax = tf.nn.softmax(predicty2ax)
-
-            # construct graph for 2st network sagittal
-            net_type2sg = config_net2sg["net_type"]
-            net_name2sg = config_net2sg["net_name"]
-            data_shape2sg = config_net2sg["data_shape"]
-            label_shape2sg = config_net2sg["label_shape"]
-            class_num2sg = config_net2sg["class_num"]
-
-            full_data_shape2sg = [batch_size] + data_shape2sg
-            x2sg = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape2sg)
-            net_class2sg = NetFactory.create(net_type2sg)
-            net2sg = net_class2sg(
-                num_classes=class_num2sg,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name2sg,
-            )
-            net2sg.set_params(config_net2sg)
-            predicty2sg = net2sg(x2sg, is_training=True)
-            proby2sg = tf.nn.softmax(predicty2sg)
-
-            # construct graph for 2st network corogal
-            net_type2cr = config_net2cr["net_type"]
-            net_name2cr = config_net2cr["net_name"]
-            data_shape2cr = config_net2cr["data_shape"]
-            label_shape2cr = config_net2cr["label_shape"]
-            class_num2cr = config_net2cr["class_num"]
-
-            full_data_shape2cr = [batch_size] + data_shape2cr
-            x2cr = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape2cr)
-            net_class2cr = NetFactory.create(net_type2cr)
-            net2cr = net_class2cr(
-                num_classes=class_num2cr,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name2cr,
-            )
-            net2cr.set_params(config_net2cr)
-            predicty2cr = net2cr(x2cr, is_training=True)
-            proby2cr = tf.nn.softmax(predicty2cr)
-
-        # 2.3, networks for enhanced tumor
-        if config_net3:
-            net_type3 = config_net3["net_type"]
-            net_name3 = config_net3["net_name"]
-            data_shape3 = config_net3["data_shape"]
-            label_shape3 = config_net3["label_shape"]
-            class_num3 = config_net3["class_num"]
-
-            # construct graph for 3st network
-            full_data_shape3 = [batch_size] + data_shape3
-            x3 = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape3)
-            net_class3 = NetFactory.create(net_type3)
-            net3 = net_class3(
-                num_classes=class_num3,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name3,
-            )
-            net3.set_params(config_net3)
-            predicty3 = net3(x3, is_training=True)
-            proby3 = tf.nn.softmax(predicty3)
-        else:
-            config_net3ax = config["network3ax"]
-            config_net3sg = config["network3sg"]
-            config_net3cr = config["network3cr"]
-
-            # construct graph for 3st network axial
-            net_type3ax = config_net3ax["net_type"]
-            net_name3ax = config_net3ax["net_name"]
-            data_shape3ax = config_net3ax["data_shape"]
-            label_shape3ax = config_net3ax["label_shape"]
-            class_num3ax = config_net3ax["class_num"]
-
-            full_data_shape3ax = [batch_size] + data_shape3ax
-            x3ax = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape3ax)
-            net_class3ax = NetFactory.create(net_type3ax)
-            net3ax = net_class3ax(
-                num_classes=class_num3ax,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name3ax,
-            )
-            net3ax.set_params(config_net3ax)
-            predicty3ax = net3ax(x3ax, is_training=True)
-            proby3ax = tf.nn.softmax(predicty3ax)
-
-            # construct graph for 3st network sagittal
-            net_type3sg = config_net3sg["net_type"]
-            net_name3sg = config_net3sg["net_name"]
-            data_shape3sg = config_net3sg["data_shape"]
-            label_shape3sg = config_net3sg["label_shape"]
-            class_num3sg = config_net3sg["class_num"]
-            # construct graph for 3st network
-            full_data_shape3sg = [batch_size] + data_shape3sg
-            x3sg = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape3sg)
-            net_class3sg = NetFactory.create(net_type3sg)
-            net3sg = net_class3sg(
-                num_classes=class_num3sg,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name3sg,
-            )
-            net3sg.set_params(config_net3sg)
-            predicty3sg = net3sg(x3sg, is_training=True)
-            proby3sg = tf.nn.softmax(predicty3sg)
-
-            # construct graph for 3st network corogal
-            net_type3cr = config_net3cr["net_type"]
-            net_name3cr = config_net3cr["net_name"]
-            data_shape3cr = config_net3cr["data_shape"]
-            label_shape3cr = config_net3cr["label_shape"]
-            class_num3cr = config_net3cr["class_num"]
-            # construct graph for 3st network
-            full_data_shape3cr = [batch_size] + data_shape3cr
-            x3cr = tf.compat.v1.placeholder(tf.float32, shape=full_data_shape3cr)
-            net_class3cr = NetFactory.create(net_type3cr)
-            net3cr = net_class3cr(
-                num_classes=class_num3cr,
-                w_regularizer=None,
-                b_regularizer=None,
-                name=net_name3cr,
-            )
-            net3cr.set_params(config_net3cr)
-            predicty3cr = net3cr(x3cr, is_training=True)
-            proby3cr = tf.nn.softmax(predicty3cr)
+        fused_graphs = []
+        if fused_views:
+            for stage in stage_sections:
+                [
+                    data_shapes,
+                    label_shapes,
+                    data_channel,
+                    _,
+                    stage_batch_sizes,
+                    nets,
+                    _,
+                    _,
+                ] = get_stage_networks(config, networks, stage, batch_sizes)
+                fused_graphs.append(
+                    build_fused_ensemble(
+                        nets, data_shapes, label_shapes, data_channel, stage_batch_sizes
+                    )
+                )
 
     # 3, create session and load trained models
     print("create session and load trained models /n")
-    model_t0 = time.time()
 
     # with tf.device("/device:GPU:0"): #0806
-    all_vars = tf.compat.v1.global_variables()
-    sess = tf.compat.v1.InteractiveSession()
-    sess.run(tf.compat.v1.global_variables_initializer())
-    if config_net1:
-        net1_vars = [
-            x for x in all_vars if x.name[0 : len(net_name1) + 1] == net_name1 + "/"
-        ]
-        saver1 = tf.compat.v1.train.Saver(net1_vars)
-        saver1.restore(sess, config_net1["model_file"])
+    if onnx_dir:
+        sess = OnnxSession()
     else:
-        net1ax_vars = [
-            x for x in all_vars if x.name[0 : len(net_name1ax) + 1] == net_name1ax + "/"
-        ]
-        saver1ax = tf.compat.v1.train.Saver(net1ax_vars)
-        saver1ax.restore(sess, config_net1ax["model_file"])
-        net1sg_vars = [
-            x for x in all_vars if x.name[0 : len(net_name1sg) + 1] == net_name1sg + "/"
-        ]
-        saver1sg = tf.compat.v1.train.Saver(net1sg_vars)
-        saver1sg.restore(sess, config_net1sg["model_file"])
-        net1cr_vars = [
-            x for x in all_vars if x.name[0 : len(net_name1cr) + 1] == net_name1cr + "/"
-        ]
-        saver1cr = tf.compat.v1.train.Saver(net1cr_vars)
-        saver1cr.restore(sess, config_net1cr["model_file"])
-
-    if config_test.get("whole_tumor_only", False) is False:  # 改动2!
-        if config_net2:
-            net2_vars = [
-                x for x in all_vars if x.name[0 : len(net_name2) + 1] == net_name2 + "/"
-            ]
-            saver2 = tf.compat.v1.train.Saver(net2_vars)
-            saver2.restore(sess, config_net2["model_file"])
-        else:
-            net2ax_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name2ax) + 1] == net_name2ax + "/"
-            ]
-            saver2ax = tf.compat.v1.train.Saver(net2ax_vars)
-            saver2ax.restore(sess, config_net2ax["model_file"])
-            net2sg_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name2sg) + 1] == net_name2sg + "/"
-            ]
-            saver2sg = tf.compat.v1.train.Saver(net2sg_vars)
-            saver2sg.restore(sess, config_net2sg["model_file"])
-            net2cr_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name2cr) + 1] == net_name2cr + "/"
-            ]
-            saver2cr = tf.compat.v1.train.Saver(net2cr_vars)
-            saver2cr.restore(sess, config_net2cr["model_file"])
-
-        if config_net3:
-            net3_vars = [
-                x for x in all_vars if x.name[0 : len(net_name3) + 1] == net_name3 + "/"
-            ]
-            saver3 = tf.compat.v1.train.Saver(net3_vars)
-            saver3.restore(sess, config_net3["model_file"])
-        else:
-            net3ax_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name3ax) + 1] == net_name3ax + "/"
-            ]
-            saver3ax = tf.compat.v1.train.Saver(net3ax_vars)
-            saver3ax.restore(sess, config_net3ax["model_file"])
-            net3sg_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name3sg) + 1] == net_name3sg + "/"
-            ]
-            saver3sg = tf.compat.v1.train.Saver(net3sg_vars)
-            saver3sg.restore(sess, config_net3sg["model_file"])
-            net3cr_vars = [
-                x
-                for x in all_vars
-                if x.name[0 : len(net_name3cr) + 1] == net_name3cr + "/"
-            ]
-            saver3cr = tf.compat.v1.train.Saver(net3cr_vars)
-            saver3cr.restore(sess, config_net3cr["model_file"])
+        all_vars = tf.compat.v1.global_variables()
+        sess = create_session(config_session, xla)
+        sess.run(tf.compat.v1.global_variables_initializer())
+        if not frozen_graph:
+            for section in sections:
+                restore_network(sess, config[section], all_vars)
+
+    calibration_data = config_test.get("calibration_data", None)
+    if calibration_data is not None:
+        # record the inputs of each network, see quantize.py and fold_batch_norm.py
+        assert onnx_dir or frozen_graph, "calibration needs a frozen graph or onnx networks"
+        names = dict((networks[section][2], section) for section in sections)
+        sess = RecordingSession(sess, calibration_data, names)
 
     print("Model load time is {}".format(time.time() - model_t0))
 
@@ -403,11 +297,70 @@ def run_inference(input_dir, output_dir, config_file, example_names=None) -> dic
     print("start to test \n")
     test_slice_direction = config_test.get("test_slice_direction", "all")
     save_folder = output_dir
+    # per study: time of the cascade as before, excluding the nifti outputs, and time of the outputs
     test_time = []
+    write_time = []
+    write_times = {}
     struct = ndimage.generate_binary_structure(3, 2)
     margin = config_test.get("roi_patch_margin", 5)
+    min_slab_voxels = config_test.get("min_slab_voxels", 0)
+    prob_dtype = np.dtype(config_test.get("probability_dtype", "float32"))
+    # skip: stop the cascade after net1 if it finds no tumor, cascade: run net2 and net3 on the brain
+    empty_whole_tumor = config_test.get("empty_whole_tumor", "cascade")
+    # [low, high] to run the sagittal and coronal networks only where the axial probability is in between
+    adaptive_views = config_test.get("adaptive_views", None)
+    # downsampling factor of the whole tumor localization pass, 0 or 1 runs stage 1 on the whole brain
+    coarse_factor = config_test.get("coarse_localization", 0)
+    coarse_margin = config_test.get("coarse_margin", 10)
+    assert empty_whole_tumor in ["skip", "cascade"], "empty_whole_tumor should be skip or cascade"
+
+    def predict_stage(stage, imgs, weight, scheduler=None, statistics=None):
+        """
+        average foreground probability of the three views of a stage of the cascade,
+        or its label with fused_views. With a scheduler, the probability is complete once
+        the scheduler has run. The slabs and skipped forward passes are counted in statistics.
+        """
+        if fused_views:
+            [x, label] = fused_graphs[stage]
+            return sess.run(label, feed_dict={x: imgs})
+        [
+            data_shapes,
+            label_shapes,
+            data_channel,
+            class_num,
+            stage_batch_sizes,
+            nets,
+            outputs,
+            inputs,
+        ] = get_stage_networks(config, networks, stage_sections[stage], batch_sizes)
+        return test_one_image_three_nets_adaptive_shape(
+            imgs,
+            data_shapes,
+            label_shapes,
+            data_channel,
+            class_num,
+            stage_batch_sizes,
+            sess,
+            nets,
+            outputs,
+            inputs,
+            shape_mode=2 if stage == 0 else 1,
+            shape_buckets=shape_buckets,
+            weight=weight,
+            min_slab_voxels=min_slab_voxels,
+            dtype=prob_dtype,
+            uncertain_range=adaptive_views,
+            concurrent=concurrent_views,
+            scheduler=scheduler,
+            statistics=statistics,
+        )
 
-    for i in range(image_num):
+    def segment_study(i):
+        """
+        segment the i-th study, a generator yielding the (stage, images, weight) of each prediction
+        of the cascade and sent the probability back, it returns the tumor volumes of the study.
+        The time spent writing its outputs is stored in write_times[i].
+        """
         [
             temp_imgs,
             temp_weight,
@@ -416,216 +369,126 @@ def run_inference(input_dir, output_dir, config_file, example_names=None) -> dic
             temp_bbox,
             temp_size,
         ] = dataloader.get_image_data_with_name(i)
-        t0 = time.time()
-        # 5.1, test of 1st network
-        if config_net1:
-            data_shapes = [data_shape1[:-1], data_shape1[:-1], data_shape1[:-1]]
-            label_shapes = [label_shape1[:-1], label_shape1[:-1], label_shape1[:-1]]
-            nets = [net1, net1, net1]
-            outputs = [proby1, proby1, proby1]
-            inputs = [x1, x1, x1]
-            class_num = class_num1
-        else:
-            data_shapes = [data_shape1ax[:-1], data_shape1sg[:-1], data_shape1cr[:-1]]
-            label_shapes = [
-                label_shape1ax[:-1],
-                label_shape1sg[:-1],
-                label_shape1cr[:-1],
-            ]
-            nets = [net1ax, net1sg, net1cr]
-            outputs = [proby1ax, proby1sg, proby1cr]
-            inputs = [x1ax, x1sg, x1cr]
-            class_num = class_num1ax
-        prob1 = test_one_image_three_nets_adaptive_shape(
-            temp_imgs,
-            data_shapes,
-            label_shapes,
-            data_shape1ax[-1],
-            class_num,
-            batch_size,
-            sess,
-            nets,
-            outputs,
-            inputs,
-            shape_mode=2,
-        )  # average probability of ax,sg,co
-        pred1 = np.asarray(np.argmax(prob1, axis=3), np.uint16)
+        # 5.1, test of 1st network, average probability of ax,sg,co
+        prob1, wt_bbox = yield from predict_whole_tumor(
+            temp_imgs, temp_weight, coarse_factor, coarse_margin, prob_dtype
+        )
+        if coarse_factor > 1 and wt_bbox is None:
+            print("coarse localization failed, full resolution pass", temp_name)
+        pred1 = np.asarray(prob1 > 0.5, np.uint16)
         pred1 = pred1 * temp_weight  # what is the temp_weight
 
         wt_threshold = 500  # 4500
+        early_exit = False
         if config_test.get("whole_tumor_only", False) is True:  # 改动3!
-            pred1_lc = ndimage.morphology.binary_closing(pred1, structure=struct)
+            pred1_lc = binary_closing_in_bounding_box(pred1, struct)
             pred1_lc = get_largest_two_component(pred1_lc, False, wt_threshold)
             out_label = pred1_lc
+        elif pred1.sum() == 0 and empty_whole_tumor == "skip":
+            print("net1 output is null, net2 and net3 are skipped", temp_name)
+            early_exit = True
+            out_label = np.zeros(pred1.shape, np.int16)
         else:
             # 5.2, test of 2nd network
             if pred1.sum() == 0:
                 print("net1 output is null", temp_name)
-                bbox1 = get_ND_bounding_box(temp_imgs[0] > 0, margin)
+                bbox1 = get_ND_bounding_box(temp_weight, margin)
             else:
-                pred1_lc = ndimage.morphology.binary_closing(pred1, structure=struct)
+                pred1_lc = binary_closing_in_bounding_box(pred1, struct)
                 pred1_lc = get_largest_two_component(pred1_lc, False, wt_threshold)
                 bbox1 = get_ND_bounding_box(pred1_lc, margin)
-            sub_imgs = [
-                crop_ND_volume_with_bounding_box(one_img, bbox1[0], bbox1[1])
-                for one_img in temp_imgs
-            ]
+            sub_imgs = crop_ND_volume_with_bounding_box(
+                temp_imgs, bbox1[0] + [0], bbox1[1] + [temp_imgs.shape[-1] - 1]
+            )
             sub_weight = crop_ND_volume_with_bounding_box(
                 temp_weight, bbox1[0], bbox1[1]
             )
 
-            if config_net2:
-                data_shapes = [data_shape2[:-1], data_shape2[:-1], data_shape2[:-1]]
-                label_shapes = [label_shape2[:-1], label_shape2[:-1], label_shape2[:-1]]
-                nets = [net2, net2, net2]
-                outputs = [proby2, proby2, proby2]
-                inputs = [x2, x2, x2]
-                class_num = class_num2
-            else:
-                data_shapes = [
-                    data_shape2ax[:-1],
-                    data_shape2sg[:-1],
-                    data_shape2cr[:-1],
-                ]
-                label_shapes = [
-                    label_shape2ax[:-1],
-                    label_shape2sg[:-1],
-                    label_shape2cr[:-1],
-                ]
-                nets = [net2ax, net2sg, net2cr]
-                outputs = [proby2ax, proby2sg, proby2cr]
-                inputs = [x2ax, x2sg, x2cr]
-                class_num = class_num2ax
-            prob2 = test_one_image_three_nets_adaptive_shape(
-                sub_imgs,
-                data_shapes,
-                label_shapes,
-                data_shape2ax[-1],
-                class_num,
-                batch_size,
-                sess,
-                nets,
-                outputs,
-                inputs,
-                shape_mode=1,
-            )
-            pred2 = np.asarray(np.argmax(prob2, axis=3), np.uint16)
+            prob2 = yield (1, sub_imgs, sub_weight)
+            pred2 = np.asarray(prob2 > 0.5, np.uint16)
             pred2 = pred2 * sub_weight
 
             # 5.3, test of 3rd network
             if pred2.sum() == 0:
-                [roid, roih, roiw] = sub_imgs[0].shape
+                [roid, roih, roiw] = sub_imgs.shape[:3]
                 bbox2 = [[0, 0, 0], [roid - 1, roih - 1, roiw - 1]]
                 subsub_imgs = sub_imgs
                 subsub_weight = sub_weight
             else:
-                pred2_lc = ndimage.morphology.binary_closing(pred2, structure=struct)
+                pred2_lc = binary_closing_in_bounding_box(pred2, struct)
                 pred2_lc = get_largest_two_component(pred2_lc)
                 bbox2 = get_ND_bounding_box(pred2_lc, margin)
-                subsub_imgs = [
-                    crop_ND_volume_with_bounding_box(one_img, bbox2[0], bbox2[1])
-                    for one_img in sub_imgs
-                ]
+                subsub_imgs = crop_ND_volume_with_bounding_box(
+                    sub_imgs, bbox2[0] + [0], bbox2[1] + [sub_imgs.shape[-1] - 1]
+                )
                 subsub_weight = crop_ND_volume_with_bounding_box(
                     sub_weight, bbox2[0], bbox2[1]
                 )
 
-            if config_net3:
-                data_shapes = [data_shape3[:-1], data_shape3[:-1], data_shape3[:-1]]
-                label_shapes = [label_shape3[:-1], label_shape3[:-1], label_shape3[:-1]]
-                nets = [net3, net3, net3]
-                outputs = [proby3, proby3, proby3]
-                inputs = [x3, x3, x3]
-                class_num = class_num3
-            else:
-                data_shapes = [
-                    data_shape3ax[:-1],
-                    data_shape3sg[:-1],
-                    data_shape3cr[:-1],
-                ]
-                label_shapes = [
-                    label_shape3ax[:-1],
-                    label_shape3sg[:-1],
-                    label_shape3cr[:-1],
-                ]
-                nets = [net3ax, net3sg, net3cr]
-                outputs = [proby3ax, proby3sg, proby3cr]
-                inputs = [x3ax, x3sg, x3cr]
-                class_num = class_num3ax
-
-            prob3 = test_one_image_three_nets_adaptive_shape(
-                subsub_imgs,
-                data_shapes,
-                label_shapes,
-                data_shape3ax[-1],
-                class_num,
-                batch_size,
-                sess,
-                nets,
-                outputs,
-                inputs,
-                shape_mode=1,
-            )
+            prob3 = yield (2, subsub_imgs, subsub_weight)
 
-            pred3 = np.asarray(np.argmax(prob3, axis=3), np.uint16)
+            pred3 = np.asarray(prob3 > 0.5, np.uint16)
             pred3 = pred3 * subsub_weight
 
             # 5.4, fuse results at 3 levels
-            # convert subsub_label to full size (non-enhanced)
+            # tumor core and enhancing tumor only exist in bbox1, they are fused in bbox1 coordinates
+            # convert subsub_label to bbox1 size (non-enhanced)
             label3_roi = np.zeros_like(pred2)
             label3_roi = set_ND_volume_roi_with_bounding_box_range(
                 label3_roi, bbox2[0], bbox2[1], pred3
             )
-            label3 = np.zeros_like(pred1)
-            label3 = set_ND_volume_roi_with_bounding_box_range(
-                label3, bbox1[0], bbox1[1], label3_roi
-            )
+            label2_3_roi = (pred2 + label3_roi) > 0
 
-            label2 = np.zeros_like(pred1)
-            label2 = set_ND_volume_roi_with_bounding_box_range(
-                label2, bbox1[0], bbox1[1], pred2
-            )
-
-            label1_mask = (pred1 + label2 + label3) > 0
-            label1_mask = ndimage.morphology.binary_closing(
-                label1_mask, structure=struct
-            )
+            label1_mask = pred1 > 0
+            # adds the core of bbox1 to label1_mask through a view
+            label1_mask_roi = get_ND_volume_roi_view(label1_mask, bbox1[0], bbox1[1])
+            label1_mask_roi |= label2_3_roi
+            label1_mask = binary_closing_in_bounding_box(label1_mask, struct)
             label1_mask = get_largest_two_component(label1_mask, False, wt_threshold)
             label1 = pred1 * label1_mask
 
-            label2_3_mask = (label2 + label3) > 0
-            label2_3_mask = label2_3_mask * label1_mask
-            label2_3_mask = ndimage.morphology.binary_closing(
-                label2_3_mask, structure=struct
+            label1_mask_roi = crop_ND_volume_with_bounding_box(
+                label1_mask, bbox1[0], bbox1[1]
             )
-            label2_3_mask = remove_external_core(label1, label2_3_mask)
+            label1_roi = crop_ND_volume_with_bounding_box(label1, bbox1[0], bbox1[1])
+            label2_3_mask = label2_3_roi * label1_mask_roi
+            # the part of the volume around bbox1 reached by the closing
+            padding = [
+                (min(bbox1[0][dim], 2), min(pred1.shape[dim] - 1 - bbox1[1][dim], 2))
+                for dim in range(3)
+            ]
+            label2_3_mask = binary_closing_in_bounding_box(
+                label2_3_mask, struct, padding
+            )
+            label2_3_mask = remove_external_core(label1_roi, label2_3_mask)
             if label2_3_mask.sum() > 0:
                 label2_3_mask = get_largest_two_component(label2_3_mask)
-            label1 = (label1 + label2_3_mask) > 0
-            label2 = label2_3_mask
-            label3 = label2 * label3
-            vox_3 = np.asarray(label3 > 0, np.float32).sum()
+            label2_roi = label2_3_mask
+            label3_roi = label2_roi * label3_roi
+            vox_3 = np.asarray(label3_roi > 0, np.float32).sum()
             if 0 < vox_3 and vox_3 < 30:
-                label3 = np.zeros_like(label2)
+                label3_roi = np.zeros_like(label2_roi)
 
             # 5.5, convert label and save output
-            out_label = label1 * 2
+            out_label = np.asarray(label1 > 0, np.int16) * np.int16(2)
+            # the labels of bbox1 are written to out_label through a view
+            out_label_roi = get_ND_volume_roi_view(out_label, bbox1[0], bbox1[1])
+            out_label_roi[label2_roi > 0] = 2
             if (
                 "Flair" in config_data["modality_postfix"]
                 and "mha" in config_data["file_postfix"]
             ):
-                out_label[label2 > 0] = 3
-                out_label[label3 == 1] = 1
-                out_label[label3 == 2] = 4
+                out_label_roi[label2_roi > 0] = 3
+                out_label_roi[label3_roi == 1] = 1
+                out_label_roi[label3_roi == 2] = 4
             elif (
                 "flair" in config_data["modality_postfix"]
                 and "nii" in config_data["file_postfix"]
             ):
-                out_label[label2 > 0] = 1
-                out_label[label3 > 0] = 4
-            out_label = np.asarray(out_label, np.int16)
+                out_label_roi[label2_roi > 0] = 1
+                out_label_roi[label3_roi > 0] = 4
 
-        test_time.append(time.time() - t0)
+        write_t0 = time.time()
         final_label = np.zeros(temp_size, np.int16)
         final_label = set_ND_volume_roi_with_bounding_box_range(
             final_label, temp_bbox[0], temp_bbox[1], out_label
@@ -643,6 +506,8 @@ def run_inference(input_dir, output_dir, config_file, example_names=None) -> dic
         tumor_volume = calculate_tumor(
             subfolder + "/{}_seg_whole.nii.gz".format(temp_name.split("/")[-1])
         )
+        # studies without whole tumor that stopped after net1
+        tumor_volume["early exit"] = early_exit
         # print tumor volume report for each case
         volume_report = (
             f"The quantitative volumetry report of accession number {temp_name.split('/')[-1]} suggests total tumor volume"
@@ -709,10 +574,79 @@ def run_inference(input_dir, output_dir, config_file, example_names=None) -> dic
             subfolder + "/{}_seg_non_enhanced.nii.gz".format(temp_name.split("/")[-1]),
             volume_report_non_enhanced,
         )
+        write_times[i] = time.time() - write_t0
+        return tumor_volume
+
+    # number of studies segmented together, the slabs of all of them fill the minibatches of each network
+    queue_depth = config_test.get("queue_depth", 1)
+    assert queue_depth == 1 or not (
+        fused_views or adaptive_views
+    ), "queue_depth needs the three views of a stage to be run independently"
+    assert queue_depth == 1 or not (
+        frozen_graph or onnx_dir
+    ), "queue_depth is not supported with frozen or onnx networks yet"
+    tumor_volumes = {}
+    queue_time = []
+
+    def step(i, prob=None):
+        """
+        run the i-th study of the queue up to its next prediction, or to its end
+        """
+        t0 = time.time()
+        try:
+            if prob is None:
+                requests[i] = next(studies[i])
+            else:
+                requests[i] = studies[i].send(prob)
+        except StopIteration as stop:
+            del requests[i]
+            tumor_volumes[i] = stop.value
+        study_time[i] += time.time() - t0
+
+    for first in range(0, image_num, queue_depth):
+        queued = list(range(first, min(first + queue_depth, image_num)))
+        queue_t0 = time.time()
+        statistics = SlabStatistics()
+        # time of the steps of each study, and its share of the forward passes run together
+        study_time = dict((i, 0.0) for i in queued)
+        studies = dict((i, segment_study(i)) for i in queued)
+        requests = {}
+        for i in queued:
+            step(i)
+        while requests:
+            # the studies of the queue may be at different stages, slabs are grouped by network
+            t0 = time.time()
+            scheduler = SlabScheduler() if queue_depth > 1 else None
+            probs = dict(
+                (i, predict_stage(*requests[i], scheduler=scheduler, statistics=statistics))
+                for i in requests
+            )
+            if scheduler is not None:
+                scheduler.run(sess)
+            for i in probs:
+                study_time[i] += (time.time() - t0) / len(probs)
+            for i in probs:
+                step(i, probs[i])
+        test_time += [study_time[i] - write_times[i] for i in queued]
+        write_time += [write_times[i] for i in queued]
+        queue_time.append(time.time() - queue_t0)
+        print(
+            "{}: skipped {} of {} slab forward passes, {} without brain voxels and "
+            "{} sagittal or coronal ones certain in the axial view".format(
+                ", ".join(dataloader.patient_names[i] for i in queued),
+                statistics.get_skipped(),
+                statistics.total,
+                statistics.get_skipped("brain"),
+                statistics.get_skipped("views"),
+            )
+        )
 
     test_time = np.asarray(test_time)
     print("test time", test_time.mean())
+    print("write time", np.mean(write_time))
+    if queue_depth > 1:
+        print("queue time", np.mean(queue_time), "for", queue_depth, "studies")
     np.savetxt(save_folder + "/test_time.txt", test_time)
     sess.close()
 
-    return tumor_volume
+    return tumor_volumes[image_num - 1]
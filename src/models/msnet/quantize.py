@@ -0,0 +1,106 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import onnxruntime as ort
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from src.models.msnet.evaluate import evaluate_variants
+from src.models.msnet.util.calibration import record_calibration_data
+from src.models.msnet.util.onnx_backend import get_onnx_file
+
+
+class RecordedDataReader(CalibrationDataReader):
+    """
+    feed the network inputs recorded by CalibrationData to the onnxruntime calibrator
+    """
+
+    def __init__(self, batches, input_name):
+        self.batches = iter(batches)
+        self.input_name = input_name
+
+    def get_next(self):
+        data = next(self.batches, None)
+        if data is None:
+            return None
+        return {self.input_name: data}
+
+
+def quantize_networks(studies_dir, onnx_dir, config_file, max_batches=16):
+    """
+    calibrate and quantize the onnx networks of the cascade to int8.
+    The float32 cascade is run on the calibration studies so that every network is calibrated on the
+    inputs it receives in the cascade, e.g. tumor core networks on the crops around the whole tumor.
+    inputs:
+        studies_dir: skull-stripped calibration studies, one folder per study
+        onnx_dir: directory written by export_onnx.py, <section>_int8.onnx files are added to it
+        config_file: inference config file
+        max_batches: maximal number of calibration minibatches per network
+    """
+    calibration_data = record_calibration_data(
+        studies_dir, config_file, {"onnx_dir": onnx_dir, "precision": "fp32"}, max_batches
+    )
+
+    for section, batches in calibration_data.batches.items():
+        t0 = time.time()
+        model_file = get_onnx_file(onnx_dir, section, "fp32")
+        prepared_file = get_onnx_file(onnx_dir, section, "int8") + ".prep"
+        quant_pre_process(model_file, prepared_file)
+        input_name = ort.InferenceSession(prepared_file).get_inputs()[0].name
+        # activations are asymmetric after PReLU, weights are quantized per output channel
+        quantize_static(
+            prepared_file,
+            get_onnx_file(onnx_dir, section, "int8"),
+            RecordedDataReader(batches, input_name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+        os.remove(prepared_file)
+        print(
+            "quantized {} with {} of {} minibatches in {:.1f}s".format(
+                section, len(batches), calibration_data.counts[section], time.time() - t0
+            )
+        )
+
+
+def evaluate_quantized_networks(studies_dir, output_dir, onnx_dir, config_file):
+    """
+    report the dice of the int8 cascade versus the float32 cascade for each sub-region (WT/TC/EN)
+    """
+    variants = {
+        "fp32": {"onnx_dir": onnx_dir, "precision": "fp32"},
+        "int8": {"onnx_dir": onnx_dir, "precision": "int8"},
+    }
+    return evaluate_variants(studies_dir, output_dir, config_file, variants, "fp32")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [4, 5]:
+        print("Number of arguments should be 4 or 5. e.g.")
+        print(
+            "    python -m src.models.msnet.quantize data/calibration src/models/msnet/model19_prepost4s/onnx "
+            "src/models/msnet/config/mercure_config.txt [evaluation_output_dir]"
+        )
+        exit()
+    quantize_networks(sys.argv[1], sys.argv[2], sys.argv[3])
+    if len(sys.argv) == 5:
+        evaluate_quantized_networks(sys.argv[1], sys.argv[4], sys.argv[2], sys.argv[3])
@@ -488,8 +488,9 @@ class TensorSliceLayer(TrainableLayer):
         input_shape = input_tensor.get_shape().as_list()
         begin = [0] * len(input_shape)
         begin[1] = self.margin
-        size = input_shape
-        size[1] = size[1] - 2 * self.margin
+        # -1 keeps the whole extent, so that batch, height and width may be unknown
+        size = [-1] * len(input_shape)
+        size[1] = input_shape[1] - 2 * self.margin
         output_tensor = tf.slice(input_tensor, begin, size, name="slice")
         return output_tensor
 
@@ -0,0 +1,90 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import random
+import shutil
+import tempfile
+import threading
+
+
+class CalibrationData(object):
+    """
+    inputs of each network recorded while running the cascade on calibration studies.
+    At most max_batches minibatches are kept per network, chosen by reservoir sampling so that
+    each recorded minibatch has the same chance to be kept. Studies with few minibatches may not
+    be represented.
+    """
+
+    def __init__(self, max_batches=16, seed=1):
+        self.max_batches = max_batches
+        self.random = random.Random(seed)
+        self.batches = {}
+        self.counts = {}
+        # views may run in parallel threads, see concurrent_views
+        self.lock = threading.Lock()
+
+    def add(self, name, data):
+        with self.lock:
+            batches = self.batches.setdefault(name, [])
+            count = self.counts.get(name, 0) + 1
+            self.counts[name] = count
+            if len(batches) < self.max_batches:
+                batches.append(data)
+            else:
+                idx = self.random.randint(0, count - 1)
+                if idx < self.max_batches:
+                    batches[idx] = data
+
+
+class RecordingSession(object):
+    """
+    session wrapper recording the minibatches fed to each network into a CalibrationData
+    inputs:
+        sess: the session used by the test functions
+        calibration_data: a CalibrationData
+        names: a dictionary mapping the output of each network to its config section
+    """
+
+    def __init__(self, sess, calibration_data, names):
+        self.sess = sess
+        self.calibration_data = calibration_data
+        self.names = names
+
+    def run(self, fetches, feed_dict):
+        for data in feed_dict.values():
+            self.calibration_data.add(self.names[fetches], data)
+        return self.sess.run(fetches, feed_dict=feed_dict)
+
+    def close(self):
+        self.sess.close()
+
+
+def record_calibration_data(studies_dir, config_file, overrides, max_batches=16):
+    """
+    run the cascade on calibration studies and record the inputs each network receives,
+    e.g. tumor core networks get the crops around the whole tumor
+    inputs:
+        studies_dir: skull-stripped calibration studies, one folder per study
+        config_file: inference config file
+        overrides: [testing] overrides selecting a frozen graph or onnx networks
+        max_batches: maximal number of minibatches kept per network
+    outputs:
+        calibration_data: a CalibrationData
+    """
+    from src.models.msnet.inference import run_inference
+
+    calibration_data = CalibrationData(max_batches)
+    overrides = dict(overrides)
+    overrides["calibration_data"] = calibration_data
+    output_dir = tempfile.mkdtemp()
+    run_inference(studies_dir, output_dir, config_file, overrides=overrides)
+    shutil.rmtree(output_dir)
+    return calibration_data
@@ -9,6 +9,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import json
 import os
 import random
 
@@ -16,7 +17,7 @@ import numpy as np
 from scipy import ndimage
 
 from src.models.msnet.util.data_process import *
-from src.common.enums import NiftiExtensions
+from src.common.enums import BrainMaskArtifacts, NiftiExtensions
 
 
 class DataLoader:
@@ -47,6 +48,10 @@ class DataLoader:
         self.data_num = config.get("data_num", None)
         self.data_resize = config.get("data_resize", None)
         self.with_flip = config.get("with_flip", True)
+        self.brain_mask_name = config.get("brain_mask_name", BrainMaskArtifacts.MASK.value)
+        self.brain_bbox_name = config.get(
+            "brain_bbox_name", BrainMaskArtifacts.BOUNDING_BOX.value
+        )
 
         if self.label_convert_source and self.label_convert_target:
             assert len(self.label_convert_source) == len(self.label_convert_target)
@@ -104,6 +109,28 @@ class DataLoader:
 
         return volume, volume_name
 
+    def __load_brain_mask(self, patient_name):
+        """
+        load the brain mask and its bounding box saved by skull stripping, if they exist
+        outputs:
+            mask: boolean array with shape [Depth, Height, Width], or None
+            bbox: [bbmin, bbmax] without margin in the same axis order, or None
+        """
+        patient_dir = os.path.join(self.data_root[0], patient_name)
+        mask_name = os.path.join(patient_dir, self.brain_mask_name)
+        if not os.path.isfile(mask_name):
+            return None, None
+        mask = load_3d_volume_as_array(mask_name) > 0
+        bbox_name = os.path.join(patient_dir, self.brain_bbox_name)
+        if os.path.isfile(bbox_name):
+            with open(bbox_name) as f:
+                brain_bbox = json.load(f)
+            # stored in NIfTI voxel order, arrays are loaded as [z, y, x]
+            bbox = [brain_bbox["bbmin"][::-1], brain_bbox["bbmax"][::-1]]
+        else:
+            bbox = get_ND_bounding_box(mask, 0)
+        return mask, bbox
+
     def load_data(self):
         """
         load all the training/testing data
@@ -120,8 +147,9 @@ class DataLoader:
             self.data_num if (self.data_num is not None) else len(self.patient_names)
         )
         for i in range(data_num):
-            volume_list = []
+            image = None
             volume_name_list = []
+            brain_mask, brain_bbox = self.__load_brain_mask(self.patient_names[i])
             for mod_idx in range(len(self.modality_postfix)):
                 print(
                     "Loading patient {} and modality {}".format(
@@ -133,21 +161,45 @@ class DataLoader:
                 )
                 if mod_idx == 0:
                     margin = 5
-                    bbmin, bbmax = get_ND_bounding_box(volume, margin)
                     volume_size = volume.shape
-                volume = crop_ND_volume_with_bounding_box(volume, bbmin, bbmax)
+                    if brain_mask is not None:
+                        bbmin = [max(x - margin, 0) for x in brain_bbox[0]]
+                        bbmax = [
+                            min(x + margin, volume_size[dim] - 1)
+                            for dim, x in enumerate(brain_bbox[1])
+                        ]
+                    else:
+                        bbmin, bbmax = get_ND_bounding_box(volume, margin)
+                # the crop is only read, before it is cast into the study tensor
+                volume = get_ND_volume_roi_view(volume, bbmin, bbmax)
                 if self.data_resize:
                     volume = resize_3D_volume_to_given_shape(
                         volume, self.data_resize, 1
                     )
                 if mod_idx == 0:
-                    weight = np.asarray(volume > 0, np.float32)
+                    if brain_mask is not None:
+                        weight = crop_ND_volume_with_bounding_box(
+                            brain_mask, bbmin, bbmax
+                        )
+                        if self.data_resize:
+                            weight = resize_3D_volume_to_given_shape(
+                                weight, self.data_resize, 0
+                            )
+                        weight = np.asarray(weight, np.float32)
+                    else:
+                        weight = np.asarray(volume > 0, np.float32)
                 if self.intensity_normalize[mod_idx]:
                     volume = itensity_normalize_one_volume(volume)
-                volume_list.append(volume)
+                if image is None:
+                    # one contiguous channels-last tensor, so that a slab of all the modalities is
+                    # one slice, each modality is cast into it without an intermediate copy
+                    image = np.empty(
+                        volume.shape + (len(self.modality_postfix),), np.float32
+                    )
+                image[..., mod_idx] = volume
                 volume_name_list.append(volume_name)
             ImageNames.append(volume_name_list)
-            X.append(volume_list)
+            X.append(image)
             W.append(weight)
             bbox.append([bbmin, bbmax])
             in_size.append(volume_size)  #
@@ -219,7 +271,10 @@ class DataLoader:
             else:
                 flip = False
             self.patient_id = random.randint(0, len(self.data) - 1)
-            data_volumes = [x for x in self.data[self.patient_id]]
+            data_volumes = [
+                self.data[self.patient_id][..., c]
+                for c in range(self.data[self.patient_id].shape[-1])
+            ]
             weight_volumes = [self.weight[self.patient_id]]
             boundingbox = None
             if self.with_ground_truth:
@@ -338,6 +393,9 @@ class DataLoader:
     def get_image_data_with_name(self, i):
         """
         Used for testing, get one image data and patient name
+        outputs:
+            data: [Depth, Height, Width, modality] float32 tensor, weight, patient name,
+                  image names, bounding box and size of the original volume
         """
         return [
             self.data[i],
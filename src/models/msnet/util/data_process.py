@@ -106,17 +106,20 @@ def itensity_normalize_one_volume(volume):
 def get_ND_bounding_box(label, margin):
     """
     get the bounding box of the non-zero region of an ND volume
+    The extent along each axis is found from the projection of the volume on that axis,
+    without listing the indices of every non-zero voxel.
     """
     input_shape = label.shape
     if type(margin) is int:
         margin = [margin] * len(input_shape)
     assert len(input_shape) == len(margin)
-    indxes = np.nonzero(label)
     idx_min = []
     idx_max = []
     for i in range(len(input_shape)):
-        idx_min.append(indxes[i].min())
-        idx_max.append(indxes[i].max())
+        other_axes = tuple(j for j in range(len(input_shape)) if j != i)
+        indxes = np.flatnonzero(np.any(label, axis=other_axes))
+        idx_min.append(indxes.min())
+        idx_max.append(indxes.max())
 
     for i in range(len(input_shape)):
         idx_min[i] = max(idx_min[i] - margin[i], 0)
@@ -127,42 +130,19 @@ def get_ND_bounding_box(label, margin):
 def crop_ND_volume_with_bounding_box(volume, min_idx, max_idx):
     """
     crop/extract a subregion form an nd image.
+    The subregion is a copy, see get_ND_volume_roi_view to write to the subregion of volume.
+    """
+    output = get_ND_volume_roi_view(volume, min_idx, max_idx).copy()
+    return output
+
+
+def get_ND_volume_roi_view(volume, min_idx, max_idx):
+    """
+    get a subregion of an nd image without copying it, writing to the subregion writes to volume
     """
     dim = len(volume.shape)
     assert dim >= 2 and dim <= 5
-    if dim == 2:
-        output = volume[
-            np.ix_(range(min_idx[0], max_idx[0] + 1), range(min_idx[1], max_idx[1] + 1))
-        ]
-    elif dim == 3:
-        output = volume[
-            np.ix_(
-                range(min_idx[0], max_idx[0] + 1),
-                range(min_idx[1], max_idx[1] + 1),
-                range(min_idx[2], max_idx[2] + 1),
-            )
-        ]
-    elif dim == 4:
-        output = volume[
-            np.ix_(
-                range(min_idx[0], max_idx[0] + 1),
-                range(min_idx[1], max_idx[1] + 1),
-                range(min_idx[2], max_idx[2] + 1),
-                range(min_idx[3], max_idx[3] + 1),
-            )
-        ]
-    elif dim == 5:
-        output = volume[
-            np.ix_(
-                range(min_idx[0], max_idx[0] + 1),
-                range(min_idx[1], max_idx[1] + 1),
-                range(min_idx[2], max_idx[2] + 1),
-                range(min_idx[3], max_idx[3] + 1),
-                range(min_idx[4], max_idx[4] + 1),
-            )
-        ]
-    else:
-        raise ValueError("the dimension number shoud be 2 to 5")
+    output = volume[tuple(slice(min_idx[i], max_idx[i] + 1) for i in range(dim))]
     return output
 
 
@@ -171,30 +151,10 @@ def set_ND_volume_roi_with_bounding_box_range(volume, bb_min, bb_max, sub_volume
     set a subregion to an nd image.
     """
     dim = len(bb_min)
-    out = volume
-    if dim == 2:
-        out[
-            np.ix_(range(bb_min[0], bb_max[0] + 1), range(bb_min[1], bb_max[1] + 1))
-        ] = sub_volume
-    elif dim == 3:
-        out[
-            np.ix_(
-                range(bb_min[0], bb_max[0] + 1),
-                range(bb_min[1], bb_max[1] + 1),
-                range(bb_min[2], bb_max[2] + 1),
-            )
-        ] = sub_volume  # 改动2   #+ 1
-    elif dim == 4:
-        out[
-            np.ix_(
-                range(bb_min[0], bb_max[0] + 1),
-                range(bb_min[1], bb_max[1] + 1),
-                range(bb_min[2], bb_max[2] + 1),
-                range(bb_min[3], bb_max[3] + 1),
-            )
-        ] = sub_volume
-    else:
+    if dim not in [2, 3, 4]:
         raise ValueError("array dimension should be 2, 3 or 4")
+    out = volume
+    out[tuple(slice(bb_min[i], bb_max[i] + 1) for i in range(dim))] = sub_volume
     return out
 
 
@@ -282,6 +242,38 @@ def transpose_volumes(volumes, slice_direction):
     return tr_volumes
 
 
+def transpose_image_tensor(tensor, slice_direction):
+    """
+    transpose a channels-last image tensor to a slice direction
+    inputs:
+        tensor: a [Depth, Height, Width, channel] array
+        slice_direction: 'axial', 'sagittal', or 'coronal'
+    outputs:
+        tr_tensor: the transposed tensor, copied to contiguous memory
+    """
+    axes = {"axial": (0, 1, 2), "sagittal": (2, 0, 1), "coronal": (1, 0, 2)}
+    tr_tensor = np.transpose(tensor, axes[slice_direction] + (3,))
+    return np.ascontiguousarray(tr_tensor)
+
+
+def downsample_volume(volume, factor):
+    """
+    downsample the first three axes of a 3D/4D volume by averaging blocks of factor^3 voxels
+    inputs:
+        volume: [Depth, Height, Width] or [Depth, Height, Width, channel] array
+        factor: integer downsampling factor
+    outputs:
+        out: the downsampled volume, trailing voxels that do not fill a block are dropped
+    """
+    shape = [int(x / factor) for x in volume.shape[:3]]
+    volume = volume[: shape[0] * factor, : shape[1] * factor, : shape[2] * factor]
+    blocks = volume.reshape(
+        [shape[0], factor, shape[1], factor, shape[2], factor] + list(volume.shape[3:])
+    )
+    out = blocks.mean(axis=(1, 3, 5))
+    return out
+
+
 def resize_ND_volume_to_given_shape(volume, out_shape, order=3):
     """
     resize an nd volume to a given shape
@@ -299,6 +291,32 @@ def resize_ND_volume_to_given_shape(volume, out_shape, order=3):
     return out_volume
 
 
+def get_roi_slices(center, roi_shape, volume_shape):
+    """
+    get the slices of an roi centered in a volume, clipped to the volume
+    inputs:
+        center: the center of the roi in the volume
+        roi_shape: the size of the roi
+        volume_shape: the size of the volume
+    outputs:
+        roi_slices: the part of the roi inside the volume, in roi coordinates
+        volume_slices: the same part in volume coordinates
+    """
+    r0max = [int(x / 2) for x in roi_shape]
+    r1max = [roi_shape[i] - r0max[i] for i in range(len(r0max))]
+    r0 = [min(r0max[i], center[i]) for i in range(len(r0max))]
+    r1 = [min(r1max[i], volume_shape[i] - center[i]) for i in range(len(r0max))]
+    # an roi outside of the volume gives empty slices
+    r1 = [max(r1[i], -r0[i]) for i in range(len(r0max))]
+    roi_slices = tuple(
+        slice(r0max[i] - r0[i], r0max[i] + r1[i]) for i in range(len(r0max))
+    )
+    volume_slices = tuple(
+        slice(center[i] - r0[i], center[i] + r1[i]) for i in range(len(r0max))
+    )
+    return roi_slices, volume_slices
+
+
 def extract_roi_from_volume(volume, in_center, output_shape, fill="random"):
     """
     extract a roi from a 3d volume
@@ -310,30 +328,18 @@ def extract_roi_from_volume(volume, in_center, output_shape, fill="random"):
     outputs:
         output: the roi volume
     """
-    input_shape = volume.shape
-    if fill == "random":
+    out_slices, in_slices = get_roi_slices(in_center, output_shape, volume.shape)
+    inside = all(
+        out_slices[i].stop - out_slices[i].start == output_shape[i]
+        for i in range(len(output_shape))
+    )
+    if inside:
+        output = np.empty(output_shape)
+    elif fill == "random":
         output = np.random.normal(0, 1, size=output_shape)
     else:
         output = np.zeros(output_shape)
-    r0max = [int(x / 2) for x in output_shape]
-    r1max = [output_shape[i] - r0max[i] for i in range(len(r0max))]
-    r0 = [min(r0max[i], in_center[i]) for i in range(len(r0max))]
-    r1 = [min(r1max[i], input_shape[i] - in_center[i]) for i in range(len(r0max))]
-    out_center = r0max
-
-    output[
-        np.ix_(
-            range(out_center[0] - r0[0], out_center[0] + r1[0]),
-            range(out_center[1] - r0[1], out_center[1] + r1[1]),
-            range(out_center[2] - r0[2], out_center[2] + r1[2]),
-        )
-    ] = volume[
-        np.ix_(
-            range(in_center[0] - r0[0], in_center[0] + r1[0]),
-            range(in_center[1] - r0[1], in_center[1] + r1[1]),
-            range(in_center[2] - r0[2], in_center[2] + r1[2]),
-        )
-    ]
+    output[out_slices] = volume[in_slices]
     return output
 
 
@@ -348,52 +354,78 @@ def set_roi_to_volume(volume, center, sub_volume):
         output_volume: the output 3D/4D volume
     """
     volume_shape = volume.shape
-    patch_shape = sub_volume.shape
     output_volume = volume
     for i in range(len(center)):
         if center[i] >= volume_shape[i]:
             return output_volume
-    r0max = [int(x / 2) for x in patch_shape]
-    r1max = [patch_shape[i] - r0max[i] for i in range(len(r0max))]
-    r0 = [min(r0max[i], center[i]) for i in range(len(r0max))]
-    r1 = [min(r1max[i], volume_shape[i] - center[i]) for i in range(len(r0max))]
-    patch_center = r0max
-
-    if len(center) == 3:
-        output_volume[
-            np.ix_(
-                range(center[0] - r0[0], center[0] + r1[0]),
-                range(center[1] - r0[1], center[1] + r1[1]),
-                range(center[2] - r0[2], center[2] + r1[2]),
-            )
-        ] = sub_volume[
-            np.ix_(
-                range(patch_center[0] - r0[0], patch_center[0] + r1[0]),
-                range(patch_center[1] - r0[1], patch_center[1] + r1[1]),
-                range(patch_center[2] - r0[2], patch_center[2] + r1[2]),
-            )
-        ]
-    elif len(center) == 4:
-        output_volume[
-            np.ix_(
-                range(center[0] - r0[0], center[0] + r1[0]),
-                range(center[1] - r0[1], center[1] + r1[1]),
-                range(center[2] - r0[2], center[2] + r1[2]),
-                range(center[3] - r0[3], center[3] + r1[3]),
-            )
-        ] = sub_volume[
-            np.ix_(
-                range(patch_center[0] - r0[0], patch_center[0] + r1[0]),
-                range(patch_center[1] - r0[1], patch_center[1] + r1[1]),
-                range(patch_center[2] - r0[2], patch_center[2] + r1[2]),
-                range(patch_center[3] - r0[3], patch_center[3] + r1[3]),
-            )
-        ]
-    else:
+    if len(center) not in [3, 4]:
         raise ValueError("array dimension should be 3 or 4")
+    patch_slices, volume_slices = get_roi_slices(center, sub_volume.shape, volume_shape)
+    output_volume[volume_slices] = sub_volume[patch_slices]
     return output_volume
 
 
+def get_component_sizes(img, labeled_array, numpatches, weights=None):
+    """
+    sum of img (or of weights) over each component of a labeled volume, in one pass
+    outputs:
+        sizes: array of numpatches + 1 sums, sizes[0] is the background
+    """
+    if weights is None:
+        weights = img
+    sizes = np.bincount(
+        labeled_array.ravel(),
+        weights=np.asarray(weights, np.float64).ravel(),
+        minlength=numpatches + 1,
+    )
+    return sizes
+
+
+def keep_components(labeled_array, keep):
+    """
+    mask of the components selected by a lookup table
+    inputs:
+        labeled_array: the output of ndimage.label
+        keep: boolean lookup table indexed by component label
+    outputs:
+        out_img: boolean volume of the kept components
+    """
+    keep = np.array(keep, bool)
+    keep[0] = False
+    return keep[labeled_array]
+
+
+def binary_closing_in_bounding_box(img, structure, padding=None):
+    """
+    binary closing of a volume computed in the bounding box of its non-zero region.
+    The box is padded by the reach of the dilation and of the erosion, so the result is the
+    same as that of ndimage.binary_closing on the whole volume.
+    inputs:
+        img: the input nd volume
+        structure: structuring element of the closing
+        padding: if img is an roi of a larger volume, the number of voxels of that volume
+                 before and after the roi along each axis, in the format of np.pad.
+                 These are taken as 0, so that the result is the roi of the closing of
+                 the larger volume. 2 voxels are enough for a 3x3x3 structure.
+    """
+    out_img = np.zeros(img.shape, bool)
+    if not np.any(img):
+        return out_img
+    if padding is not None:
+        sub_img = binary_closing_in_bounding_box(
+            np.pad(np.asarray(img, bool), padding, mode="constant"), structure
+        )
+        roi = tuple(
+            slice(padding[i][0], padding[i][0] + img.shape[i]) for i in range(img.ndim)
+        )
+        return sub_img[roi]
+    margin = [2 * int(x / 2) for x in structure.shape]
+    bbmin, bbmax = get_ND_bounding_box(img, margin)
+    sub_img = get_ND_volume_roi_view(img, bbmin, bbmax)
+    sub_img = ndimage.binary_closing(sub_img, structure=structure)
+    return set_ND_volume_roi_with_bounding_box_range(out_img, bbmin, bbmax, sub_img)
+
+
 def get_largest_two_component(img, print_info=False, threshold=None):
     """
     Get the largest two components of a binary volume
@@ -403,35 +435,32 @@ def get_largest_two_component(img, print_info=False, threshold=None):
     outputs:
         out_img: the output volume
     """
+    if not np.any(img):
+        return np.zeros_like(img)
+    # components are labeled in the bounding box of the volume only
+    bbmin, bbmax = get_ND_bounding_box(img, 0)
+    sub_img = get_ND_volume_roi_view(img, bbmin, bbmax)
     s = ndimage.generate_binary_structure(3, 2)  # iterate structure
-    labeled_array, numpatches = ndimage.label(img, s)  # labeling
-    sizes = ndimage.sum(img, labeled_array, range(1, numpatches + 1))
-    sizes_list = [sizes[i] for i in range(len(sizes))]
-    sizes_list.sort()
+    labeled_array, numpatches = ndimage.label(sub_img, s)  # labeling
+    if numpatches == 1:
+        return img
+    sizes = get_component_sizes(sub_img, labeled_array, numpatches)
+    sizes[0] = 0
     if print_info:
-        print("component size", sizes_list)
-    if len(sizes) == 1:
-        out_img = img
+        print("component size", sorted(sizes[1:]))
+    if threshold:
+        keep = sizes > threshold
     else:
-        if threshold:
-            out_img = np.zeros_like(img)
-            for temp_size in sizes_list:
-                if temp_size > threshold:
-                    temp_lab = np.where(sizes == temp_size)[0] + 1
-                    temp_cmp = labeled_array == temp_lab
-                    out_img = (out_img + temp_cmp) > 0
-            return out_img
-        else:
-            max_size1 = sizes_list[-1]
-            max_size2 = sizes_list[-2]
-            max_label1 = np.where(sizes == max_size1)[0] + 1
-            max_label2 = np.where(sizes == max_size2)[0] + 1
-            component1 = labeled_array == max_label1
-            component2 = labeled_array == max_label2
-            if max_size2 * 10 > max_size1:
-                component1 = (component1 + component2) > 0
-            out_img = component1
-    return out_img
+        # labels of the largest and second largest components
+        order = np.argsort(-sizes, kind="stable")
+        keep = np.zeros(numpatches + 1, bool)
+        keep[order[0]] = True
+        if sizes[order[1]] * 10 > sizes[order[0]]:
+            keep[order[1]] = True
+    out_img = np.zeros(img.shape, bool)
+    return set_ND_volume_roi_with_bounding_box_range(
+        out_img, bbmin, bbmax, keep_components(labeled_array, keep)
+    )
 
 
 def fill_holes(img):
@@ -441,12 +470,9 @@ def fill_holes(img):
     neg = 1 - img
     s = ndimage.generate_binary_structure(3, 1)  # iterate structure
     labeled_array, numpatches = ndimage.label(neg, s)  # labeling
-    sizes = ndimage.sum(neg, labeled_array, range(1, numpatches + 1))
-    sizes_list = [sizes[i] for i in range(len(sizes))]
-    sizes_list.sort()
-    max_size = sizes_list[-1]
-    max_label = np.where(sizes == max_size)[0] + 1
-    component = labeled_array == max_label
+    sizes = get_component_sizes(neg, labeled_array, numpatches)
+    sizes[0] = 0
+    component = labeled_array == np.argmax(sizes)
     return 1 - component
 
 
@@ -458,16 +484,12 @@ def remove_external_core(lab_main, lab_ext):
     # for each component of lab_ext, compute the overlap with lab_main
     s = ndimage.generate_binary_structure(3, 2)  # iterate structure
     labeled_array, numpatches = ndimage.label(lab_ext, s)  # labeling
-    sizes = ndimage.sum(lab_ext, labeled_array, range(1, numpatches + 1))
-    sizes_list = [sizes[i] for i in range(len(sizes))]
-    new_lab_ext = np.zeros_like(lab_ext)
-    for i in range(len(sizes)):
-        sizei = sizes_list[i]
-        labeli = np.where(sizes == sizei)[0] + 1
-        componenti = labeled_array == labeli
-        overlap = componenti * lab_main
-        if (overlap.sum() + 0.0) / sizei >= 0.5:
-            new_lab_ext = np.maximum(new_lab_ext, componenti)
+    sizes = get_component_sizes(lab_ext, labeled_array, numpatches)
+    overlaps = get_component_sizes(
+        lab_ext, labeled_array, numpatches, np.asarray(lab_ext, np.float64) * lab_main
+    )
+    keep = overlaps >= 0.5 * sizes
+    new_lab_ext = np.asarray(keep_components(labeled_array, keep), lab_ext.dtype)
     return new_lab_ext
 
 
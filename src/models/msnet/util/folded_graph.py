@@ -0,0 +1,237 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+# epsilon of niftynet BNLayer
+BN_EPSILON = 1e-5
+# convolutions of a ResBlock and the batch normalization that precedes each of them
+RESBLOCK_LAYERS = [("bn_0", "acti_0", "conv_0"), ("bn_1", "acti_1", "conv_1")]
+# niftynet ConvolutionalLayer and DeconvolutionalLayer append the batch normalization and the
+# activation to their name, e.g. the variables of fuse1 are in fuse1_bn_prelu/conv_, /bn_ and /acti_
+LAYER_SUFFIX = "_bn_prelu"
+# layers created without a name in the original networks, found under the niftynet default name
+UNNAMED_LAYERS = {"downsample2": "conv" + LAYER_SUFFIX}
+
+
+def load_checkpoint_weights(model_file, net_name):
+    """
+    read the variables of one MSNet from its checkpoint
+    outputs:
+        weights: a dictionary mapping variable names without the network prefix, e.g.
+                 block1_1/conv_0/w, to numpy arrays
+    """
+    reader = tf.compat.v1.train.NewCheckpointReader(model_file)
+    prefix = net_name + "/"
+    weights = {}
+    for name in reader.get_variable_to_shape_map():
+        if name.startswith(prefix):
+            weights[name[len(prefix) :]] = reader.get_tensor(name)
+    return weights
+
+
+def get_moving_statistics(weights):
+    """
+    batch normalization statistics stored in the checkpoint (moving_mean and moving_variance)
+    outputs:
+        statistics: a dictionary mapping each batch normalization layer, e.g. block1_1/bn_0, to (mean, variance)
+    """
+    statistics = {}
+    for name in weights:
+        if name.endswith("/moving_mean"):
+            layer = name[: -len("/moving_mean")]
+            statistics[layer] = (weights[name], weights[layer + "/moving_variance"])
+    return statistics
+
+
+class InferenceMSNet(object):
+    """
+    MSNet forward pass built from checkpoint weights with tensorflow ops only, without niftynet.
+    Without statistics, every batch normalization uses the moments of the minibatch as in the
+    original network run with is_training=True, and the moments are exposed in self.moments for calibration.
+    With statistics, each batch normalization is folded into the weights and bias of the convolution
+    before it, or into a per-channel scale and shift when it follows a residual sum.
+    """
+
+    def __init__(self, weights, params, statistics=None):
+        self.weights = weights
+        self.statistics = statistics
+        self.base_chns = params.get("base_feature_number", [32, 32, 32, 32])
+        self.downsample_twice = params["downsample_twice"]
+        assert params.get("acti_func", "prelu") == "prelu", "only prelu is supported"
+        self.moments = {}
+
+    def bn_scale_shift(self, name):
+        """
+        per-channel scale and shift equivalent to a batch normalization with fixed statistics
+        """
+        mean, variance = self.statistics[name]
+        scale = self.weights[name + "/gamma"] / np.sqrt(variance + BN_EPSILON)
+        shift = self.weights[name + "/beta"] - mean * scale
+        return scale.astype(np.float32), shift.astype(np.float32)
+
+    def batch_norm(self, x, name):
+        if self.statistics is not None:
+            scale, shift = self.bn_scale_shift(name)
+            return x * scale + shift
+        mean, variance = tf.nn.moments(x, axes=[0, 1, 2, 3])
+        self.moments[name] = (mean, variance)
+        return tf.nn.batch_normalization(
+            x, mean, variance, self.weights[name + "/beta"], self.weights[name + "/gamma"], BN_EPSILON
+        )
+
+    def prelu(self, x, name):
+        alpha = self.weights[name + "/alpha"]
+        return tf.nn.relu(x) + alpha * (x - tf.abs(x)) * 0.5
+
+    def conv(self, x, w, stride=(1, 1, 1), dilation=(1, 1, 1), padding="SAME"):
+        return tf.nn.convolution(
+            x, w, padding=padding, strides=list(stride), dilation_rate=list(dilation)
+        )
+
+    def deconv(self, x, w):
+        shape = tf.shape(x)
+        output_shape = tf.stack([shape[0], shape[1], shape[2] * 2, shape[3] * 2, w.shape[-2]])
+        return tf.nn.conv3d_transpose(
+            x, w, output_shape, strides=[1, 1, 2, 2, 1], padding="SAME"
+        )
+
+    def get_layer_scope(self, name):
+        """
+        variable scope of a niftynet ConvolutionalLayer or DeconvolutionalLayer in the checkpoint
+        """
+        scope = name + LAYER_SUFFIX
+        if scope + "/bn_/gamma" not in self.weights and name in UNNAMED_LAYERS:
+            scope = UNNAMED_LAYERS[name]
+        assert scope + "/bn_/gamma" in self.weights, "layer {} not found in the checkpoint".format(name)
+        return scope
+
+    def conv_bn_acti(self, x, name, stride=(1, 1, 1), padding="SAME", deconv=False):
+        """
+        niftynet ConvolutionalLayer or DeconvolutionalLayer with batch normalization and prelu
+        """
+        name = self.get_layer_scope(name)
+        if deconv:
+            w = self.weights[name + "/deconv_/w"]
+        else:
+            w = self.weights[name + "/conv_/w"]
+        if self.statistics is not None:
+            # deconvolution kernels are [..., out, in], convolution kernels [..., in, out]
+            scale, shift = self.bn_scale_shift(name + "/bn_")
+            if deconv:
+                w = w * scale[:, np.newaxis]
+            else:
+                w = w * scale
+            x = self.deconv(x, w) if deconv else self.conv(x, w, stride, padding=padding)
+            x = x + shift
+        else:
+            x = self.deconv(x, w) if deconv else self.conv(x, w, stride, padding=padding)
+            x = self.batch_norm(x, name + "/bn_")
+        return self.prelu(x, name + "/acti_")
+
+    def res_block(self, x, name, dilation):
+        """
+        bn -> prelu -> conv twice, with a residual connection.
+        With statistics, bn_1 is folded into conv_0 and bn_0 becomes a scale and shift.
+        """
+        y = x
+        if self.statistics is not None:
+            y = self.batch_norm(y, name + "/bn_0")
+            y = self.prelu(y, name + "/acti_0")
+            scale, shift = self.bn_scale_shift(name + "/bn_1")
+            y = self.conv(y, self.weights[name + "/conv_0/w"] * scale, dilation=dilation) + shift
+            y = self.prelu(y, name + "/acti_1")
+            y = self.conv(y, self.weights[name + "/conv_1/w"], dilation=dilation)
+        else:
+            for bn_name, acti_name, conv_name in RESBLOCK_LAYERS:
+                y = self.batch_norm(y, name + "/" + bn_name)
+                y = self.prelu(y, name + "/" + acti_name)
+                y = self.conv(y, self.weights[name + "/" + conv_name + "/w"], dilation=dilation)
+        return y + x
+
+    def __call__(self, images):
+        f1 = images
+        f1 = self.res_block(f1, "block1_1", [1, 1, 1])
+        f1 = self.res_block(f1, "block1_2", [1, 1, 1])
+        f1 = self.conv_bn_acti(f1, "fuse1", padding="VALID")
+        if self.downsample_twice:
+            f1 = self.conv_bn_acti(f1, "downsample1", stride=[1, 2, 2])
+        if self.base_chns[0] != self.base_chns[1]:
+            f1 = self.conv_bn_acti(f1, "feature_expand1")
+        f1 = self.res_block(f1, "block2_1", [1, 1, 1])
+        f1 = self.res_block(f1, "block2_2", [1, 1, 1])
+        f1 = self.conv_bn_acti(f1, "fuse2", padding="VALID")
+
+        f2 = self.conv_bn_acti(f1, "downsample2", stride=[1, 2, 2])
+        if self.base_chns[1] != self.base_chns[2]:
+            f2 = self.conv_bn_acti(f2, "feature_expand2")
+        f2 = self.res_block(f2, "block3_1", [1, 1, 1])
+        f2 = self.res_block(f2, "block3_2", [1, 2, 2])
+        f2 = self.res_block(f2, "block3_3", [1, 3, 3])
+        f2 = self.conv_bn_acti(f2, "fuse3", padding="VALID")
+
+        f3 = f2
+        if self.base_chns[2] != self.base_chns[3]:
+            f3 = self.conv_bn_acti(f3, "feature_expand3")
+        f3 = self.res_block(f3, "block4_1", [1, 3, 3])
+        f3 = self.res_block(f3, "block4_2", [1, 2, 2])
+        f3 = self.res_block(f3, "block4_3", [1, 1, 1])
+        f3 = self.conv_bn_acti(f3, "fuse4", padding="VALID")
+
+        p1 = f1[:, 2:-2]
+        if self.downsample_twice:
+            p1 = self.conv_bn_acti(p1, "pred_up1", deconv=True)
+        else:
+            p1 = self.conv(p1, self.weights["pred1/w"])
+
+        p2 = f2[:, 1:-1]
+        p2 = self.conv_bn_acti(p2, "pred_up2_1", deconv=True)
+        if self.downsample_twice:
+            p2 = self.conv_bn_acti(p2, "pred_up2_2", deconv=True)
+
+        p3 = self.conv_bn_acti(f3, "pred_up3_1", deconv=True)
+        if self.downsample_twice:
+            p3 = self.conv_bn_acti(p3, "pred_up3_2", deconv=True)
+
+        cat = tf.concat([p1, p2, p3], axis=4)
+        return self.conv(cat, self.weights["final_pred/w"])
+
+
+def calibrate_statistics(weights, params, batches):
+    """
+    estimate the statistics of each batch normalization as the average of the minibatch moments
+    of the original network over calibration minibatches
+    inputs:
+        weights: checkpoint weights from load_checkpoint_weights
+        params: config section of the network
+        batches: calibration minibatches with shape [N, D, H, W, C]
+    outputs:
+        statistics: a dictionary mapping each batch normalization layer to (mean, variance)
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.compat.v1.placeholder(tf.float32, [None, batches[0].shape[1], None, None, batches[0].shape[-1]])
+        net = InferenceMSNet(weights, params)
+        net(x)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            sums = None
+            for data in batches:
+                moments = sess.run(net.moments, feed_dict={x: data})
+                if sums is None:
+                    sums = moments
+                else:
+                    for name in sums:
+                        sums[name] = (sums[name][0] + moments[name][0], sums[name][1] + moments[name][1])
+    return dict(
+        (name, (mean / len(batches), variance / len(batches)))
+        for name, (mean, variance) in sums.items()
+    )
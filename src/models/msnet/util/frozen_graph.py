@@ -0,0 +1,53 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import tensorflow as tf
+
+INPUT_SUFFIX = "_input"
+OUTPUT_SUFFIX = "_prob"
+
+
+class FrozenNet(object):
+    """
+    a network of a frozen cascade graph.
+    The input accepts any batch size, height and width, so the same tensors are used for every
+    adaptive shape and no graph needs to be built at test time.
+    """
+
+    dynamic_shape = True
+
+    def __init__(self, name, x, proby):
+        self.name = name
+        self.x = x
+        self.proby = proby
+
+
+def load_frozen_networks(graph_file, sections):
+    """
+    load the networks of a frozen cascade graph written by export_graph.py
+    inputs:
+        graph_file: the frozen GraphDef (.pb)
+        sections: config sections of the networks to load, e.g. network1ax
+    outputs:
+        networks: a dictionary mapping each section to (net, x, proby)
+    """
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.io.gfile.GFile(graph_file, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    tf.import_graph_def(graph_def, name="")
+
+    graph = tf.compat.v1.get_default_graph()
+    networks = {}
+    for section in sections:
+        x = graph.get_tensor_by_name(section + INPUT_SUFFIX + ":0")
+        proby = graph.get_tensor_by_name(section + OUTPUT_SUFFIX + ":0")
+        networks[section] = (FrozenNet(section, x, proby), x, proby)
+    return networks
@@ -0,0 +1,87 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+
+import onnxruntime as ort
+
+PRECISIONS = ["fp32", "int8"]
+
+
+class OnnxTensor(object):
+    """
+    input or output of an onnx network, used in place of a tensorflow tensor in feed_dict and fetches
+    """
+
+    def __init__(self, net, name):
+        self.net = net
+        self.name = name
+
+
+class OnnxNet(object):
+    """
+    a network exported by export_onnx.py, executed with onnxruntime on CPU.
+    The input accepts any batch size, height and width.
+    """
+
+    dynamic_shape = True
+
+    def __init__(self, name, model_file, intra_op_threads=0):
+        self.name = name
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(
+            model_file, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.x = OnnxTensor(self, self.session.get_inputs()[0].name)
+        self.proby = OnnxTensor(self, self.session.get_outputs()[0].name)
+
+
+class OnnxSession(object):
+    """
+    replacement of the tensorflow session for onnx networks.
+    run(proby, feed_dict={x: data}) has the same contract as tf.Session.run in the test functions
+    of train_test_func.py.
+    """
+
+    def run(self, fetches, feed_dict):
+        inputs = dict((x.name, value) for x, value in feed_dict.items())
+        return fetches.net.session.run([fetches.name], inputs)[0]
+
+    def close(self):
+        pass
+
+
+def get_onnx_file(onnx_dir, section, precision="fp32"):
+    assert precision in PRECISIONS, "unsupported precision: {}".format(precision)
+    if precision == "fp32":
+        return os.path.join(onnx_dir, section + ".onnx")
+    return os.path.join(onnx_dir, "{}_{}.onnx".format(section, precision))
+
+
+def load_onnx_networks(onnx_dir, sections, intra_op_threads=0, precision="fp32"):
+    """
+    load the onnx networks of the cascade
+    inputs:
+        onnx_dir: directory written by export_onnx.py, with one <section>.onnx file per network
+        sections: config sections of the networks to load, e.g. network1ax
+        intra_op_threads: number of threads used inside each operator, 0 lets onnxruntime decide
+        precision: fp32, or int8 for the networks written by quantize.py
+    outputs:
+        networks: a dictionary mapping each section to (net, x, proby)
+    """
+    networks = {}
+    for section in sections:
+        model_file = get_onnx_file(onnx_dir, section, precision)
+        net = OnnxNet(section, model_file, intra_op_threads)
+        networks[section] = (net, net.x, net.proby)
+    return networks
@@ -0,0 +1,188 @@
+# Implementation of Wang et al 2017: Automatic Brain Tumor Segmentation using Cascaded Anisotropic Convolutional Neural Networks. https://arxiv.org/abs/1709.00382
+# Author: Guotai Wang
+# Copyright (c) 2017-2018 University College London, United Kingdom. All rights reserved.
+# http://cmictig.cs.ucl.ac.uk
+#
+# Distributed under the BSD-3 licence. Please see the file licence.txt
+# This software is not certified for clinical use.
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import platform
+
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+XLA_MODES = ["none", "auto", "jit_scope"]
+# grappler passes that can be switched on or off in the [session] section
+OPTIMIZER_PASSES = [
+    "constant_folding",
+    "arithmetic_optimization",
+    "layout_optimizer",
+    "remapping",
+    "dependency_optimization",
+    "loop_optimization",
+]
+
+
+def get_thread_budget(config_session):
+    """
+    number of cores given to inference: thread_budget of the [session] section, otherwise the
+    PIPELINE_THREAD_BUDGET environment variable shared with the other pipeline steps, otherwise all cores
+    """
+    budget = config_session.get("thread_budget", 0)
+    if not budget:
+        budget = int(os.environ.get("PIPELINE_THREAD_BUDGET", 0))
+    if not budget and hasattr(os, "sched_getaffinity"):
+        budget = len(os.sched_getaffinity(0))
+    if not budget:
+        budget = os.cpu_count() or 1
+    return budget
+
+
+def get_thread_counts(config_session):
+    """
+    intra-op and inter-op thread counts, 0 means derived from the thread budget.
+    The cascade runs one network at a time, so most of the budget goes to intra-op threads.
+    With concurrent_views, the three views of a stage run at the same time: each needs an
+    inter-op thread, and they share the intra-op pool, which keeps the whole budget.
+    outputs:
+        intra_op_threads, inter_op_threads
+    """
+    budget = get_thread_budget(config_session)
+    if config_session.get("concurrent_views", False):
+        inter_op_threads = max(config_session.get("inter_op_threads", 0), 3)
+        intra_op_threads = config_session.get("intra_op_threads", 0) or budget
+        return intra_op_threads, inter_op_threads
+    inter_op_threads = config_session.get("inter_op_threads", 0) or 1
+    intra_op_threads = config_session.get("intra_op_threads", 0) or max(
+        1, budget // inter_op_threads
+    )
+    return intra_op_threads, inter_op_threads
+
+
+def set_session_environment(config_session):
+    """
+    set the environment variables read by CUDA, OpenMP and MKL/oneDNN.
+    This must be called before the first session is created.
+    """
+    intra_op_threads, _ = get_thread_counts(config_session)
+    cuda_devices = config_session.get("cuda_visible_devices", None)
+    if cuda_devices is not None:
+        os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(cuda_devices)
+    os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+    os.environ["MKL_NUM_THREADS"] = str(intra_op_threads)
+    # thread pinning of MKL/oneDNN builds, left to the defaults unless configured
+    if config_session.get("kmp_blocktime", None) is not None:
+        os.environ["KMP_BLOCKTIME"] = str(config_session["kmp_blocktime"])
+    if config_session.get("kmp_affinity", None):
+        os.environ["KMP_AFFINITY"] = config_session["kmp_affinity"]
+    # TF_DISABLE_MKL for MKL builds of tensorflow 1.x, TF_ENABLE_ONEDNN_OPTS for later versions
+    onednn = config_session.get("onednn", None)
+    if onednn is not None:
+        os.environ["TF_DISABLE_MKL"] = "0" if onednn else "1"
+        os.environ["TF_ENABLE_ONEDNN_OPTS"] = "1" if onednn else "0"
+
+
+def enable_cpu_auto_jit():
+    """
+    XLA auto-clustering is only enabled for GPUs unless asked for CPUs explicitly.
+    The flag is read once per process, before the first graph is optimized.
+    """
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    if "--tf_xla_cpu_global_jit" not in xla_flags:
+        os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+
+
+def get_session_config(config_session=None, xla="none"):
+    """
+    get the tensorflow session config
+    inputs:
+        config_session: the [session] section of the config, see inference_config.txt
+        xla: none, auto to let tensorflow cluster and compile the graph with XLA, or jit_scope
+             to compile each network forward pass explicitly (see build_network)
+    """
+    assert xla in XLA_MODES, "unsupported xla mode: {}".format(xla)
+    config_session = config_session or {}
+    intra_op_threads, inter_op_threads = get_thread_counts(config_session)
+    session_config = tf.compat.v1.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads,
+    )
+    if config_session.get("allow_growth", None) is not None:
+        session_config.gpu_options.allow_growth = config_session["allow_growth"]
+    if config_session.get("allocator_type", None):
+        session_config.gpu_options.allocator_type = config_session["allocator_type"]
+
+    rewrite_options = session_config.graph_options.rewrite_options
+    for optimizer_pass in OPTIMIZER_PASSES:
+        enabled = config_session.get(optimizer_pass, None)
+        if enabled is not None:
+            setattr(
+                rewrite_options,
+                optimizer_pass,
+                rewriter_config_pb2.RewriterConfig.ON
+                if enabled
+                else rewriter_config_pb2.RewriterConfig.OFF,
+            )
+
+    if xla == "auto":
+        enable_cpu_auto_jit()
+        session_config.graph_options.optimizer_options.global_jit_level = (
+            tf.compat.v1.OptimizerOptions.ON_1
+        )
+    return session_config
+
+
+def create_session(config_session=None, xla="none"):
+    """
+    create the interactive session used by inference with the [session] profile of the config
+    """
+    config_session = config_session or {}
+    set_session_environment(config_session)
+    intra_op_threads, inter_op_threads = get_thread_counts(config_session)
+    print(
+        "tensorflow session with {} intra-op and {} inter-op threads".format(
+            intra_op_threads, inter_op_threads
+        )
+    )
+    return tf.compat.v1.InteractiveSession(
+        config=get_session_config(config_session, xla)
+    )
+
+
+def get_host_key(config_session):
+    """
+    key of the host in tuning files: processor model and thread budget, so that tunings are shared
+    by identical nodes and containers with the same cores
+    """
+    processor = platform.processor() or platform.machine()
+    if os.path.isfile("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    processor = line.split(":", 1)[1].strip()
+                    break
+    return "{} x{}".format(processor, get_thread_budget(config_session))
+
+
+def load_tuning(tuning_file, config_session):
+    """
+    load the settings measured by autotune.py for this host
+    outputs:
+        tuning: {"session": {"intra_op_threads", "inter_op_threads"}, "networks": {section: {"batch_size"}}},
+                or None if there is no tuning for this host
+    """
+    if not tuning_file or not os.path.isfile(tuning_file):
+        return None
+    with open(tuning_file) as f:
+        tunings = json.load(f)
+    host_key = get_host_key(config_session)
+    if host_key not in tunings:
+        print("no tuning for {} in {}".format(host_key, tuning_file))
+        return None
+    return tunings[host_key]
@@ -9,12 +9,203 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import tensorflow as tf
 
 from src.models.msnet.util.data_process import *
 
 
+class SlabStatistics(object):
+    """
+    Count of the slabs of the current studies and of the forward passes skipped, by reason:
+    "brain" for slabs without brain voxels, "views" for sagittal and coronal slabs with brain
+    voxels but none left uncertain by the axial network (see test_one_image_three_nets_adaptive_shape).
+    run_inference passes a new one to the test functions for each study, or each queue of studies
+    with queue_depth. Views running in parallel threads add to it under its lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.skipped = {}
+
+    def add(self, total, skipped, reason="brain"):
+        with self.lock:
+            self.total = self.total + total
+            self.skipped[reason] = self.skipped.get(reason, 0) + skipped
+
+    def get_skipped(self, reason=None):
+        if reason is None:
+            return sum(self.skipped.values())
+        return self.skipped.get(reason, 0)
+
+
+class MinibatchPrefetcher(object):
+    """
+    Iterate over the items of a generator that is run by a background thread, so that the next
+    minibatch is assembled while the network runs on the current one (sess.run releases the GIL).
+    depth: number of items built ahead of the consumer, 0 runs the generator in the calling thread
+    """
+
+    _end = object()
+
+    def __init__(self, generator, depth=1):
+        self.generator = generator
+        self.depth = depth
+
+    def _produce(self, items, stop):
+        try:
+            for item in self.generator:
+                items.put((item, None))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            items.put((None, e))
+            return
+        items.put((self._end, None))
+
+    def __iter__(self):
+        if self.depth == 0:
+            for item in self.generator:
+                yield item
+            return
+        items = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(items, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is self._end:
+                    break
+                yield item
+        finally:
+            # unblock the producer if the consumer stopped early
+            stop.set()
+            while producer.is_alive():
+                try:
+                    items.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+class SlabScheduler(object):
+    """
+    Queue of the slabs of several studies, run together so that the minibatches of each network are
+    filled with slabs of all the studies instead of the few slabs of a small tumor core crop.
+    Slabs are queued by volume_probability_prediction with their provenance: fill writes the input of
+    the slab from its study, write adds its probability to the accumulator of its study and view.
+    Slabs are grouped by input placeholder and slab shape: frozen and onnx networks have one
+    placeholder for every adaptive shape.
+    """
+
+    def __init__(self, prefetch_depth=1):
+        self.prefetch_depth = prefetch_depth
+        self.queues = {}
+        self.callbacks = []
+
+    def add(self, x, proby, batch_size, slab_shape, fill, write, index):
+        """
+        queue one slab, fill(data_slab, index) and write(prob_slab, index) are called by run
+        """
+        key = (x, proby, tuple(slab_shape))
+        if key not in self.queues:
+            self.queues[key] = (batch_size, list(slab_shape), [])
+        self.queues[key][2].append((fill, write, index))
+
+    def add_callback(self, callback):
+        """
+        call callback once all the slabs are written, e.g. to average the views of a study
+        """
+        self.callbacks.append(callback)
+
+    def run(self, sess):
+        """
+        run the queued slabs in minibatches and empty the queue
+        outputs:
+            batches: number of minibatches run
+        """
+        batches = 0
+        for (x, proby, _), (batch_size, slab_shape, slabs) in self.queues.items():
+
+            def get_minibatches():
+                for start in range(0, len(slabs), batch_size):
+                    batch = slabs[start : start + batch_size]
+                    data_mini_batch = np.empty([len(batch)] + slab_shape, np.float32)
+                    for batch_idx, (fill, _, index) in enumerate(batch):
+                        fill(data_mini_batch[batch_idx], index)
+                    yield batch, data_mini_batch
+
+            for batch, data_mini_batch in MinibatchPrefetcher(get_minibatches(), self.prefetch_depth):
+                prob_mini_batch = sess.run(proby, feed_dict={x: data_mini_batch})
+                for batch_idx, (_, write, index) in enumerate(batch):
+                    write(prob_mini_batch[batch_idx], index)
+                batches = batches + 1
+        for callback in self.callbacks:
+            callback()
+        self.queues = {}
+        self.callbacks = []
+        return batches
+
+
+def get_roi_range(center, patch_size, volume_size):
+    """
+    Range of an roi along one axis, clipped to the volume as in set_roi_to_volume
+    outputs:
+        v0, v1: first and last (excluded) index of the roi in the volume
+        p0: index of v0 in the patch
+    """
+    r0max = int(patch_size / 2)
+    r0 = min(r0max, center)
+    r1 = min(patch_size - r0max, volume_size - center)
+    return center - r0, center + r1, r0max - r0
+
+
+def get_empty_slabs(weight, centers, label_slice, min_slab_voxels=0):
+    """
+    Find the slabs whose output slices hold at most min_slab_voxels brain voxels.
+    inputs:
+        weight: brain mask of the image, 0 outside the brain
+        centers: center slice of each slab along z-axis
+        label_slice: number of output slices of a slab
+    outputs:
+        empty: a list of booleans, one per slab
+    """
+    D = weight.shape[0]
+    slice_voxels = np.asarray(weight > 0, np.int64).reshape(D, -1).sum(axis=1)
+    empty = []
+    for center_slice in centers:
+        [z0, z1, _] = get_roi_range(center_slice, label_slice, D)
+        empty.append(slice_voxels[z0:z1].sum() <= min_slab_voxels)
+    return empty
+
+
+def get_skipped_slabs(empty, batch_size):
+    """
+    The networks use minibatch moments in batch normalization, so a minibatch is only skipped
+    when all its slabs are empty, the other minibatches keep all their slabs.
+    inputs:
+        empty: a list of booleans, one per slab
+    outputs:
+        skipped: a list of booleans, one per slab
+    """
+    skipped = []
+    for start in range(0, len(empty), batch_size):
+        batch_empty = empty[start : start + batch_size]
+        skipped += [all(batch_empty)] * len(batch_empty)
+    return skipped
+
+
 def volume_probability_prediction(
     temp_imgs,
     data_shape,
@@ -25,57 +216,113 @@ def volume_probability_prediction(
     sess,
     proby,
     x,
+    weight=None,
+    min_slab_voxels=0,
+    prob_volume=None,
+    prefetch_depth=1,
+    region=None,
+    lock=None,
+    scheduler=None,
+    statistics=None,
 ):
     """
     Test one image with sub regions along z-axis
+    The last minibatch holds the remaining sub regions only, x should have a dynamic batch dimension
+    Minibatches whose sub regions all have output slices with at most min_slab_voxels voxels of weight
+    are not run through the network, their foreground probability stays 0. The networks use minibatch
+    moments in batch normalization, so the other minibatches keep all their sub regions. The prediction
+    is multiplied by weight afterwards, so the default of 0 does not change the segmentation.
+    The foreground probability of each sub region is added to prob_volume as soon as its minibatch
+    is done. prob_volume can be a transposed view of the accumulator of another view, so that the
+    probability is written in the orientation of the accumulator directly.
+    Minibatches are assembled by a MinibatchPrefetcher, prefetch_depth of them ahead of sess.run.
+    region: voxels that need a prediction, sub regions with brain voxels but none of region count
+            as empty as well, under "views" in statistics
+    lock: held while writing to prob_volume, when other threads write to the same accumulator
+    scheduler: a SlabScheduler the sub regions are queued to instead of being run, prob_volume is
+            complete once the scheduler has run
+    statistics: a SlabStatistics counting the sub regions and the skipped forward passes
+    temp_imgs: [D, H, W, data_channel] tensor, each slab is one slice of it with all the channels
+    outputs:
+        prob_volume: foreground probability, a [D, H, W] float32 volume unless given
     """
-    [D, H, W] = temp_imgs[0].shape
+    assert class_num == 2, "the probability accumulator holds the foreground class only"
+    if lock is None:
+        lock = threading.Lock()
+    [D, H, W] = temp_imgs.shape[:3]
     input_center = [int(D / 2), int(H / 2), int(W / 2)]
-    temp_prob = np.zeros([D, H, W, class_num])
-    sub_image_baches = []
-    for center_slice in range(
-        int(label_shape[0] / 2), D + int(label_shape[0] / 2), label_shape[0]
-    ):
-        center_slice = min(center_slice, D - int(label_shape[0] / 2))
-        sub_image_bach = []
-        for chn in range(data_channel):
-            temp_input_center = [center_slice, input_center[1], input_center[2]]
-            sub_image = extract_roi_from_volume(
-                temp_imgs[chn], temp_input_center, data_shape
-            )
-            sub_image_bach.append(sub_image)
-        sub_image_bach = np.asanyarray(sub_image_bach, np.float32)
-        sub_image_baches.append(sub_image_bach)
-    total_batch = len(sub_image_baches)
-    max_mini_batch = int((total_batch + batch_size - 1) / batch_size)
-    sub_label_idx = 0
-    for mini_batch_idx in range(max_mini_batch):
-        data_mini_batch = sub_image_baches[
-            mini_batch_idx
-            * batch_size : min((mini_batch_idx + 1) * batch_size, total_batch)
-        ]
-        if mini_batch_idx == max_mini_batch - 1:
-            for idx in range(batch_size - (total_batch - mini_batch_idx * batch_size)):
-                data_mini_batch.append(
-                    np.random.normal(0, 1, size=[data_channel] + data_shape)
-                )
-        data_mini_batch = np.asarray(data_mini_batch, np.float32)
-        data_mini_batch = np.transpose(data_mini_batch, [0, 2, 3, 4, 1])
+    if prob_volume is None:
+        prob_volume = np.zeros([D, H, W], np.float32)
+    centers = [
+        min(center_slice, D - int(label_shape[0] / 2))
+        for center_slice in range(
+            int(label_shape[0] / 2), D + int(label_shape[0] / 2), label_shape[0]
+        )
+    ]
+    if weight is None:
+        no_brain = [False] * len(centers)
+    else:
+        no_brain = get_empty_slabs(weight, centers, label_shape[0], min_slab_voxels)
+    if region is None:
+        outside = [False] * len(centers)
+    else:
+        outside = get_empty_slabs(region, centers, label_shape[0])
+    empty = get_skipped_slabs([b or o for b, o in zip(no_brain, outside)], batch_size)
+    if statistics is not None:
+        statistics.add(len(centers), sum(e and b for e, b in zip(empty, no_brain)), "brain")
+        statistics.add(0, sum(e and not b for e, b in zip(empty, no_brain)), "views")
+
+    # output slices written by each sub region: the overlap of the last sub region with the
+    # previous one is taken from the last sub region, as set_roi_to_volume would overwrite it
+    z_ranges = [get_roi_range(c, label_shape[0], D) for c in centers]
+    for i in range(len(z_ranges) - 1):
+        [z0, z1, s0] = z_ranges[i]
+        z_ranges[i] = [z0, max(z0, min(z1, z_ranges[i + 1][0])), s0]
+    [h0, h1, sh0] = get_roi_range(input_center[1], label_shape[1], H)
+    [w0, w1, sw0] = get_roi_range(input_center[2], label_shape[2], W)
+
+    slabs = [i for i in range(len(centers)) if not empty[i]]
+
+    # the part of the image in each slab, the rest of the slab is filled with noise
+    [ih0, ih1, ph0] = get_roi_range(input_center[1], data_shape[1], H)
+    [iw0, iw1, pw0] = get_roi_range(input_center[2], data_shape[2], W)
+    ph1 = ph0 + ih1 - ih0
+    pw1 = pw0 + iw1 - iw0
+    pad_hw = [ph0, ph1, pw0, pw1] != [0, data_shape[1], 0, data_shape[2]]
+
+    def fill_slab(data_slab, i):
+        [iz0, iz1, pz0] = get_roi_range(centers[i], data_shape[0], D)
+        if pad_hw or iz1 - iz0 < data_shape[0]:
+            data_slab[...] = np.random.normal(0, 1, size=data_slab.shape)
+        data_slab[pz0 : pz0 + iz1 - iz0, ph0:ph1, pw0:pw1] = temp_imgs[iz0:iz1, ih0:ih1, iw0:iw1]
+
+    def write_slab(prob_slab, i):
+        [z0, z1, sz0] = z_ranges[i]
+        sub_prob = np.reshape(prob_slab, label_shape + [class_num])
+        with lock:
+            prob_volume[z0:z1, h0:h1, w0:w1] += sub_prob[
+                sz0 : sz0 + z1 - z0, sh0 : sh0 + h1 - h0, sw0 : sw0 + w1 - w0, 1
+            ]
+
+    if scheduler is not None:
+        for i in slabs:
+            scheduler.add(x, proby, batch_size, data_shape + [data_channel], fill_slab, write_slab, i)
+        return prob_volume
+
+    def get_minibatches():
+        for start in range(0, len(slabs), batch_size):
+            batch_shape = [min(batch_size, len(slabs) - start)] + data_shape + [data_channel]
+            data_mini_batch = np.empty(batch_shape, np.float32)
+            for batch_idx, i in enumerate(slabs[start : start + batch_size]):
+                fill_slab(data_mini_batch[batch_idx], i)
+            yield start, data_mini_batch
+
+    for start, data_mini_batch in MinibatchPrefetcher(get_minibatches(), prefetch_depth):
         prob_mini_batch = sess.run(proby, feed_dict={x: data_mini_batch})
 
         for batch_idx in range(prob_mini_batch.shape[0]):
-            center_slice = sub_label_idx * label_shape[0] + int(label_shape[0] / 2)
-            center_slice = min(center_slice, D - int(label_shape[0] / 2))
-            temp_input_center = [
-                center_slice,
-                input_center[1],
-                input_center[2],
-                int(class_num / 2),
-            ]
-            sub_prob = np.reshape(prob_mini_batch[batch_idx], label_shape + [class_num])
-            temp_prob = set_roi_to_volume(temp_prob, temp_input_center, sub_prob)
-            sub_label_idx = sub_label_idx + 1
-    return temp_prob
+            write_slab(prob_mini_batch[batch_idx], slabs[start + batch_idx])
+    return prob_volume
 
 
 def volume_probability_prediction_3d_roi(
@@ -91,8 +338,10 @@ def volume_probability_prediction_3d_roi(
 ):
     """
     Test one image with sub regions along x, y, z axis
+    The last minibatch holds the remaining sub regions only, x should have a dynamic batch dimension
+    temp_imgs: [D, H, W, data_channel] tensor, each sub region holds all the channels
     """
-    [D, H, W] = temp_imgs[0].shape
+    [D, H, W] = temp_imgs.shape[:3]
     temp_prob = np.zeros([D, H, W, class_num])
     sub_image_batches = []
     sub_image_centers = []
@@ -107,14 +356,12 @@ def volume_probability_prediction_3d_roi(
                 centerw = min(centerw, W - roiw_half)
                 temp_input_center = [centerd, centerh, centerw]
                 sub_image_centers.append(temp_input_center)
-                sub_image_batch = []
-                for chn in range(data_channel):
-                    sub_image = extract_roi_from_volume(
-                        temp_imgs[chn], temp_input_center, data_shape
-                    )
-                    sub_image_batch.append(sub_image)
-                sub_image_bach = np.asanyarray(sub_image_batch, np.float32)
-                sub_image_batches.append(sub_image_bach)
+                sub_image = extract_roi_from_volume(
+                    temp_imgs,
+                    temp_input_center + [int(data_channel / 2)],
+                    data_shape + [data_channel],
+                )
+                sub_image_batches.append(np.asarray(sub_image, np.float32))
 
     total_batch = len(sub_image_batches)
     max_mini_batch = int((total_batch + batch_size - 1) / batch_size)
@@ -124,19 +371,11 @@ def volume_probability_prediction_3d_roi(
             mini_batch_idx
             * batch_size : min((mini_batch_idx + 1) * batch_size, total_batch)
         ]
-        if mini_batch_idx == max_mini_batch - 1:
-            for idx in range(batch_size - (total_batch - mini_batch_idx * batch_size)):
-                data_mini_batch.append(
-                    np.random.normal(0, 1, size=[data_channel] + data_shape)
-                )
         data_mini_batch = np.asanyarray(data_mini_batch, np.float32)
-        data_mini_batch = np.transpose(data_mini_batch, [0, 2, 3, 4, 1])
         outprob_mini_batch = sess.run(proby, feed_dict={x: data_mini_batch})
 
-        for batch_idx in range(batch_size):
+        for batch_idx in range(outprob_mini_batch.shape[0]):
             glb_batch_idx = batch_idx + mini_batch_idx * batch_size
-            if glb_batch_idx >= total_batch:
-                continue
             temp_center = sub_image_centers[glb_batch_idx]
             temp_prob = set_roi_to_volume(
                 temp_prob, temp_center + [1], outprob_mini_batch[batch_idx]
@@ -145,23 +384,113 @@ def volume_probability_prediction_3d_roi(
     return temp_prob
 
 
+def network_forward(net, x):
+    """
+    build the probability output of a network.
+    Networks built with xla = jit_scope (see inference.py) are compiled with XLA, so that the
+    batch normalization, prelu and residual sums are fused with the convolutions.
+    """
+    if getattr(net, "jit_scope", False):
+        with tf.xla.experimental.jit_scope():
+            predicty = net(x, is_training=True)
+            proby = tf.nn.softmax(predicty)
+    else:
+        predicty = net(x, is_training=True)
+        proby = tf.nn.softmax(predicty)
+    return proby
+
+
+class DynamicShapeGraphCache(object):
+    """
+    Cache of the graphs built for adaptive tensor shapes.
+    Graphs are keyed by network and input shape, so that the same few shapes are reused across views and
+    images instead of growing the default graph on every call. The cache is emptied when the default graph changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.graph = None
+        self.graphs = {}
+
+    def get(self, net, full_data_shape):
+        """
+        get the input placeholder and probability output of a network for a given input shape
+        """
+        if getattr(net, "dynamic_shape", False):
+            # frozen networks accept any batch, height and width
+            return net.x, net.proby
+        # views running in parallel threads share the cache and the default graph
+        with self.lock:
+            graph = tf.compat.v1.get_default_graph()
+            if graph is not self.graph:
+                self.graph = graph
+                self.graphs = {}
+            key = (net, tuple(full_data_shape))
+            if key not in self.graphs:
+                x = tf.compat.v1.placeholder(tf.float32, full_data_shape)
+                proby = network_forward(net, x)
+                self.graphs[key] = (x, proby)
+            return self.graphs[key]
+
+
+dynamic_shape_graphs = DynamicShapeGraphCache()
+
+
+# sizes above the native size of a network are rounded up to a multiple of this step when no
+# shape buckets are given, which bounds the number of graphs built by dynamic_shape_graphs
+SHAPE_BUCKET_STEP = 16
+
+
+def get_adaptive_size(size, min_size, shape_buckets=None):
+    """
+    Get the tensor height or width used for an image size.
+    The size is rounded up to a multiple of 4 and to min_size, then to the smallest bucket that fits it.
+    Sizes up to min_size, the native size of the network, and sizes larger than every bucket are kept
+    as they are. shape_buckets None rounds sizes above min_size up to a multiple of SHAPE_BUCKET_STEP,
+    an empty list keeps them at a multiple of 4.
+    """
+    size = max(int((size + 3) / 4) * 4, min_size)
+    if size > min_size and shape_buckets is None:
+        return int((size + SHAPE_BUCKET_STEP - 1) / SHAPE_BUCKET_STEP) * SHAPE_BUCKET_STEP
+    if shape_buckets and size > min_size:
+        for bucket in sorted(shape_buckets):
+            if bucket >= size:
+                assert bucket % 4 == 0, "shape buckets should be multiples of 4"
+                return bucket
+    return size
+
+
 def volume_probability_prediction_dynamic_shape(
-    temp_imgs, data_shape, label_shape, data_channel, class_num, batch_size, sess, net
+    temp_imgs,
+    data_shape,
+    label_shape,
+    data_channel,
+    class_num,
+    batch_size,
+    sess,
+    net,
+    shape_buckets=None,
+    weight=None,
+    min_slab_voxels=0,
+    prob_volume=None,
+    region=None,
+    lock=None,
+    scheduler=None,
+    statistics=None,
 ):
     """
     Test one image with sub regions along z-axis
-    The height and width of input tensor is adapted to those of the input image
+    The height and width of input tensor is adapted to those of the input image,
+    rounded up to shape_buckets so that graphs can be reused from dynamic_shape_graphs
     """
-    # construct graph
-    [D, H, W] = temp_imgs[0].shape
-    Hx = max(int((H + 3) / 4) * 4, data_shape[1])
-    Wx = max(int((W + 3) / 4) * 4, data_shape[2])
+    # get graph
+    [D, H, W] = temp_imgs.shape[:3]
+    Hx = get_adaptive_size(H, data_shape[1], shape_buckets)
+    Wx = get_adaptive_size(W, data_shape[2], shape_buckets)
     data_slice = data_shape[0]
     label_slice = label_shape[0]
-    full_data_shape = [batch_size, data_slice, Hx, Wx, data_channel]
-    x = tf.compat.v1.placeholder(tf.float32, full_data_shape)
-    predicty = net(x, is_training=True)
-    proby = tf.nn.softmax(predicty)
+    full_data_shape = [None, data_slice, Hx, Wx, data_channel]
+    x, proby = dynamic_shape_graphs.get(net, full_data_shape)
 
     new_data_shape = [data_slice, Hx, Wx]
     new_label_shape = [label_slice, Hx, Wx]
@@ -175,6 +504,13 @@ def volume_probability_prediction_dynamic_shape(
         sess,
         proby,
         x,
+        weight,
+        min_slab_voxels,
+        prob_volume,
+        region=region,
+        lock=lock,
+        scheduler=scheduler,
+        statistics=statistics,
     )
     return temp_prob
 
@@ -191,6 +527,14 @@ def test_one_image_three_nets_adaptive_shape(
     outputs,
     inputs,
     shape_mode,
+    shape_buckets=None,
+    weight=None,
+    min_slab_voxels=0,
+    dtype=np.float32,
+    uncertain_range=None,
+    concurrent=False,
+    scheduler=None,
+    statistics=None,
 ):
     """
     Test one image with three anisotropic networks with fixed or adaptable tensor height and width.
@@ -198,93 +542,227 @@ def test_one_image_three_nets_adaptive_shape(
     shape_mode: 0: use fixed tensor shape in all direction
                 1: compare tensor shape and image shape and then select fixed or adaptive tensor shape
                 2: use adaptive tensor shape in all direction
+    shape_buckets: sizes adaptive tensor heights and widths are rounded up to, see get_adaptive_size
+    batch_size: one batch size for the three networks, or a list with the batch size of each network
+    temp_imgs: [D, H, W, data_channel] tensor, copied once to contiguous memory for the sagittal
+               and coronal views
+    weight: brain mask of the image, slabs with at most min_slab_voxels brain voxels are skipped,
+            see volume_probability_prediction
+    dtype: float32 or float16, type of the probability accumulator shared by the three views
+    uncertain_range: [low, high] to run the sagittal and coronal networks only on the slabs that hold
+            voxels with an axial probability in ]low, high[. The three views are averaged on those
+            voxels, the axial probability is kept elsewhere. None runs the three networks everywhere.
+    concurrent: run the views in parallel threads, sess.run releases the GIL. With uncertain_range,
+            the sagittal and coronal views run in parallel after the axial view.
+    scheduler: a SlabScheduler the slabs of the three views are queued to, prob holds the average
+            once the scheduler has run. It needs uncertain_range None, concurrent is not used.
+    statistics: a SlabStatistics shared by the three views, see volume_probability_prediction
+    outputs:
+        prob: average foreground probability of the three views, a [D, H, W] volume of dtype
     """
-    [ax_data_shape, sg_data_shape, cr_data_shape] = data_shapes
-    [ax_label_shape, sg_label_shape, cr_label_shape] = label_shapes
-    [D, H, W] = temp_imgs[0].shape
-    if shape_mode == 0 or (
-        shape_mode == 1 and (H <= ax_data_shape[1] and W <= ax_data_shape[2])
-    ):
-        prob = volume_probability_prediction(
-            temp_imgs,
-            ax_data_shape,
-            ax_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            outputs[0],
-            inputs[0],
-        )
-    else:
-        prob = volume_probability_prediction_dynamic_shape(
-            temp_imgs,
-            ax_data_shape,
-            ax_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            nets[0],
-        )
+    if not isinstance(batch_size, (list, tuple)):
+        batch_size = [batch_size] * 3
+    if weight is None:
+        weight = temp_imgs[..., 0] > 0
+    [D, H, W] = temp_imgs.shape[:3]
+    # the sagittal and coronal views write into transposed views of the axial accumulator
+    prob = np.zeros([D, H, W], dtype)
+    # serializes the writes of concurrent views to the accumulator
+    lock = threading.Lock()
+    slice_directions = ["axial", "sagittal", "coronal"]
 
-    tr_volumes1 = transpose_volumes(temp_imgs, "sagittal")
-    [sgD, sgH, sgW] = tr_volumes1[0].shape
-    if shape_mode == 0 or (
-        shape_mode == 1 and (sgH <= sg_data_shape[1] and sgW <= sg_data_shape[2])
-    ):
-        prob1 = volume_probability_prediction(
-            tr_volumes1,
-            sg_data_shape,
-            sg_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            outputs[1],
-            inputs[1],
-        )
+    def predict_view(view_idx, view_prob, region=None):
+        slice_direction = slice_directions[view_idx]
+        if slice_direction == "axial":
+            tr_volumes = temp_imgs
+        else:
+            tr_volumes = transpose_image_tensor(temp_imgs, slice_direction)
+        tr_weight = transpose_volumes([weight], slice_direction)[0]
+        tr_prob = transpose_volumes([view_prob], slice_direction)[0]
+        if region is not None:
+            region = transpose_volumes([region], slice_direction)[0]
+        data_shape = data_shapes[view_idx]
+        label_shape = label_shapes[view_idx]
+        [trD, trH, trW] = tr_volumes.shape[:3]
+        if shape_mode == 0 or (
+            shape_mode == 1 and (trH <= data_shape[1] and trW <= data_shape[2])
+        ):
+            volume_probability_prediction(
+                tr_volumes,
+                data_shape,
+                label_shape,
+                data_channel,
+                class_num,
+                batch_size[view_idx],
+                sess,
+                outputs[view_idx],
+                inputs[view_idx],
+                tr_weight,
+                min_slab_voxels,
+                tr_prob,
+                region=region,
+                lock=lock,
+                scheduler=scheduler,
+                statistics=statistics,
+            )
+        else:
+            volume_probability_prediction_dynamic_shape(
+                tr_volumes,
+                data_shape,
+                label_shape,
+                data_channel,
+                class_num,
+                batch_size[view_idx],
+                sess,
+                nets[view_idx],
+                shape_buckets,
+                tr_weight,
+                min_slab_voxels,
+                tr_prob,
+                region=region,
+                lock=lock,
+                scheduler=scheduler,
+                statistics=statistics,
+            )
+
+    if scheduler is not None:
+        assert uncertain_range is None, "the sagittal and coronal views need the axial probability"
+        concurrent = False
+    if uncertain_range is None:
+        view_prob = prob
+        uncertain = None
+        views = [0, 1, 2]
     else:
-        prob1 = volume_probability_prediction_dynamic_shape(
-            tr_volumes1,
-            sg_data_shape,
-            sg_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            nets[1],
-        )
-    prob1 = np.transpose(prob1, [1, 2, 0, 3])
-
-    tr_volumes2 = transpose_volumes(temp_imgs, "coronal")
-    [trD, trH, trW] = tr_volumes2[0].shape
-    if shape_mode == 0 or (
-        shape_mode == 1 and (trH <= cr_data_shape[1] and trW <= cr_data_shape[2])
-    ):
-        prob2 = volume_probability_prediction(
-            tr_volumes2,
-            cr_data_shape,
-            cr_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            outputs[2],
-            inputs[2],
-        )
+        predict_view(0, prob)
+        # the other views only look at voxels that the axial network is unsure about
+        uncertain = (prob > uncertain_range[0]) & (prob < uncertain_range[1])
+        view_prob = np.zeros_like(prob)
+        views = [1, 2]
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=len(views)) as executor:
+            futures = [
+                executor.submit(predict_view, view_idx, view_prob, uncertain)
+                for view_idx in views
+            ]
+            for future in futures:
+                future.result()
     else:
-        prob2 = volume_probability_prediction_dynamic_shape(
-            tr_volumes2,
-            cr_data_shape,
-            cr_label_shape,
-            data_channel,
-            class_num,
-            batch_size,
-            sess,
-            nets[2],
-        )
-    prob2 = np.transpose(prob2, [1, 0, 2, 3])
+        for view_idx in views:
+            predict_view(view_idx, view_prob, uncertain)
 
-    prob = (prob + prob1 + prob2) / 3.0
+    if scheduler is not None:
+        scheduler.add_callback(lambda: np.divide(prob, 3.0, out=prob))
+    elif uncertain_range is None:
+        prob /= 3.0
+    else:
+        prob[uncertain] = (prob[uncertain] + view_prob[uncertain]) / 3.0
     return prob
+
+
+# axes of a [D, H, W, C] study in the view of each slice direction, and of the [D, H, W]
+# probability of the view back in the axial orientation
+VIEW_PERMUTATIONS = {
+    "axial": ([0, 1, 2, 3], [0, 1, 2]),
+    "sagittal": ([2, 0, 1, 3], [1, 2, 0]),
+    "coronal": ([1, 0, 2, 3], [1, 0, 2]),
+}
+
+
+def pad_with_noise(volume, paddings):
+    """
+    pad a [D, H, W, C] tensor with normal noise, as extract_roi_from_volume fills the outside of the image
+    """
+    padded = tf.pad(volume, paddings)
+    inside = tf.pad(tf.ones_like(volume), paddings)
+    return padded + (1.0 - inside) * tf.random.normal(tf.shape(padded))
+
+
+def view_probability_graph(net, volume, data_shape, label_shape, data_channel, batch_size):
+    """
+    Foreground probability of one view computed in the graph, with the sub regions along z-axis,
+    adaptive tensor height and width and minibatches of volume_probability_prediction_dynamic_shape.
+    inputs:
+        volume: [D, H, W, data_channel] tensor in the orientation of the view
+    outputs:
+        prob: [D, H, W] foreground probability tensor
+    """
+    shape = tf.shape(volume)
+    [D, H, W] = [shape[0], shape[1], shape[2]]
+    data_slice = data_shape[0]
+    label_slice = label_shape[0]
+    # get_adaptive_size without shape buckets, the image is centered in the slabs
+    Hx = tf.maximum((H + 3) // 4 * 4, data_shape[1])
+    Wx = tf.maximum((W + 3) // 4 * 4, data_shape[2])
+    h0 = Hx // 2 - H // 2
+    w0 = Wx // 2 - W // 2
+    padded = pad_with_noise(
+        volume,
+        [[data_slice, data_slice], [h0, Hx - H - h0], [w0, Wx - W - w0], [0, 0]],
+    )
+
+    half = int(label_slice / 2)
+    num_slabs = (D + label_slice - 1) // label_slice
+    centers = tf.minimum(half + tf.range(num_slabs) * label_slice, D - half)
+    # slices of padded in each slab, those outside the image are noise
+    rows = centers[:, None] - int(data_slice / 2) + data_slice + tf.range(data_slice)[None, :]
+
+    def run_minibatch(start, probs):
+        data_mini_batch = tf.gather(padded, rows[start : start + batch_size])
+        data_mini_batch.set_shape([None, data_slice, None, None, data_channel])
+        prob_mini_batch = network_forward(net, data_mini_batch)
+        probs = probs.write(start // batch_size, prob_mini_batch[:, :, h0 : h0 + H, w0 : w0 + W, 1])
+        return start + batch_size, probs
+
+    probs = tf.TensorArray(tf.float32, size=0, dynamic_size=True, infer_shape=False)
+    # one minibatch at a time, as in the python loop
+    _, probs = tf.while_loop(
+        lambda start, probs: start < num_slabs,
+        run_minibatch,
+        [tf.constant(0), probs],
+        parallel_iterations=1,
+    )
+    probs = probs.concat()
+
+    # output slices of each slab: the last slab overwrites its overlap with the previous one
+    last = num_slabs - 1
+    last_z0 = centers[last] - tf.minimum(half, centers[last])
+    last_s0 = half - tf.minimum(half, centers[last])
+    z = tf.range(D)
+    in_last = z >= last_z0
+    slab = tf.where(in_last, tf.ones_like(z) * last, z // label_slice)
+    offset = tf.where(in_last, z - last_z0 + last_s0, z % label_slice)
+    return tf.gather_nd(probs, tf.stack([slab, offset], axis=1))
+
+
+def build_fused_ensemble(nets, data_shapes, label_shapes, data_channel, batch_size):
+    """
+    Build the three view ensemble of a stage as one graph. The study is transposed to the sagittal and
+    coronal views in the graph, the probabilities of the three networks are transposed back and averaged,
+    and only the label volume is returned to python.
+    The networks should be built in python (see build_network), the inputs of frozen and onnx networks
+    are fixed tensors. The graph uses the adaptive tensor shape of test_one_image_three_nets_adaptive_shape
+    with shape_mode 1 or 2, and runs every slab through the networks.
+    batch_size: one batch size for the three networks, or a list with the batch size of each network
+    outputs:
+        x: [D, H, W, data_channel] input placeholder
+        label: [D, H, W] uint8 tensor, argmax of the average probability of the three views
+    """
+    if not isinstance(batch_size, (list, tuple)):
+        batch_size = [batch_size] * 3
+    x = tf.compat.v1.placeholder(tf.float32, [None, None, None, data_channel])
+    probs = []
+    for view_idx, slice_direction in enumerate(["axial", "sagittal", "coronal"]):
+        [view_axes, axial_axes] = VIEW_PERMUTATIONS[slice_direction]
+        prob = view_probability_graph(
+            nets[view_idx],
+            tf.transpose(x, view_axes),
+            data_shapes[view_idx],
+            label_shapes[view_idx],
+            data_channel,
+            batch_size[view_idx],
+        )
+        probs.append(tf.transpose(prob, axial_axes))
+    prob = tf.add_n(probs) / 3.0
+    # argmax of two classes, the background probability is 1 - prob
+    label = tf.cast(prob > 0.5, tf.uint8)
+    return x, label
@@ -13,12 +13,14 @@ def run_msnet_segmentation(input_dir, output_dir):
         p = Path(os.path.join(input_dir, "patient"))
         p.chmod(p.stat().st_mode | stat.S_IROTH | stat.S_IXOTH | stat.S_IWOTH)
     os.system(f"mv {input_dir}/*.nii.gz {input_dir}/patient/")
+    os.system(f"mv {input_dir}/*.json {input_dir}/patient/")
 
     config_file = Path("src/models/msnet/config/mercure_config.txt")
 
     tumor_volume = run_inference(input_dir, output_dir, config_file)
     print("inference completed")
     os.system(f"mv {input_dir}/patient/*.nii.gz {input_dir}/")
+    os.system(f"mv {input_dir}/patient/*.json {input_dir}/")
 
     os.system(f"mv {output_dir}/patient/patient_seg_edema.nii.gz {output_dir}/seg_edema.nii.gz")
     os.system(f"mv {output_dir}/patient/patient_seg_enhanced.nii.gz {output_dir}/seg_enhanced.nii.gz")
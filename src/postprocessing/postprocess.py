@@ -297,6 +297,7 @@ def masked2dicom(
     mask_values,
     modality,
     tumor_stats,
+    brain_bbox=None,
 ) -> dict:
     """Converts a NIfTI file with the tumor segmentation mask overlapped into multiple DICOM files where each file
     corresponds to a slice.
@@ -311,6 +312,8 @@ def masked2dicom(
         mask_values: Enum mapping tumor subregion segmentations to their label number in composite mask
         output_prefix: Prefix for the output DICOM files.
         tumor_volume: dict with keys [total, enhancing, non_enhancing, edema] and corresponding float values.
+        brain_bbox: Brain bounding box saved at skull stripping, used to restrict the diffusion and perfusion
+            statistics to the brain region. The whole volume is used when it is None.
 
     Returns:
         DICOM file with the modality overlapped by the tumor segmentation mask.
@@ -325,64 +328,41 @@ def masked2dicom(
     if modality == "diffusion" or modality == "perfusion":
         logging.info(f"Calculating stats for masked {modality}...")
 
-        # --- MODIFIED BLOCK TO PREVENT ZeroDivisionError ---
-        # We must check if any voxels match our criteria before averaging.
-
-        # 1. Enhancing Portion
-        enhancing_weights = (
-            mask_array == mask_values.ENHANCING_TUMOR.value
-        ) & (background_array > 0)
-        if np.sum(enhancing_weights) > 0:
-            tumor_stats["enhancing portion"] = round(
-                np.average(
-                    background_array,
-                    weights=enhancing_weights,
-                ),
-                3,
+        # Statistics only need the brain region: crop to the brain bounding box saved at skull stripping.
+        offset = [0, 0, 0]
+        stats_mask_array = mask_array
+        stats_background_array = background_array
+        if brain_bbox is not None and list(background_array.shape[:3]) == brain_bbox["shape"]:
+            offset = brain_bbox["bbmin"]
+            crop = tuple(
+                slice(bbmin, bbmax + 1)
+                for bbmin, bbmax in zip(brain_bbox["bbmin"], brain_bbox["bbmax"])
             )
-        else:
-            tumor_stats["enhancing portion"] = 0.0
-            logging.info(
-                f"[{modality}] No enhancing tumor voxels found with background > 0. Assigning 0.0."
-            )
-
-        # 2. Total Vasogenic Edema Volume
-        whole_tumor_weights = (mask_array == mask_values.WHOLE_TUMOR.value) & (
-            background_array > 0
-        )
-        if np.sum(whole_tumor_weights) > 0:
-            tumor_stats["total vasogenic edema volume"] = round(
-                np.average(
-                    background_array,
-                    weights=whole_tumor_weights,
-                ),
-                3,
-            )
-        else:
-            tumor_stats["total vasogenic edema volume"] = 0.0
-            logging.info(
-                f"[{modality}] No whole tumor (edema) voxels found with background > 0. Assigning 0.0."
-            )
-
-        # 3. Non Enhancing Portion
-        tumor_core_weights = (mask_array == mask_values.TUMOR_CORE.value) & (
-            background_array > 0
-        )
-        if np.sum(tumor_core_weights) > 0:
-            tumor_stats["non enhancing portion"] = round(
-                np.average(
-                    background_array,
-                    weights=tumor_core_weights,
-                ),
-                3,
-            )
-        else:
-            tumor_stats["non enhancing portion"] = 0.0
-            logging.info(
-                f"[{modality}] No non-enhancing (tumor core) voxels found with background > 0. Assigning 0.0."
-            )
-
-        # --- END MODIFIED BLOCK ---
+            stats_mask_array = mask_array[crop]
+            stats_background_array = background_array[crop]
+        # voxels with a positive value, computed once for all sub-regions
+        positive_background = stats_background_array > 0
+
+        # (stats key, mask value, CSV name, description)
+        regions = [
+            ("enhancing portion", mask_values.ENHANCING_TUMOR, "enhancing_portion", "enhancing tumor"),
+            ("total vasogenic edema volume", mask_values.WHOLE_TUMOR, "whole_tumor", "whole tumor (edema)"),
+            ("non enhancing portion", mask_values.TUMOR_CORE, "non_enhancing_portion", "non-enhancing (tumor core)"),
+        ]
+        region_weights = {}
+        for key, mask_value, _, description in regions:
+            # We must check if any voxels match our criteria before averaging.
+            weights = (stats_mask_array == mask_value.value) & positive_background
+            region_weights[key] = weights
+            if np.any(weights):
+                tumor_stats[key] = round(
+                    np.average(stats_background_array, weights=weights), 3
+                )
+            else:
+                tumor_stats[key] = 0.0
+                logging.info(
+                    f"[{modality}] No {description} voxels found with background > 0. Assigning 0.0."
+                )
 
         if modality == "diffusion":
             tumor_stats["unit"] = "1e-3mm2/s"
@@ -392,92 +372,31 @@ def masked2dicom(
         logging.debug(f"Tumor stats for {modality}: {tumor_stats}")
 
         # generate a CSV spreadsheet with the values of the ADC or rCBV maps from each voxel in the segmentation
-        # 1. Enhancing Portion
-        enhancing_data = []
-        # This mask definition is the same as 'enhancing_weights' above
-        enhancing_tumor_mask = (
-            mask_array == mask_values.ENHANCING_TUMOR.value
-        ) & (background_array > 0)
-        if np.any(enhancing_tumor_mask):
-            # Get the indices (coordinates) where the mask is True
-            x_coords, y_coords, z_coords = np.where(enhancing_tumor_mask)
-            for i in range(len(z_coords)):
-                z, y, x = z_coords[i], y_coords[i], x_coords[i]
-                voxel_value = background_array[x, y, z]
-                enhancing_data.append(
-                    {"x": x, "y": y, "z": z, "Voxel_Value": voxel_value}
+        for key, _, csv_name, description in regions:
+            weights = region_weights[key]
+            if np.any(weights):
+                # Get the indices (coordinates) where the mask is True, in the full volume
+                x_coords, y_coords, z_coords = np.where(weights)
+                voxel_data = pd.DataFrame(
+                    {
+                        "x": x_coords + offset[0],
+                        "y": y_coords + offset[1],
+                        "z": z_coords + offset[2],
+                        "Voxel_Value": stats_background_array[weights],
+                    }
                 )
-            # Save to CSV
-            output_file_path = os.path.join(
-                output_dir, f"{modality}_enhancing_portion_voxels.csv"
-            )
-            df_enhancing = pd.DataFrame(enhancing_data)
-            df_enhancing.to_csv(output_file_path, index=False)
-            logging.info(
-                f"Saved {len(enhancing_data)} enhancing tumor voxel values to {output_file_path}"
-            )
-        else:
-            logging.info(
-                f"No Enhancing Portion voxels found for {modality}. Skipping file creation."
-            )
-
-        # 2. Total Vasogenic Edema Volume
-        whole_tumor_data = []
-        # This mask definition is the same as 'whole_tumor_weights' above
-        whole_tumor_mask = (mask_array == mask_values.WHOLE_TUMOR.value) & (
-            background_array > 0
-        )
-        if np.any(whole_tumor_mask):
-            # Get the indices (coordinates) where the mask is True
-            x_coords, y_coords, z_coords = np.where(whole_tumor_mask)
-            for i in range(len(z_coords)):
-                z, y, x = z_coords[i], y_coords[i], x_coords[i]
-                voxel_value = background_array[x, y, z]
-                whole_tumor_data.append(
-                    {"x": x, "y": y, "z": z, "Voxel_Value": voxel_value}
+                # Save to CSV
+                output_file_path = os.path.join(
+                    output_dir, f"{modality}_{csv_name}_voxels.csv"
                 )
-            # Save to CSV
-            output_file_path = os.path.join(
-                output_dir, f"{modality}_whole_tumor_voxels.csv"
-            )
-            df_whole_tumor = pd.DataFrame(whole_tumor_data)
-            df_whole_tumor.to_csv(output_file_path, index=False)
-            logging.info(
-                f"Saved {len(whole_tumor_data)} whole tumor voxel values to {output_file_path}"
-            )
-        else:
-            logging.info(
-                f"No Total Vasogenic Edema Volume voxels found for {modality}. Skipping file creation."
-            )
-
-        # 3. Non-Enhancing Portion
-        non_enhancing_data = []
-        # This mask definition is the same as 'tumor_core_weights' above
-        tumor_core_mask = (mask_array == mask_values.TUMOR_CORE.value) & (
-            background_array > 0
-        )
-        if np.any(tumor_core_mask):
-            # Get the indices (coordinates) where the mask is True
-            x_coords, y_coords, z_coords = np.where(tumor_core_mask)
-            for i in range(len(z_coords)):
-                z, y, x = z_coords[i], y_coords[i], x_coords[i]
-                voxel_value = background_array[x, y, z]
-                non_enhancing_data.append(
-                    {"x": x, "y": y, "z": z, "Voxel_Value": voxel_value}
+                voxel_data.to_csv(output_file_path, index=False)
+                logging.info(
+                    f"Saved {len(voxel_data)} {description} voxel values to {output_file_path}"
+                )
+            else:
+                logging.info(
+                    f"No {description} voxels found for {modality}. Skipping file creation."
                 )
-            # Save to CSV
-            output_file_path = os.path.join(
-                output_dir, f"{modality}_non_enhancing_portion_voxels.csv"
-            )
-            df_non_enhancing = pd.DataFrame(non_enhancing_data)
-            df_non_enhancing.to_csv(output_file_path, index=False)
-            logging.info(
-                f"Saved {len(non_enhancing_data)} non-enhancing tumor voxel values to {output_file_path}"
-            )
-        else:
-            logging.info(
-                f"No Non-Enhancing Portion voxels found for {modality}. Skipping file creation."
-            )
 
     # reorient arrays to save DICOM slices in AXIAL orientation
     mask_array = np.rot90(mask_array, axes=(0, 2))
@@ -798,6 +717,7 @@ def postprocess(
     output_dir,
     dicom_source_file,
     tumor_volume: dict,
+    brain_bbox: dict = None,
 ) -> None:
     """Runs the postprocessing step given a directory with a single NIfTI file.
     """
@@ -903,6 +823,7 @@ def postprocess(
                     mask_values,
                     modality,
                     tumor_volume.copy(), # Pass a copy to avoid mutation issues
+                    brain_bbox,
                 )
                 all_results.update(modality_results)
                 logging.info(f"Finished generating masked DICOM for {modality}.")
@@ -0,0 +1,314 @@
+"""
+Fast brain extraction engine built from numpy, scipy.ndimage and SimpleITK.
+
+This is a selectable alternative to the ANTs brain extraction script. The brain mask is built from an Otsu head mask,
+optionally restricted by the MICCAI 2012 brain prior registered to the exam with a fast affine, then cleaned with a
+morphological opening, largest connected component selection and hole filling.
+
+Every mask comes with a confidence score. A quality gate, calibrated on a validation set against ANTs masks, decides
+the minimal confidence for which the fast mask is accepted; below it the pipeline falls back to ANTs. A gate calibrated
+with the template prior only applies to masks built with the prior, without it the pipeline falls back to ANTs too.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+from scipy import ndimage
+
+TEMPLATE_PATH = "templates/MICCAI2012-Multi-Atlas-Challenge-Data/"
+GATE_FILE = "templates/fast_skull_strip_gate.json"
+
+# used when no gate file has been calibrated yet
+DEFAULT_MIN_CONFIDENCE = 0.9
+# plausible adult brain volume range (mL), used when the template prior is not available
+BRAIN_VOLUME_RANGE = (900.0, 1900.0)
+
+
+def otsu_threshold(values, bins=256):
+    """Compute the Otsu threshold of a set of intensities.
+
+    Args:
+        values: 1D array of intensities
+        bins: number of histogram bins
+
+    Returns:
+        Threshold maximizing the between-class variance.
+    """
+    hist, edges = np.histogram(values, bins=bins)
+    hist = hist.astype(np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * centers) / np.maximum(weight1, 1)
+    mean2 = (np.cumsum((hist * centers)[::-1]) / np.maximum(weight2[::-1], 1))[::-1]
+    variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return edges[1:-1][np.argmax(variance)]
+
+
+def dice(mask1, mask2):
+    """Dice overlap of two binary volumes."""
+    mask1 = np.asarray(mask1, bool)
+    mask2 = np.asarray(mask2, bool)
+    denominator = mask1.sum() + mask2.sum()
+    if denominator == 0:
+        return 1.0
+    return 2.0 * np.logical_and(mask1, mask2).sum() / denominator
+
+
+def largest_component(mask, structure=None):
+    """Keep the largest connected component of a binary volume."""
+    labeled_array, numpatches = ndimage.label(mask, structure)
+    if numpatches <= 1:
+        return labeled_array > 0
+    sizes = np.bincount(labeled_array.ravel())
+    sizes[0] = 0
+    return labeled_array == np.argmax(sizes)
+
+
+def register_template_prior(image, template_path=TEMPLATE_PATH):
+    """Bring the MICCAI 2012 brain probability mask into the space of an exam with a fast affine registration.
+
+    Args:
+        image: SimpleITK image of the exam (T1CE)
+        template_path: Directory containing the MICCAI 2012 templates
+
+    Returns:
+        Brain probability array in the exam space ([z, y, x] order), or None if the templates are missing.
+    """
+    template_file = os.path.join(template_path, "T_template0.nii.gz")
+    prior_file = os.path.join(template_path, "T_template0_BrainCerebellumProbabilityMask.nii.gz")
+    if not (os.path.exists(template_file) and os.path.exists(prior_file)):
+        print("MICCAI templates not found, running fast skull stripping without prior")
+        return None
+
+    fixed = sitk.Cast(image, sitk.sitkFloat32)
+    moving = sitk.ReadImage(template_file, sitk.sitkFloat32)
+    prior = sitk.ReadImage(prior_file, sitk.sitkFloat32)
+
+    initial_transform = sitk.CenteredTransformInitializer(
+        fixed, moving, sitk.AffineTransform(3), sitk.CenteredTransformInitializerFilter.MOMENTS
+    )
+    registration = sitk.ImageRegistrationMethod()
+    registration.SetMetricAsMattesMutualInformation(numberOfHistogramBins=32)
+    registration.SetMetricSamplingStrategy(registration.RANDOM)
+    registration.SetMetricSamplingPercentage(0.02, seed=1)
+    registration.SetInterpolator(sitk.sitkLinear)
+    registration.SetOptimizerAsRegularStepGradientDescent(
+        learningRate=1.0, minStep=1e-3, numberOfIterations=100
+    )
+    registration.SetOptimizerScalesFromPhysicalShift()
+    registration.SetShrinkFactorsPerLevel(shrinkFactors=[8, 4])
+    registration.SetSmoothingSigmasPerLevel(smoothingSigmas=[4, 2])
+    registration.SetInitialTransform(initial_transform, inPlace=False)
+    transform = registration.Execute(fixed, moving)
+
+    prior = sitk.Resample(prior, fixed, transform, sitk.sitkLinear, 0.0)
+    return sitk.GetArrayFromImage(prior)
+
+
+def fast_brain_mask(image_array, prior=None, opening_radius=3):
+    """Build a brain mask with thresholding and morphology.
+
+    Args:
+        image_array: exam intensities ([z, y, x] order)
+        prior: optional brain probability array in the same space
+        opening_radius: radius (voxels) of the opening used to detach the brain from the skull
+
+    Returns:
+        Boolean brain mask.
+    """
+    values = image_array[image_array > 0]
+    if values.size == 0:
+        return np.zeros(image_array.shape, bool)
+    head = image_array > otsu_threshold(values)
+    head = ndimage.binary_fill_holes(head)
+    if prior is not None:
+        region = ndimage.binary_dilation(prior > 0.5, iterations=2)
+        head = np.logical_and(head, region)
+
+    ball = ndimage.iterate_structure(
+        ndimage.generate_binary_structure(3, 1), opening_radius
+    )
+    brain = ndimage.binary_opening(head, structure=ball)
+    brain = largest_component(brain, ndimage.generate_binary_structure(3, 1))
+    brain = np.logical_and(ndimage.binary_dilation(brain, structure=ball), head)
+    brain = ndimage.binary_closing(brain, structure=ball)
+    brain = ndimage.binary_fill_holes(brain)
+    return brain
+
+
+def mask_confidence(mask, prior, voxel_volume):
+    """Confidence score of a fast brain mask.
+
+    With a registered prior the score is the Dice between the mask and the prior brain region, otherwise it is 1.0
+    when the brain volume lies in a plausible range and 0.0 otherwise.
+    """
+    if prior is not None:
+        return dice(mask, prior > 0.5)
+    volume = mask.sum() * voxel_volume / 1000.0
+    return float(BRAIN_VOLUME_RANGE[0] <= volume <= BRAIN_VOLUME_RANGE[1])
+
+
+def load_gate(gate_file=GATE_FILE):
+    """Read a calibrated quality gate file.
+
+    Returns:
+        The minimal accepted confidence, None if the gate is closed and ANTs is always used, and whether the
+        template prior was used during calibration.
+    """
+    if not os.path.exists(gate_file):
+        return DEFAULT_MIN_CONFIDENCE, True
+    with open(gate_file) as f:
+        gate = json.load(f)
+    if gate.get("always_fall_back", False):
+        return None, gate.get("use_template", True)
+    return gate["min_confidence"], gate.get("use_template", True)
+
+
+def accept_fast_mask(confidence, min_confidence):
+    """Quality gate decision for a fast brain mask.
+
+    Args:
+        confidence: confidence of the mask, None if it could not be computed as during calibration
+        min_confidence: minimal accepted confidence, None if the gate is closed
+
+    Returns:
+        True if the mask is accepted, False if the caller should fall back to ANTs.
+    """
+    if confidence is None or min_confidence is None:
+        return False
+    return confidence >= min_confidence
+
+
+def compute_fast_brain_mask(image_file, use_template=True):
+    """Compute the fast brain mask of a NIfTI file.
+
+    Args:
+        image_file: Path to the NIfTI file (T1CE)
+        use_template: Whether to seed the mask with the registered MICCAI brain prior
+
+    Returns:
+        SimpleITK image of the exam, boolean brain mask and its confidence. The confidence is None when the
+        template prior was asked for but could not be computed, since the volume range check is not comparable to
+        the Dice with the prior.
+    """
+    image = sitk.ReadImage(image_file)
+    image_array = sitk.GetArrayFromImage(image)
+    prior = register_template_prior(image) if use_template else None
+    mask = fast_brain_mask(image_array, prior)
+    if use_template and prior is None:
+        return image, mask, None
+    voxel_volume = float(np.prod(image.GetSpacing()))
+    return image, mask, mask_confidence(mask, prior, voxel_volume)
+
+
+def fast_skull_strip(image_file, mask_file, gate_file=GATE_FILE, use_template=None):
+    """Run the fast brain extraction and save the mask if it passes the quality gate.
+
+    Args:
+        image_file: Path to the NIfTI file (T1CE)
+        mask_file: Path where the brain mask will be saved
+        gate_file: Quality gate file written by validate_fast_skull_strip
+        use_template: Whether to seed the mask with the registered MICCAI brain prior, by default as during the
+            calibration of the gate, since the confidence threshold is only valid for that setting
+
+    Returns:
+        True if the mask was accepted and saved, False if the caller should fall back to ANTs.
+    """
+    min_confidence, gate_use_template = load_gate(gate_file)
+    if min_confidence is None:
+        print("fast skull stripping gate is closed, falling back to ANTs")
+        return False
+    if use_template is None:
+        use_template = gate_use_template
+    image, mask, confidence = compute_fast_brain_mask(image_file, use_template)
+    if confidence is None:
+        print("fast skull stripping prior not available, falling back to ANTs")
+        return False
+    print("fast skull stripping confidence {:.3f} (min {:.3f})".format(confidence, min_confidence))
+    if not accept_fast_mask(confidence, min_confidence):
+        return False
+
+    mask_image = sitk.GetImageFromArray(mask.astype(np.uint8))
+    mask_image.CopyInformation(image)
+    sitk.WriteImage(mask_image, mask_file)
+    return True
+
+
+def calibrate_min_confidence(cases, target_dice):
+    """Lowest confidence such that every case at or above it reaches the target dice.
+
+    Args:
+        cases: list of dictionaries with the dice versus ANTs and the confidence of each validation case
+        target_dice: Dice versus ANTs required for every accepted case
+
+    Returns:
+        The minimal confidence, None if no case qualifies and the gate is closed.
+    """
+    min_confidence = None
+    for case in sorted(cases, key=lambda x: x["confidence"], reverse=True):
+        if case["dice"] < target_dice:
+            break
+        min_confidence = case["confidence"]
+    return min_confidence
+
+
+def validate_fast_skull_strip(validation_dir, gate_file=GATE_FILE, target_dice=0.95, use_template=True):
+    """Calibrate the quality gate of the fast engine against ANTs masks.
+
+    Each case folder of validation_dir must contain brain_t1ce.nii.gz and the ANTs mask
+    strippedBrainExtractionMask.nii.gz. The minimal confidence is the lowest one for which every accepted case reaches
+    target_dice against ANTs; if no case qualifies the gate is closed and ANTs is always used.
+
+    Args:
+        validation_dir: Directory with one folder per validation case
+        gate_file: Path where the quality gate will be written
+        target_dice: Dice versus ANTs required for every accepted case
+        use_template: Whether to seed the masks with the registered MICCAI brain prior
+
+    Returns:
+        The quality gate dictionary.
+    """
+    cases = []
+    for case in sorted(os.listdir(validation_dir)):
+        image_file = os.path.join(validation_dir, case, "brain_t1ce.nii.gz")
+        ants_mask_file = os.path.join(validation_dir, case, "strippedBrainExtractionMask.nii.gz")
+        if not (os.path.exists(image_file) and os.path.exists(ants_mask_file)):
+            continue
+        _, mask, confidence = compute_fast_brain_mask(image_file, use_template)
+        assert confidence is not None, "MICCAI templates are needed to calibrate a gate with use_template"
+        ants_mask = sitk.GetArrayFromImage(sitk.ReadImage(ants_mask_file)) > 0
+        case_dice = dice(mask, ants_mask)
+        print("{}: dice {:.4f}, confidence {:.4f}".format(case, case_dice, confidence))
+        cases.append({"case": case, "dice": case_dice, "confidence": confidence})
+    assert len(cases) > 0, "no validation cases found in {}".format(validation_dir)
+
+    min_confidence = calibrate_min_confidence(cases, target_dice)
+    accepted = [x for x in cases if accept_fast_mask(x["confidence"], min_confidence)]
+    gate = {
+        "min_confidence": min_confidence,
+        "always_fall_back": min_confidence is None,
+        "target_dice": target_dice,
+        "use_template": use_template,
+        "mean_dice": float(np.mean([x["dice"] for x in cases])),
+        "accepted_fraction": len(accepted) / float(len(cases)),
+        "cases": cases,
+    }
+    print(
+        "mean dice {:.4f}, min confidence {}, {:.0f}% of cases accepted".format(
+            gate["mean_dice"], min_confidence, 100 * gate["accepted_fraction"]
+        )
+    )
+    with open(gate_file, "w") as f:
+        json.dump(gate, f, indent=4)
+    return gate
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Number of arguments should be at least 2. e.g.")
+        print("    python -m src.preprocessing.fast_skull_strip data/validation [gate_file]")
+        exit()
+    validate_fast_skull_strip(sys.argv[1], *sys.argv[2:3])
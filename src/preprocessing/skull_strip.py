@@ -1,5 +1,12 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import json
 import nibabel as nib
+import numpy as np
+
+from src.common.enums import BrainMaskArtifacts
+from src.preprocessing.fast_skull_strip import fast_skull_strip
 
 def ants_skull_strip(image, coreg_dir, skullstrip_dir):
     # define paths
@@ -21,21 +28,35 @@ def ants_skull_strip(image, coreg_dir, skullstrip_dir):
     os.system("mv *Brain.nii.gz {}/{}".format(skullstrip_dir, image))
 
 
-def apply_mask(coreg_dir, skullstrip_dir, image, mask):
-    """Apply the brain segmentation mask to the input image."""
-    # Load NIfTI files
+def load_brain_mask(mask):
+    """Load the brain segmentation mask once as a boolean array."""
+    return np.asanyarray(nib.load(mask).dataobj) > 0
+
+
+def apply_mask(coreg_dir, skullstrip_dir, image, brain_mask):
+    """Apply the boolean brain mask to the input image, keeping the native data type of the image."""
+    # Load NIfTI file
     image_file = os.path.join(coreg_dir, image)
     nifti_input_image = nib.load(image_file)
-    nifti_mask_image = nib.load(mask)
+    header = nifti_input_image.header.copy()
+    slope, inter = header.get_slope_inter()
+    if slope in (None, 1.0) and inter in (None, 0.0):
+        image_data = np.asanyarray(nifti_input_image.dataobj)
+    else:
+        # scaled integers: a zero in storage would not map to a zero intensity
+        image_data = nifti_input_image.get_fdata(dtype=np.float32)
+        header.set_data_dtype(np.float32)
+    assert image_data.shape[:3] == brain_mask.shape, f"{image} does not match the brain mask shape"
 
-    # Apply mask
-    masked_image_data = nifti_input_image.get_fdata() * nifti_mask_image.get_fdata()
+    # Apply mask (4D volumes share the same mask for every frame)
+    mask = brain_mask.reshape(brain_mask.shape + (1,) * (image_data.ndim - 3))
+    masked_image_data = np.where(mask, image_data, 0).astype(image_data.dtype, copy=False)
 
     # Create new NIfTI file
     nifti_mask_image = nib.nifti1.Nifti1Image(
         masked_image_data,
         affine=nifti_input_image.affine,
-        header=nifti_input_image.header,
+        header=header,
     )
 
     # Save NIfTI file
@@ -43,25 +64,80 @@ def apply_mask(coreg_dir, skullstrip_dir, image, mask):
     nib.save(nifti_mask_image, output_filename)
 
 
-def skull_strip(coreg_dir, skullstrip_dir):
-    """Skull strip modalities needed for segmentation using ANTs.
+def apply_mask_to_modalities(coreg_dir, skullstrip_dir, modalities, brain_mask):
+    """Apply the boolean brain mask to all modalities in parallel."""
+    images = [f'brain_{modality}.nii.gz' for modality in modalities]
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        # list() propagates exceptions raised in the workers
+        list(executor.map(lambda image: apply_mask(coreg_dir, skullstrip_dir, image, brain_mask), images))
+
+
+def get_brain_bbox(brain_mask):
+    """Bounding box (inclusive, NIfTI voxel order) of a boolean brain mask from per-axis projections."""
+    bbmin, bbmax = [], []
+    for axis in range(brain_mask.ndim):
+        other_axes = tuple(i for i in range(brain_mask.ndim) if i != axis)
+        indices = np.flatnonzero(brain_mask.any(axis=other_axes))
+        bbmin.append(int(indices[0]))
+        bbmax.append(int(indices[-1]))
+    return bbmin, bbmax
+
+
+def save_brain_mask(brain_mask, mask, skullstrip_dir):
+    """Save the brain mask and its bounding box as pipeline artifacts in skullstrip_dir."""
+    nifti_mask_image = nib.load(mask)
+    header = nifti_mask_image.header.copy()
+    header.set_data_dtype(np.uint8)
+    nib.save(
+        nib.nifti1.Nifti1Image(brain_mask.astype(np.uint8), affine=nifti_mask_image.affine, header=header),
+        os.path.join(skullstrip_dir, BrainMaskArtifacts.MASK.value),
+    )
+
+    bbmin, bbmax = get_brain_bbox(brain_mask)
+    with open(os.path.join(skullstrip_dir, BrainMaskArtifacts.BOUNDING_BOX.value), "w") as f:
+        json.dump({"shape": list(brain_mask.shape), "bbmin": bbmin, "bbmax": bbmax}, f)
+
+
+def load_brain_bbox(skullstrip_dir):
+    """Load the brain bounding box saved by skull_strip, or None if it does not exist.
+
+    Returns:
+        dict with the mask "shape" and the inclusive "bbmin" and "bbmax" corners, in NIfTI voxel order.
+    """
+    bbox_file = os.path.join(skullstrip_dir, BrainMaskArtifacts.BOUNDING_BOX.value)
+    if not os.path.exists(bbox_file):
+        return None
+    with open(bbox_file) as f:
+        return json.load(f)
+
+
+def skull_strip(coreg_dir, skullstrip_dir, engine="ants"):
+    """Skull strip modalities needed for segmentation using ANTs or the fast engine.
 
     Args:
         coreg_dir: Directory containing coregistered NIfTI files
         skullstrip_dir: Directory where skull stripped NIfTI files will be placed
+        engine: 'ants' or 'fast'. The fast engine falls back to ANTs when its quality gate rejects the mask
     """
     # modalities to skull strip
     modalities = ['t1ce', 't1', 't2', 'flair', 'diffusion']
 
     # skull strip T1CE
     image = 'brain_t1ce.nii.gz'
-    ants_skull_strip(image, coreg_dir, skullstrip_dir)
     mask_file = f'strippedBrainExtractionMask.nii.gz'
+    if engine == "fast" and fast_skull_strip(os.path.join(coreg_dir, image), mask_file):
+        print("### Brain mask computed with the fast engine")
+    else:
+        if engine == "fast":
+            print("### Fast brain mask rejected by the quality gate, falling back to ANTs...")
+        ants_skull_strip(image, coreg_dir, skullstrip_dir)
     
-    # apply mask to remaining modalities
-    for modality in modalities:
-        image = f'brain_{modality}.nii.gz'
-        apply_mask(coreg_dir, skullstrip_dir, image, mask_file)
+    # apply mask to all modalities
+    brain_mask = load_brain_mask(mask_file)
+    apply_mask_to_modalities(coreg_dir, skullstrip_dir, modalities, brain_mask)
+
+    # keep the brain mask and its bounding box for segmentation and postprocessing
+    save_brain_mask(brain_mask, mask_file, skullstrip_dir)
 
     # remove intermediate files
     os.system("rm *BrainExtraction*")
@@ -2,7 +2,7 @@ from src.preprocessing.dcm_to_nii import convert_dicom_to_nifti
 from src.preprocessing.coreg import coreg
 from src.preprocessing.coreg_perf import coreg_perf
 from src.preprocessing.coreg_diffusion import coreg_diffusion
-from src.preprocessing.skull_strip import skull_strip
+from src.preprocessing.skull_strip import skull_strip, load_brain_bbox
 from src.models.segmentation import run_msnet_segmentation
 from src.postprocessing.postprocess import postprocess
 import os, csv, time, stat, glob
@@ -53,7 +53,7 @@ def run_pipeline(base_dir):
         p.chmod(p.stat().st_mode | stat.S_IROTH | stat.S_IXOTH | stat.S_IWOTH)
     if len(os.listdir(skullstrip_dir)) == 0:
         print("### Running skullstripping...")
-        skull_strip(coreg_dir, skullstrip_dir)
+        skull_strip(coreg_dir, skullstrip_dir, engine=os.environ.get("SKULL_STRIP_ENGINE", "ants"))
         coreg_perf(nifti_dir, coreg_dir, skullstrip_dir) # data is coregistered to skull-stripped T1CE using transforms: rigid 
     else:
         print("### Skipping skullstripping...")
@@ -84,7 +84,8 @@ def run_pipeline(base_dir):
         print("### Running postprocessing...")
         # select a DICOM file to use as a template
         dcm_source_file = glob.glob(input_dir+'/*.dcm')[0]        
-        postprocess(nifti_dir, coreg_dir, seg_dir, output_dir, dcm_source_file, tumor_volume)
+        brain_bbox = load_brain_bbox(skullstrip_dir)
+        postprocess(nifti_dir, coreg_dir, seg_dir, output_dir, dcm_source_file, tumor_volume, brain_bbox)
         # Move all the output files/folders to a subfolder named after the Accession Number
         ds = dcmread(dcm_source_file, stop_before_pixels=True)
         accession_number = ds.get("AccessionNumber", "output").strip()
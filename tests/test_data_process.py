@@ -0,0 +1,328 @@
+import numpy as np
+from scipy import ndimage
+
+from src.models.msnet.util.data_process import (
+    binary_closing_in_bounding_box,
+    crop_ND_volume_with_bounding_box,
+    extract_roi_from_volume,
+    fill_holes,
+    get_component_sizes,
+    get_largest_two_component,
+    get_ND_bounding_box,
+    get_ND_volume_roi_view,
+    keep_components,
+    remove_external_core,
+    set_ND_volume_roi_with_bounding_box_range,
+    set_roi_to_volume,
+)
+
+
+# implementations of the roi and bounding box helpers before basic slices were used
+
+
+def baseline_get_ND_bounding_box(label, margin):
+    input_shape = label.shape
+    if type(margin) is int:
+        margin = [margin] * len(input_shape)
+    indxes = np.nonzero(label)
+    idx_min = [max(indxes[i].min() - margin[i], 0) for i in range(len(input_shape))]
+    idx_max = [
+        min(indxes[i].max() + margin[i], input_shape[i] - 1) for i in range(len(input_shape))
+    ]
+    return idx_min, idx_max
+
+
+def baseline_crop_ND_volume_with_bounding_box(volume, min_idx, max_idx):
+    ranges = [range(min_idx[i], max_idx[i] + 1) for i in range(volume.ndim)]
+    return volume[np.ix_(*ranges)]
+
+
+def baseline_set_ND_volume_roi_with_bounding_box_range(volume, bb_min, bb_max, sub_volume):
+    out = volume
+    out[np.ix_(*[range(bb_min[i], bb_max[i] + 1) for i in range(len(bb_min))])] = sub_volume
+    return out
+
+
+def baseline_get_ranges(center, patch_shape, volume_shape):
+    r0max = [int(x / 2) for x in patch_shape]
+    r1max = [patch_shape[i] - r0max[i] for i in range(len(r0max))]
+    r0 = [min(r0max[i], center[i]) for i in range(len(r0max))]
+    r1 = [min(r1max[i], volume_shape[i] - center[i]) for i in range(len(r0max))]
+    patch_ranges = [range(r0max[i] - r0[i], r0max[i] + r1[i]) for i in range(len(r0max))]
+    volume_ranges = [range(center[i] - r0[i], center[i] + r1[i]) for i in range(len(r0max))]
+    return patch_ranges, volume_ranges
+
+
+def baseline_extract_roi_from_volume(volume, in_center, output_shape, fill="random"):
+    if fill == "random":
+        output = np.random.normal(0, 1, size=output_shape)
+    else:
+        output = np.zeros(output_shape)
+    out_ranges, in_ranges = baseline_get_ranges(in_center, output_shape, volume.shape)
+    output[np.ix_(*out_ranges)] = volume[np.ix_(*in_ranges)]
+    return output
+
+
+def baseline_set_roi_to_volume(volume, center, sub_volume):
+    output_volume = volume
+    for i in range(len(center)):
+        if center[i] >= volume.shape[i]:
+            return output_volume
+    patch_ranges, volume_ranges = baseline_get_ranges(center, sub_volume.shape, volume.shape)
+    output_volume[np.ix_(*volume_ranges)] = sub_volume[np.ix_(*patch_ranges)]
+    return output_volume
+
+
+def get_random_volumes(rng, shapes, density=0.01):
+    volumes = []
+    for shape in shapes:
+        volume = np.asarray(rng.uniform(size=shape) < density, np.uint8)
+        volumes.append(volume)
+        # non-zero voxels on the boundary of the volume
+        edge = np.zeros(shape, np.uint8)
+        edge[(0,) * len(shape)] = 1
+        edge[tuple(s - 1 for s in shape)] = 1
+        volumes.append(edge)
+    return volumes
+
+
+def test_bounding_box_matches_baseline():
+    rng = np.random.RandomState(0)
+    for volume in get_random_volumes(rng, [(20, 30, 25), (12, 14, 10, 4), (30, 40)]):
+        for margin in [0, 3, [1, 0, 5, 2][: volume.ndim]]:
+            expected = baseline_get_ND_bounding_box(volume, margin)
+            assert get_ND_bounding_box(volume, margin) == expected
+
+
+def test_crop_matches_baseline_and_is_a_copy():
+    rng = np.random.RandomState(1)
+    for shape in [(20, 30), (20, 30, 25), (12, 14, 10, 4), (6, 8, 10, 4, 2)]:
+        volume = rng.normal(size=shape)
+        for _ in range(5):
+            bbmin = [rng.randint(0, s) for s in shape]
+            bbmax = [rng.randint(b, s) for b, s in zip(bbmin, shape)]
+            expected = baseline_crop_ND_volume_with_bounding_box(volume, bbmin, bbmax)
+            output = crop_ND_volume_with_bounding_box(volume, bbmin, bbmax)
+            np.testing.assert_array_equal(output, expected)
+            assert not np.shares_memory(output, volume)
+            view = get_ND_volume_roi_view(volume, bbmin, bbmax)
+            np.testing.assert_array_equal(view, expected)
+            assert np.shares_memory(view, volume)
+
+
+def test_writing_to_a_crop_leaves_the_volume_unchanged():
+    volume = np.zeros([10, 10, 10], bool)
+    crop = crop_ND_volume_with_bounding_box(volume, [2, 2, 2], [5, 5, 5])
+    crop |= True
+    assert not volume.any()
+    view = get_ND_volume_roi_view(volume, [2, 2, 2], [5, 5, 5])
+    view |= True
+    assert volume.sum() == 4 * 4 * 4
+
+
+def test_set_roi_matches_baseline():
+    rng = np.random.RandomState(2)
+    for shape in [(20, 30), (20, 30, 25), (12, 14, 10, 4)]:
+        for _ in range(5):
+            bbmin = [rng.randint(0, s) for s in shape]
+            bbmax = [rng.randint(b, s) for b, s in zip(bbmin, shape)]
+            sub_volume = rng.normal(size=[b1 - b0 + 1 for b0, b1 in zip(bbmin, bbmax)])
+            volume = rng.normal(size=shape)
+            expected = baseline_set_ND_volume_roi_with_bounding_box_range(
+                volume.copy(), bbmin, bbmax, sub_volume
+            )
+            output = set_ND_volume_roi_with_bounding_box_range(volume, bbmin, bbmax, sub_volume)
+            np.testing.assert_array_equal(output, expected)
+
+
+def test_extract_and_set_roi_match_baseline():
+    rng = np.random.RandomState(3)
+    for shape, roi_shape in [((20, 30, 25), (7, 10, 9)), ((12, 14, 10, 4), (5, 6, 7, 4))]:
+        volume = rng.normal(size=shape)
+        # centers inside the volume, on its boundary and near it
+        centers = [[s // 2 for s in shape], [0] * len(shape), [s - 1 for s in shape]]
+        centers += [[rng.randint(0, s) for s in shape] for _ in range(5)]
+        for center in centers:
+            expected = baseline_extract_roi_from_volume(volume, center, roi_shape, fill="zero")
+            output = extract_roi_from_volume(volume, center, roi_shape, fill="zero")
+            np.testing.assert_array_equal(output, expected)
+
+            # the part outside of the volume is noise, the rest matches
+            np.random.seed(0)
+            expected = baseline_extract_roi_from_volume(volume, center, roi_shape)
+            np.random.seed(0)
+            output = extract_roi_from_volume(volume, center, roi_shape)
+            assert output.shape == expected.shape
+            inside = baseline_extract_roi_from_volume(np.ones(shape), center, roi_shape, "zero") > 0
+            np.testing.assert_array_equal(output[inside], expected[inside])
+
+            sub_volume = rng.normal(size=roi_shape)
+            expected = baseline_set_roi_to_volume(volume.copy(), center, sub_volume)
+            output = set_roi_to_volume(volume.copy(), center, sub_volume)
+            np.testing.assert_array_equal(output, expected)
+
+        # a center outside of the volume leaves it unchanged
+        center = [s for s in shape]
+        output = set_roi_to_volume(volume.copy(), center, rng.normal(size=roi_shape))
+        np.testing.assert_array_equal(output, volume)
+
+
+# scipy implementations of the connected component helpers before bincount lookup tables were
+# used. The original code found the label of a component from its size with np.where, which
+# breaks on components of equal size; here ties go to the component with the lower label.
+
+
+def baseline_get_largest_two_component(img, threshold=None):
+    s = ndimage.generate_binary_structure(3, 2)
+    labeled_array, numpatches = ndimage.label(img, s)
+    sizes = ndimage.sum(img, labeled_array, range(1, numpatches + 1))
+    if len(sizes) == 1:
+        return np.asarray(img, bool)
+    if threshold:
+        out_img = np.zeros(img.shape, bool)
+        for label, size in enumerate(sizes):
+            if size > threshold:
+                out_img |= labeled_array == label + 1
+        return out_img
+    order = sorted(range(numpatches), key=lambda x: -sizes[x])
+    out_img = labeled_array == order[0] + 1
+    if sizes[order[1]] * 10 > sizes[order[0]]:
+        out_img |= labeled_array == order[1] + 1
+    return out_img
+
+
+def baseline_fill_holes(img):
+    neg = 1 - img
+    s = ndimage.generate_binary_structure(3, 1)
+    labeled_array, numpatches = ndimage.label(neg, s)
+    sizes = ndimage.sum(neg, labeled_array, range(1, numpatches + 1))
+    component = labeled_array == int(np.argmax(sizes)) + 1
+    return 1 - component
+
+
+def baseline_remove_external_core(lab_main, lab_ext):
+    s = ndimage.generate_binary_structure(3, 2)
+    labeled_array, numpatches = ndimage.label(lab_ext, s)
+    new_lab_ext = np.zeros_like(lab_ext)
+    for label in range(1, numpatches + 1):
+        component = labeled_array == label
+        overlap = component * lab_main
+        if (overlap.sum() + 0.0) / component.sum() >= 0.5:
+            new_lab_ext = np.maximum(new_lab_ext, component)
+    return new_lab_ext
+
+
+def get_component_volumes(rng, shape=(24, 30, 28)):
+    """
+    random volumes with several components, some touching the boundary of the volume, and
+    volumes with components of equal size
+    """
+    volumes = []
+    for density in [0.05, 0.15, 0.3]:
+        volumes.append(np.asarray(rng.uniform(size=shape) < density, np.uint8))
+    edge = np.zeros(shape, np.uint8)
+    edge[:4, :5, :6] = 1
+    edge[-3:, -7:, -2:] = 1
+    edge[10:14, 12:16, 10:13] = 1
+    volumes.append(edge)
+    # components of equal size, as the two largest and as the second largest
+    ties = np.zeros(shape, np.uint8)
+    ties[2:6, 2:6, 2:6] = 1
+    ties[10:14, 10:14, 10:14] = 1
+    ties[18:20, 20:22, 20:22] = 1
+    ties[18:20, 2:4, 2:4] = 1
+    volumes.append(ties)
+    ties_second = np.zeros(shape, np.uint8)
+    ties_second[0:8, 0:6, 0:6] = 1
+    ties_second[10:14, 10:14, 10:14] = 1
+    ties_second[16:20, 20:24, 20:24] = 1
+    volumes.append(ties_second)
+    return volumes
+
+
+def test_component_sizes_and_lookup_match_scipy():
+    rng = np.random.RandomState(4)
+    s = ndimage.generate_binary_structure(3, 2)
+    for volume in get_component_volumes(rng):
+        labeled_array, numpatches = ndimage.label(volume, s)
+        sizes = get_component_sizes(volume, labeled_array, numpatches)
+        expected = ndimage.sum(volume, labeled_array, range(1, numpatches + 1))
+        np.testing.assert_allclose(sizes[1:], expected)
+        weights = rng.uniform(size=volume.shape)
+        sizes = get_component_sizes(volume, labeled_array, numpatches, weights)
+        expected = ndimage.sum(weights, labeled_array, range(1, numpatches + 1))
+        np.testing.assert_allclose(sizes[1:], expected)
+
+        keep = rng.uniform(size=numpatches + 1) < 0.5
+        labels = [label for label in range(1, numpatches + 1) if keep[label]]
+        expected = np.isin(labeled_array, labels)
+        np.testing.assert_array_equal(keep_components(labeled_array, keep), expected)
+
+
+def test_component_selection_matches_scipy():
+    rng = np.random.RandomState(5)
+    for volume in get_component_volumes(rng):
+        for threshold in [None, 10, 50]:
+            expected = baseline_get_largest_two_component(volume, threshold)
+            output = get_largest_two_component(volume, False, threshold)
+            np.testing.assert_array_equal(np.asarray(output, bool), expected)
+
+        np.testing.assert_array_equal(fill_holes(volume), baseline_fill_holes(volume))
+
+        lab_main = np.asarray(rng.uniform(size=volume.shape) < 0.5, np.uint8)
+        near = ndimage.binary_dilation(volume, iterations=2)
+        lab_main[near & (rng.uniform(size=volume.shape) < 0.3)] = 1
+        expected = baseline_remove_external_core(lab_main, volume)
+        output = remove_external_core(lab_main, volume)
+        np.testing.assert_array_equal(output, expected)
+
+
+def test_largest_two_components_with_ties():
+    volumes = get_component_volumes(np.random.RandomState(6))
+    ties, ties_second = volumes[-2:]
+    # the two largest components have the same size, both are kept
+    output = get_largest_two_component(ties)
+    expected = np.zeros_like(ties)
+    expected[2:6, 2:6, 2:6] = 1
+    expected[10:14, 10:14, 10:14] = 1
+    np.testing.assert_array_equal(output, expected > 0)
+    # the second largest size is shared, the first of those components is kept
+    output = get_largest_two_component(ties_second)
+    expected = np.zeros_like(ties)
+    expected[0:8, 0:6, 0:6] = 1
+    expected[10:14, 10:14, 10:14] = 1
+    np.testing.assert_array_equal(output, expected > 0)
+
+
+def test_closing_in_bounding_box_matches_scipy():
+    rng = np.random.RandomState(7)
+    structures = [
+        ndimage.generate_binary_structure(3, 1),
+        ndimage.generate_binary_structure(3, 2),
+        ndimage.iterate_structure(ndimage.generate_binary_structure(3, 1), 2),
+    ]
+    for volume in get_component_volumes(rng):
+        for structure in structures:
+            expected = ndimage.binary_closing(volume, structure=structure)
+            output = binary_closing_in_bounding_box(volume, structure)
+            np.testing.assert_array_equal(output, expected)
+
+            # roi of a larger volume that is 0 around the roi, padded by the reach of the closing
+            reach = 2 * int(structure.shape[0] / 2)
+            bbmin = [3, 0, 5]
+            bbmax = [s - 1 - m for s, m in zip(volume.shape, [1, 6, 0])]
+            roi = np.zeros(volume.shape, np.uint8)
+            roi_view = get_ND_volume_roi_view(roi, bbmin, bbmax)
+            roi_view[...] = get_ND_volume_roi_view(volume, bbmin, bbmax)
+            expected = crop_ND_volume_with_bounding_box(
+                ndimage.binary_closing(roi, structure=structure), bbmin, bbmax
+            )
+            padding = [
+                (min(bbmin[dim], reach), min(volume.shape[dim] - 1 - bbmax[dim], reach))
+                for dim in range(3)
+            ]
+            output = binary_closing_in_bounding_box(roi_view, structure, padding)
+            np.testing.assert_array_equal(output, expected)
+
+    empty = np.zeros([8, 8, 8], np.uint8)
+    assert not binary_closing_in_bounding_box(empty, structures[1]).any()
@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+from scipy import ndimage
+
+from src.preprocessing.fast_skull_strip import (
+    accept_fast_mask,
+    calibrate_min_confidence,
+    dice,
+    fast_brain_mask,
+    load_gate,
+    mask_confidence,
+    otsu_threshold,
+)
+
+
+def get_phantom(shape=(48, 64, 64), radius=16, bridge=2):
+    """
+    ball brain of intensity 100 inside a dark scalp shell, joined to it by a thin bright bridge, with noise
+    """
+    grid = np.mgrid[tuple(slice(0, s) for s in shape)]
+    center = [s // 2 for s in shape]
+    distance = np.sqrt(sum((g - c) ** 2 for g, c in zip(grid, center)))
+    brain = distance <= radius
+    image = np.zeros(shape, np.float32)
+    image[np.logical_and(distance > radius + 3, distance <= radius + 6)] = 30
+    image[brain] = 100
+    z, y = center[:2]
+    image[z : z + bridge, y : y + bridge, center[2] :] = 100
+    rng = np.random.RandomState(0)
+    image[image > 0] += rng.normal(0, 3, size=int((image > 0).sum()))
+    return image, brain
+
+
+def test_otsu_threshold_separates_two_modes():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.normal(20, 2, 5000), rng.normal(80, 2, 5000)])
+    threshold = otsu_threshold(values)
+    assert values[:5000].max() < threshold < values[5000:].min()
+
+
+def test_fast_brain_mask_on_phantom():
+    image, brain = get_phantom()
+    mask = fast_brain_mask(image, opening_radius=2)
+    assert mask.dtype == bool
+    # the bridge is cut by the opening and the brain is the largest component
+    assert dice(mask, brain) > 0.9
+    assert ndimage.label(mask)[1] == 1
+    assert np.array_equal(mask, ndimage.binary_fill_holes(mask))
+
+
+def test_fast_brain_mask_of_empty_image():
+    mask = fast_brain_mask(np.zeros((8, 8, 8), np.float32))
+    assert mask.shape == (8, 8, 8)
+    assert not mask.any()
+
+
+def test_mask_confidence():
+    _, brain = get_phantom()
+    prior = brain.astype(np.float32) * 0.9
+    assert mask_confidence(brain, prior, 1.0) == 1.0
+    # without a prior, a volume check in mL
+    assert mask_confidence(brain, None, 1.0) == 0.0
+    assert mask_confidence(brain, None, 1000.0 * 1000.0 / brain.sum()) == 1.0
+
+
+def test_gate_decision():
+    cases = [
+        {"case": "a", "dice": 0.97, "confidence": 0.95},
+        {"case": "b", "dice": 0.96, "confidence": 0.92},
+        {"case": "c", "dice": 0.90, "confidence": 0.91},
+        {"case": "d", "dice": 0.96, "confidence": 0.80},
+    ]
+    min_confidence = calibrate_min_confidence(cases, 0.95)
+    assert min_confidence == 0.92
+    assert accept_fast_mask(0.93, min_confidence)
+    assert not accept_fast_mask(0.91, min_confidence)
+    # no prior although the gate was calibrated with it
+    assert not accept_fast_mask(None, min_confidence)
+
+    # no case qualifies, the gate is closed
+    assert calibrate_min_confidence(cases, 0.99) is None
+    assert not accept_fast_mask(1.0, None)
+
+
+def test_closed_gate_file(tmpdir):
+    gate_file = str(tmpdir.join("gate.json"))
+    with open(gate_file, "w") as f:
+        json.dump({"min_confidence": None, "always_fall_back": True, "use_template": False}, f)
+    with open(gate_file) as f:
+        # standard JSON, no Infinity
+        assert "Infinity" not in f.read()
+    assert load_gate(gate_file) == (None, False)
+    assert load_gate(str(tmpdir.join("missing.json")))[1]
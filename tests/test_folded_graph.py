@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("niftynet")
+
+from src.models.msnet.util.folded_graph import (
+    InferenceMSNet,
+    get_moving_statistics,
+    load_checkpoint_weights,
+)
+from src.models.msnet.util.MSNet import MSNet
+
+NET_NAME = "MSNet_small"
+DATA_SHAPE = [None, 19, None, None, 4]
+
+
+def write_checkpoint(model_file, params):
+    """
+    save a small MSNet with random batch normalization parameters, statistics and prelu slopes
+    """
+    rng = np.random.RandomState(0)
+    graph = tf.Graph()
+    with graph.as_default():
+        net = MSNet(num_classes=2, name=NET_NAME)
+        net.set_params(params)
+        net(tf.compat.v1.placeholder(tf.float32, DATA_SHAPE), is_training=True)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            for var in tf.compat.v1.global_variables():
+                shape = var.shape.as_list()
+                if var.name.endswith(("gamma:0", "moving_variance:0")):
+                    var.load(rng.uniform(0.5, 1.5, shape), sess)
+                elif var.name.endswith(("beta:0", "moving_mean:0", "alpha:0")):
+                    var.load(rng.normal(0, 0.2, shape), sess)
+            tf.compat.v1.train.Saver().save(sess, model_file)
+
+
+def run_msnet(model_file, params, data, is_training):
+    graph = tf.Graph()
+    with graph.as_default():
+        net = MSNet(num_classes=2, name=NET_NAME)
+        net.set_params(params)
+        x = tf.compat.v1.placeholder(tf.float32, DATA_SHAPE)
+        y = net(x, is_training=is_training)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            tf.compat.v1.train.Saver().restore(sess, model_file)
+            return sess.run(y, feed_dict={x: data})
+
+
+def run_inference_msnet(weights, params, data, statistics):
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.compat.v1.placeholder(tf.float32, DATA_SHAPE)
+        y = InferenceMSNet(weights, params, statistics)(x)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            return sess.run(y, feed_dict={x: data})
+
+
+@pytest.mark.parametrize("downsample_twice", [True, False])
+def test_folded_network_matches_niftynet(tmpdir, downsample_twice):
+    params = {"base_feature_number": [4, 4, 6, 8], "downsample_twice": downsample_twice}
+    model_file = str(tmpdir.join("msnet_small.ckpt"))
+    write_checkpoint(model_file, params)
+    weights = load_checkpoint_weights(model_file, NET_NAME)
+    data = np.random.RandomState(1).normal(0, 1, size=[2, 19, 48, 48, 4]).astype(np.float32)
+
+    # minibatch moments, as the networks are run at test time
+    expected = run_msnet(model_file, params, data, is_training=True)
+    output = run_inference_msnet(weights, params, data, None)
+    np.testing.assert_allclose(output, expected, rtol=1e-3, atol=1e-4)
+
+    # batch normalization folded with the statistics the niftynet network uses outside training
+    expected = run_msnet(model_file, params, data, is_training=False)
+    output = run_inference_msnet(weights, params, data, get_moving_statistics(weights))
+    np.testing.assert_allclose(output, expected, rtol=1e-3, atol=1e-4)
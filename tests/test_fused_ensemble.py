@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from src.models.msnet.util import train_test_func
+from src.models.msnet.util.train_test_func import build_fused_ensemble
+
+DATA_SHAPE = [19, 32, 32]
+LABEL_SHAPE = [11, 32, 32]
+
+
+class VoxelwiseNet(object):
+    """
+    stub network: the foreground logit of the central label slices is the first channel of each voxel
+    scaled by the network, so that a view transposed the wrong way is noticed
+    """
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, x, is_training=True):
+        margin = int((DATA_SHAPE[0] - LABEL_SHAPE[0]) / 2)
+        feature = self.scale * x[:, margin : DATA_SHAPE[0] - margin, :, :, 0]
+        return tf.stack([tf.zeros_like(feature), feature], axis=-1)
+
+
+@pytest.mark.parametrize("shape", [[30, 36, 40], [24, 20, 28]])
+def test_fused_ensemble_matches_python_views(shape):
+    rng = np.random.RandomState(0)
+    image = rng.normal(0, 1, size=shape + [4]).astype(np.float32)
+    # away from the decision boundary, so that the labels do not depend on rounding
+    image[..., 0] = np.sign(image[..., 0]) * rng.uniform(0.2, 2.0, size=shape)
+    graph = tf.Graph()
+    with graph.as_default():
+        nets = [VoxelwiseNet(1.0), VoxelwiseNet(2.0), VoxelwiseNet(0.5)]
+        x, label = build_fused_ensemble(nets, [DATA_SHAPE] * 3, [LABEL_SHAPE] * 3, 4, 2)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            # imported through the module, pytest would collect the test_ function otherwise
+            prob = train_test_func.test_one_image_three_nets_adaptive_shape(
+                image,
+                [DATA_SHAPE] * 3,
+                [LABEL_SHAPE] * 3,
+                4,
+                2,
+                2,
+                sess,
+                nets,
+                [None] * 3,
+                [None] * 3,
+                2,
+                shape_buckets=[],
+                weight=np.ones(shape, np.uint8),
+            )
+            fused_label = sess.run(label, feed_dict={x: image})
+    feature = image[..., 0].astype(np.float64)
+    expected = sum(1.0 / (1.0 + np.exp(-scale * feature)) for scale in [1.0, 2.0, 0.5]) / 3.0
+    np.testing.assert_allclose(prob, expected, rtol=1e-5)
+    assert fused_label.dtype == np.uint8
+    np.testing.assert_array_equal(fused_label, np.asarray(prob > 0.5, np.uint8))
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.models.msnet.inference import get_coarse_bounding_box, predict_whole_tumor
+from src.models.msnet.util.data_process import (
+    binary_closing_in_bounding_box,
+    get_largest_two_component,
+    get_ND_bounding_box,
+)
+
+FACTOR = 4
+MARGIN = 10
+
+
+def predict_voxelwise(imgs, weight):
+    """
+    stub stage 1: the whole tumor probability is a sigmoid of the first channel of each voxel
+    """
+    prob = 1.0 / (1.0 + np.exp(-20.0 * (imgs[..., 0] - 0.5)))
+    return prob * (weight > 0)
+
+
+def run_stage1(imgs, weight, factor):
+    """
+    drive predict_whole_tumor with the stub, as the scheduler of run_inference does
+    """
+    requests = []
+    generator = predict_whole_tumor(imgs, weight, factor, MARGIN)
+    prob = None
+    try:
+        while True:
+            stage, stage_imgs, stage_weight = generator.send(prob)
+            assert stage == 0
+            requests.append(stage_imgs.shape[:3])
+            prob = predict_voxelwise(stage_imgs, stage_weight)
+    except StopIteration as stop:
+        prob1, wt_bbox = stop.value
+    pred1 = np.asarray(prob1 > 0.5, np.uint16) * weight
+    # the whole tumor bounding box the next stages are cropped to, as segment_study computes it
+    struct = np.ones((3, 3, 3), bool)
+    wt_mask = get_largest_two_component(binary_closing_in_bounding_box(pred1, struct), False, 2000)
+    bbox1 = get_ND_bounding_box(wt_mask, 5) if wt_mask.any() else None
+    return pred1, bbox1, wt_bbox, requests
+
+
+def get_study(tumor_slices):
+    shape = (64, 80, 72)
+    imgs = np.zeros(shape + (4,), np.float32)
+    weight = np.zeros(shape, np.uint8)
+    weight[4:60, 4:76, 4:68] = 1
+    if tumor_slices is not None:
+        imgs[tumor_slices] = 1.0
+    return imgs, weight
+
+
+def assert_same_as_full_pass(imgs, weight):
+    pred_full, bbox_full, _, requests_full = run_stage1(imgs, weight, 0)
+    pred, bbox, wt_bbox, requests = run_stage1(imgs, weight, FACTOR)
+    assert len(requests_full) == 1
+    np.testing.assert_array_equal(pred, pred_full)
+    assert bbox == bbox_full
+    return wt_bbox, requests
+
+
+def test_coarse_pass_matches_full_pass():
+    imgs, weight = get_study(np.s_[20:36, 30:50, 25:41])
+    wt_bbox, requests = assert_same_as_full_pass(imgs, weight)
+    # the fine pass covers the coarse tumor with margin only, the coarse blocks half in the tumor
+    # along the height are not part of it, but are within the margin
+    assert wt_bbox == [[10, 22, 14], [45, 57, 49]]
+    assert requests == [(16, 20, 18), (36, 36, 36)]
+
+
+def test_empty_coarse_tumor_falls_back_to_full_pass():
+    imgs, weight = get_study(None)
+    wt_bbox, requests = assert_same_as_full_pass(imgs, weight)
+    assert wt_bbox is None
+    assert requests == [(16, 20, 18), (64, 80, 72)]
+
+
+def test_tumor_touching_the_boundary_falls_back_to_full_pass():
+    # the tumor reaches the last slices, outside the brain mask of the coarse pass too
+    imgs, weight = get_study(np.s_[40:64, 30:50, 25:41])
+    weight[40:64, 30:50, 25:41] = 1
+    wt_bbox, requests = assert_same_as_full_pass(imgs, weight)
+    assert wt_bbox is None
+    assert requests == [(16, 20, 18), (64, 80, 72)]
+
+
+def test_get_coarse_bounding_box():
+    coarse_weight = np.ones((8, 8, 8), bool)
+    coarse_prob = np.zeros((8, 8, 8), np.float32)
+    assert get_coarse_bounding_box(coarse_prob, coarse_weight, (32, 32, 32), 4, 3) is None
+    coarse_prob[2:4, 3, 4:6] = 1.0
+    assert get_coarse_bounding_box(coarse_prob, coarse_weight, (32, 32, 32), 4, 3) == [
+        [5, 9, 13],
+        [18, 18, 26],
+    ]
+    # the margin is clipped to the study
+    assert get_coarse_bounding_box(coarse_prob, coarse_weight, (32, 32, 32), 4, 20) == [
+        [0, 0, 0],
+        [31, 31, 31],
+    ]
+    # tumor outside the brain mask is ignored
+    coarse_weight[2:4] = False
+    assert get_coarse_bounding_box(coarse_prob, coarse_weight, (32, 32, 32), 4, 3) is None
+    # tumor on the boundary of the coarse study
+    coarse_prob[7, 3, 4] = 1.0
+    coarse_weight[7] = True
+    assert get_coarse_bounding_box(coarse_prob, coarse_weight, (32, 32, 32), 4, 3) is None
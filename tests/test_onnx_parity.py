@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tf2onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("niftynet")
+
+from src.models.msnet.export_graph import export_graph
+from src.models.msnet.export_onnx import check_onnx_parity, export_onnx
+from src.models.msnet.inference import build_network
+from src.models.msnet.util.parse_config import parse_config
+
+CONFIG = """
+[network1]
+net_type            = MSNet
+net_name            = MSNet_small
+downsample_twice    = True
+base_feature_number = [4, 4, 4, 4]
+data_shape          = [19, 48, 48, 4]
+label_shape         = [11, 48, 48, 1]
+class_num           = 2
+model_file          = {model_file}
+
+[testing]
+whole_tumor_only    = True
+"""
+
+
+def write_small_network(tmpdir):
+    """
+    write the config and the randomly initialized checkpoint of a small one-stage cascade
+    """
+    config_file = str(tmpdir.join("config.txt"))
+    with open(config_file, "w") as f:
+        f.write(CONFIG.format(model_file=str(tmpdir.join("msnet_small.ckpt"))))
+    config_net = parse_config(config_file, None, None, None)["network1"]
+    graph = tf.Graph()
+    with graph.as_default():
+        build_network(config_net, [None, 19, None, None, 4])
+        with tf.compat.v1.Session(graph=graph) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            tf.compat.v1.train.Saver().save(sess, config_net["model_file"])
+    return config_file
+
+
+def test_onnx_matches_frozen_graph(tmpdir):
+    config_file = write_small_network(tmpdir)
+    graph_file = str(tmpdir.join("msnet_cascade.pb"))
+    onnx_dir = str(tmpdir.join("onnx"))
+    export_graph(config_file, graph_file)
+    with tf.Graph().as_default():
+        export_onnx(config_file, graph_file, onnx_dir)
+    assert os.path.exists(os.path.join(onnx_dir, "network1.onnx"))
+    with tf.Graph().as_default():
+        max_diff = check_onnx_parity(config_file, graph_file, onnx_dir, batch_size=2, sizes=(48, 64))
+    assert max_diff["network1"] <= 1e-4
@@ -0,0 +1,58 @@
+import numpy as np
+
+from src.models.msnet.util.train_test_func import (
+    SlabScheduler,
+    volume_probability_prediction_dynamic_shape,
+)
+
+
+class DynamicShapeNet(object):
+    """
+    stands for a frozen network: one input and one output for every batch size, height and width
+    """
+
+    dynamic_shape = True
+
+    def __init__(self):
+        self.x = "x"
+        self.proby = "proby"
+
+
+class VoxelwiseSession(object):
+    """
+    runs a network whose foreground probability is the sigmoid of the first channel of each voxel
+    """
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def run(self, proby, feed_dict):
+        data = feed_dict["x"]
+        self.batch_shapes.append(data.shape)
+        prob = 1.0 / (1.0 + np.exp(-data[..., 0]))
+        return np.stack([1.0 - prob, prob], axis=-1)
+
+
+def test_queued_studies_with_different_shapes():
+    net = DynamicShapeNet()
+    sess = VoxelwiseSession()
+    scheduler = SlabScheduler()
+    studies = [
+        np.random.normal(0, 1, size=shape).astype(np.float32)
+        for shape in [(40, 170, 150, 4), (40, 200, 150, 4)]
+    ]
+    probs = [
+        volume_probability_prediction_dynamic_shape(
+            study, [19, 180, 160], [19, 180, 160], 4, 2, 5, sess, net, scheduler=scheduler
+        )
+        for study in studies
+    ]
+    assert sess.batch_shapes == []
+    scheduler.run(sess)
+
+    # one minibatch per slab shape, each with the 3 slabs of its study, the height 200 above the
+    # native 180 is rounded up to a multiple of 16
+    assert sorted(sess.batch_shapes) == [(3, 19, 180, 160, 4), (3, 19, 208, 160, 4)]
+    for study, prob in zip(studies, probs):
+        expected = 1.0 / (1.0 + np.exp(-study[..., 0]))
+        np.testing.assert_allclose(prob, expected, rtol=1e-5)
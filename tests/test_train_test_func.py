@@ -0,0 +1,299 @@
+import itertools
+import threading
+
+import numpy as np
+import pytest
+
+from src.models.msnet.util.train_test_func import (
+    MinibatchPrefetcher,
+    SlabStatistics,
+    get_adaptive_size,
+    volume_probability_prediction,
+)
+from src.models.msnet.util import train_test_func
+from src.models.msnet.util.data_process import transpose_image_tensor
+
+# the three networks of a stage: input, output and scale of the stub network of each view
+VIEW_INPUTS = ["x_ax", "x_sg", "x_cr"]
+VIEW_OUTPUTS = ["proby_ax", "proby_sg", "proby_cr"]
+VIEW_SCALES = {"proby_ax": 1.0, "proby_sg": 2.0, "proby_cr": 0.5}
+DATA_SHAPE = [19, 48, 48]
+LABEL_SHAPE = [11, 48, 48]
+
+
+def test_adaptive_size_is_bucketed_by_default():
+    # native sizes and smaller images keep the native size
+    assert get_adaptive_size(90, 96) == 96
+    assert get_adaptive_size(96, 96) == 96
+    # larger images are rounded up to a multiple of 16, so a few graphs cover every image
+    assert get_adaptive_size(97, 96) == 112
+    assert get_adaptive_size(200, 180) == 208
+    sizes = set(get_adaptive_size(size, 96) for size in range(1, 257))
+    assert len(sizes) == len(np.arange(96, 257, 16))
+    # explicit buckets, and an empty list for the exact multiple of 4
+    assert get_adaptive_size(130, 96, [128, 144, 160]) == 144
+    assert get_adaptive_size(170, 96, [128, 144, 160]) == 172
+    assert get_adaptive_size(130, 96, []) == 132
+
+
+class MinibatchSession(object):
+    """
+    runs a stub network on the central label slices of each slab: the foreground probability is the
+    sigmoid of the first channel normalized with the moments of the minibatch, as batch normalization
+    with is_training=True
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self.batch_shapes = []
+
+    def run(self, proby, feed_dict):
+        data = feed_dict["x"]
+        self.batch_shapes.append(data.shape)
+        feature = data[:, self.margin : data.shape[1] - self.margin, ..., 0]
+        feature = (feature - feature.mean()) / (feature.std() + 1e-5)
+        prob = 1.0 / (1.0 + np.exp(-feature))
+        return np.stack([1.0 - prob, prob], axis=-1)
+
+
+class VoxelwiseSession(MinibatchSession):
+    """
+    runs a stub network whose foreground probability is the sigmoid of the first channel of each voxel
+    """
+
+    def run(self, proby, feed_dict):
+        data = feed_dict["x"]
+        self.batch_shapes.append(data.shape)
+        prob = 1.0 / (1.0 + np.exp(-data[:, self.margin : data.shape[1] - self.margin, ..., 0]))
+        return np.stack([1.0 - prob, prob], axis=-1)
+
+
+def test_slabs_are_written_to_their_output_slices():
+    # the image is smaller than the slabs in height and width, the last slab overlaps the previous one
+    image = np.random.RandomState(0).normal(0, 1, size=[40, 30, 26, 4]).astype(np.float32)
+    sess = VoxelwiseSession(4)
+    prob = volume_probability_prediction(
+        image, [19, 32, 32], [11, 32, 32], 4, 2, 3, sess, "proby", "x"
+    )
+    np.testing.assert_allclose(prob, 1.0 / (1.0 + np.exp(-image[..., 0])), rtol=1e-5)
+    # 4 slabs, the last minibatch holds the remaining slab only
+    assert [shape[0] for shape in sess.batch_shapes] == [3, 1]
+
+
+def test_partial_last_minibatch_is_deterministic():
+    image = np.random.RandomState(0).normal(0, 1, size=[60, 32, 32, 4]).astype(np.float32)
+    probs = []
+    for _ in range(2):
+        np.random.seed(1)
+        sess = MinibatchSession(4)
+        probs.append(
+            volume_probability_prediction(
+                image, [19, 32, 32], [11, 32, 32], 4, 2, 4, sess, "proby", "x"
+            )
+        )
+        # 6 slabs, no noise slabs are added to the last minibatch
+        assert [shape[0] for shape in sess.batch_shapes] == [4, 2]
+    np.testing.assert_array_equal(probs[0], probs[1])
+
+
+def test_minibatches_without_brain_are_skipped():
+    image = np.random.RandomState(0).normal(0, 1, size=[60, 32, 32, 4]).astype(np.float32)
+    # brain voxels in the output slices of the first slab only
+    weight = np.zeros([60, 32, 32], np.uint8)
+    weight[2:8] = 1
+    sess = VoxelwiseSession(4)
+    statistics = SlabStatistics()
+    prob = volume_probability_prediction(
+        image, [19, 32, 32], [11, 32, 32], 4, 2, 2, sess, "proby", "x", weight, statistics=statistics
+    )
+    # the second slab runs with the first one, the other two minibatches are skipped
+    assert [shape[0] for shape in sess.batch_shapes] == [2]
+    assert statistics.total == 6
+    assert statistics.get_skipped("brain") == 4
+    expected = 1.0 / (1.0 + np.exp(-image[..., 0]))
+    np.testing.assert_allclose(prob[:22], expected[:22], rtol=1e-5)
+    assert not prob[22:].any()
+
+
+class ViewSession(object):
+    """
+    runs a voxelwise stub network for each view, the foreground probability is the sigmoid of the first
+    channel scaled differently for each view, so that a view written in the wrong orientation is noticed
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self.batch_shapes = []
+        self.threads = {}
+
+    def run(self, proby, feed_dict):
+        [data] = list(feed_dict.values())
+        self.batch_shapes.append(data.shape)
+        self.threads.setdefault(proby, set()).add(threading.current_thread())
+        feature = VIEW_SCALES[proby] * data[:, self.margin : data.shape[1] - self.margin, ..., 0]
+        prob = 1.0 / (1.0 + np.exp(-feature))
+        return np.stack([1.0 - prob, prob], axis=-1)
+
+
+def predict_three_views(image, batch_size, sess=None, **kwargs):
+    if sess is None:
+        sess = ViewSession(4)
+    # imported through the module, pytest would collect the test_ function otherwise
+    return train_test_func.test_one_image_three_nets_adaptive_shape(
+        image,
+        [DATA_SHAPE] * 3,
+        [LABEL_SHAPE] * 3,
+        4,
+        2,
+        batch_size,
+        sess,
+        [None] * 3,
+        VIEW_OUTPUTS,
+        VIEW_INPUTS,
+        0,
+        weight=np.ones(image.shape[:3], np.uint8),
+        **kwargs
+    )
+
+
+def predict_three_views_baseline(image, batch_size):
+    """
+    the views as they were computed before the shared accumulator: one probability volume per view,
+    transposed back to the axial orientation and averaged
+    """
+    probs = []
+    for view_idx, slice_direction in enumerate(["axial", "sagittal", "coronal"]):
+        prob = volume_probability_prediction(
+            transpose_image_tensor(image, slice_direction),
+            DATA_SHAPE,
+            LABEL_SHAPE,
+            4,
+            2,
+            batch_size,
+            ViewSession(4),
+            VIEW_OUTPUTS[view_idx],
+            VIEW_INPUTS[view_idx],
+        )
+        probs.append(prob.astype(np.float64))
+    return (probs[0] + np.transpose(probs[1], [1, 2, 0]) + np.transpose(probs[2], [1, 0, 2])) / 3.0
+
+
+def test_three_view_accumulator_matches_baseline():
+    image = np.random.RandomState(0).normal(0, 1, size=[30, 36, 40, 4]).astype(np.float32)
+    expected = predict_three_views_baseline(image, 2)
+    prob = predict_three_views(image, 2)
+    assert prob.dtype == np.float32
+    assert prob.shape == (30, 36, 40)
+    np.testing.assert_allclose(prob, expected, rtol=1e-5)
+    # the half precision accumulator
+    prob = predict_three_views(image, 2, dtype=np.float16)
+    assert prob.dtype == np.float16
+    np.testing.assert_allclose(prob, expected, atol=2e-3)
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetcher_keeps_the_order(depth):
+    assert list(MinibatchPrefetcher(iter(range(10)), depth)) == list(range(10))
+    assert list(MinibatchPrefetcher(iter([]), depth)) == []
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetcher_raises_the_error_of_the_generator(depth):
+    def generator():
+        yield 0
+        yield 1
+        raise ValueError("slab")
+
+    items = []
+    with pytest.raises(ValueError, match="slab"):
+        for item in MinibatchPrefetcher(generator(), depth):
+            items.append(item)
+    assert items == [0, 1]
+
+
+def test_prefetcher_stops_its_thread_when_the_consumer_stops():
+    threads = threading.active_count()
+    items = iter(MinibatchPrefetcher(itertools.count(), 2))
+    assert [next(items), next(items)] == [0, 1]
+    assert threading.active_count() == threads + 1
+    items.close()
+    assert threading.active_count() == threads
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetched_minibatches_match_the_calling_thread(depth):
+    image = np.random.RandomState(0).normal(0, 1, size=[60, 30, 26, 4]).astype(np.float32)
+    probs = []
+    for prefetch_depth in [0, depth]:
+        np.random.seed(1)
+        sess = MinibatchSession(4)
+        probs.append(
+            volume_probability_prediction(
+                image,
+                [19, 32, 32],
+                [11, 32, 32],
+                4,
+                2,
+                4,
+                sess,
+                "proby",
+                "x",
+                prefetch_depth=prefetch_depth,
+            )
+        )
+        assert [shape[0] for shape in sess.batch_shapes] == [4, 2]
+    np.testing.assert_array_equal(probs[0], probs[1])
+
+
+def get_uncertain_image():
+    """
+    an image the axial stub network is sure about, but for a small block of voxels close to 0
+    """
+    rng = np.random.RandomState(0)
+    image = rng.normal(0, 1, size=[30, 36, 40, 4]).astype(np.float32)
+    image[..., 0] = np.where(image[..., 0] > 0, 6.0, -6.0)
+    image[2:6, 5:10, 3:8, 0] = rng.uniform(-1, 1, size=[4, 5, 5])
+    return image
+
+
+def test_adaptive_views_match_the_three_views_on_uncertain_voxels():
+    image = get_uncertain_image()
+    feature = image[..., 0].astype(np.float64)
+    prob_ax = 1.0 / (1.0 + np.exp(-feature))
+    uncertain = (prob_ax > 0.2) & (prob_ax < 0.8)
+    assert uncertain.sum() == uncertain[2:6, 5:10, 3:8].sum() == 100
+    expected = predict_three_views_baseline(image, 1)
+    expected[~uncertain] = prob_ax[~uncertain]
+
+    statistics = SlabStatistics()
+    prob = predict_three_views(image, 1, uncertain_range=[0.2, 0.8], statistics=statistics)
+    np.testing.assert_allclose(prob, expected, rtol=1e-5)
+    # 3 axial slabs, 4 sagittal and 4 coronal ones, of which only the first hold uncertain voxels
+    assert statistics.total == 11
+    assert statistics.get_skipped("views") == 6
+    assert statistics.get_skipped("brain") == 0
+
+    # without uncertain voxels, the sagittal and coronal networks are not run
+    image[2:6, 5:10, 3:8, 0] = 6.0
+    statistics = SlabStatistics()
+    prob = predict_three_views(image, 1, uncertain_range=[0.2, 0.8], statistics=statistics)
+    np.testing.assert_allclose(prob, 1.0 / (1.0 + np.exp(-image[..., 0])), rtol=1e-5)
+    assert statistics.get_skipped("views") == 8
+
+
+@pytest.mark.parametrize("uncertain_range", [None, [0.2, 0.8]])
+def test_concurrent_views_match_sequential_views(uncertain_range):
+    image = get_uncertain_image()
+    sess = ViewSession(4)
+    expected = predict_three_views(image, 2, sess, uncertain_range=uncertain_range)
+    assert all(threads == set([threading.current_thread()]) for threads in sess.threads.values())
+    sess = ViewSession(4)
+    statistics = SlabStatistics()
+    prob = predict_three_views(
+        image, 2, sess, uncertain_range=uncertain_range, concurrent=True, statistics=statistics
+    )
+    # the views add to the accumulator in any order
+    np.testing.assert_allclose(prob, expected, rtol=1e-6)
+    # the sagittal and coronal views run in their own threads, after the axial view with uncertain_range
+    assert threading.current_thread() not in sess.threads["proby_sg"] | sess.threads["proby_cr"]
+    assert statistics.total == 11